@@ -0,0 +1,72 @@
+"""
+Index persistant des publicités vues, par compte : ad_id → détails et métriques.
+
+Les métriques d'une annonce sont celles de la dernière récupération, quelle que soit sa période :
+chaque ligne garde donc la période couverte (metrics_since / metrics_until) et la date de
+récupération (metrics_fetched_at), pour que l'appelant sache ce que les chiffres représentent.
+
+Toutes les publicités récupérées pour un compte y sont enregistrées (pas seulement les
+gagnantes), à chaque récupération depuis l'API. `facebook_client.get_ad_by_id` lit cet index
+directement ; en cas d'absence, seule la publicité demandée est relue depuis l'API puis
+ajoutée : l'affichage d'un rapport ou la régénération d'un script ne déclenche jamais la
+récupération complète d'un compte.
+"""
+
+import json
+import time
+from typing import Dict, List, Optional
+
+import database
+
+# Détails de l'annonce stockés en colonnes ; les métriques calculées sont stockées en JSON
+DETAIL_COLUMNS = ['name', 'created_time', 'creative_id', 'video_id', 'image_url', 'image_hash']
+
+
+def save_ads(ad_account_id: str, records: List[Dict], since: str, until: str):
+    """
+    Enregistre (ou met à jour) des publicités du compte. Chaque enregistrement contient 'id',
+    les colonnes de DETAIL_COLUMNS et, s'il y a lieu, 'metrics' (métriques de ad_ranking)
+    calculées sur la période [since, until].
+    """
+    if not records:
+        return
+    now = time.time()
+    conn = database.get_db_connection()
+    try:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO ad_index
+                (ad_account_id, ad_id, name, created_time, creative_id, video_id, image_url, image_hash, metrics,
+                 metrics_since, metrics_until, metrics_fetched_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(
+                ad_account_id, record['id'], *(record.get(column) for column in DETAIL_COLUMNS),
+                json.dumps(record['metrics']) if record.get('metrics') else None, since, until, now, now
+            ) for record in records]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def get_ad(ad_account_id: str, ad_id: str) -> Optional[Dict]:
+    """
+    Enregistrement indexé de la publicité, au format de `save_ads`, ou None. Il contient aussi
+    'metrics_since', 'metrics_until' et 'metrics_fetched_at' : la période des métriques.
+    """
+    conn = database.get_db_connection()
+    row = conn.execute(
+        'SELECT * FROM ad_index WHERE ad_account_id = ? AND ad_id = ?', (ad_account_id, ad_id)
+    ).fetchone()
+    conn.close()
+    if row is None:
+        return None
+    record = {'id': row['ad_id'], **{column: row[column] for column in DETAIL_COLUMNS}}
+    record['metrics'] = json.loads(row['metrics']) if row['metrics'] else None
+    for column in ('metrics_since', 'metrics_until', 'metrics_fetched_at'):
+        record[column] = row[column]
+    return record
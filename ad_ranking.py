@@ -0,0 +1,184 @@
+"""
+Classement vectorisé des publicités d'un compte (pandas / NumPy).
+
+Les insights bruts sont aplatis une seule fois en colonnes (`build_frame`). Les filtres de
+dépense, CPA, ROAS et date de création sont ensuite des masques booléens, et le score est une
+combinaison pondérée de métriques (`rank_ads`). Seul le top N est trié, après une sélection
+partielle (np.partition) : les objets pydantic ne sont construits que pour les gagnantes.
+
+Pondérations : {'roas': 1.0} par défaut, ce qui reproduit le tri historique par ROAS décroissant.
+Avec plusieurs métriques, chacune est convertie en rang centile parmi les annonces qualifiées
+(le CPA est inversé : plus il est bas, mieux c'est) avant d'être pondérée.
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from config import RANKING_WEIGHTS
+
+# Métriques utilisables dans les pondérations, et sens dans lequel elles sont meilleures
+SCORABLE_METRICS = {'roas': True, 'cpa': False, 'hook_rate': True, 'hold_rate': True}
+
+
+def parse_weights(spec: str) -> Dict[str, float]:
+    """Convertit "roas:0.6,hook_rate:0.4" en {'roas': 0.6, 'hook_rate': 0.4}."""
+    weights = {}
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+        metric, _, weight = item.partition(':')
+        metric = metric.strip()
+        if metric not in SCORABLE_METRICS:
+            raise ValueError(f"Métrique de classement inconnue : {metric}")
+        weights[metric] = float(weight or 1)
+    return weights or {'roas': 1.0}
+
+
+DEFAULT_WEIGHTS = parse_weights(RANKING_WEIGHTS)
+
+
+def _actions_by_type(actions: Optional[list]) -> Dict[str, str]:
+    return {action.get('action_type'): action.get('value') for action in actions or []}
+
+
+# Colonnes des métriques extraites d'une ligne d'insights, dans l'ordre de `_insight_values`
+METRIC_COLUMNS = [
+    'spend', 'cpa', 'roas', 'website_purchases', 'website_purchases_value',
+    'cpm', 'unique_ctr', 'frequency', 'impressions', 'video_3s_views', 'thru_plays',
+]
+
+
+def _insight_values(insight_data: Dict) -> tuple:
+    """Métriques brutes d'une ligne d'insights ; chaque tableau d'actions n'est parcouru qu'une fois."""
+    actions = _actions_by_type(insight_data.get('actions'))
+    action_values = _actions_by_type(insight_data.get('action_values'))
+    cost_per_action = _actions_by_type(insight_data.get('cost_per_action_type'))
+    video_plays = _actions_by_type(insight_data.get('video_play_actions'))
+    thru_plays = _actions_by_type(insight_data.get('video_thruplay_watched_actions'))
+    purchase_roas = insight_data.get('purchase_roas') or []
+    return (
+        insight_data.get('spend', 0), cost_per_action.get('purchase', 0),
+        purchase_roas[0]['value'] if purchase_roas else 0,
+        actions.get('purchase', 0), action_values.get('purchase', 0),
+        insight_data.get('cpm', 0), insight_data.get('unique_ctr', 0), insight_data.get('frequency', 0),
+        insight_data.get('impressions', 0), video_plays.get('video_view', 0), thru_plays.get('video_view', 0),
+    )
+
+
+def _finish_frame(frame: pd.DataFrame) -> pd.DataFrame:
+    """Convertit les métriques en nombres et calcule hook rate et hold rate."""
+    numeric = ['spend', 'cpa', 'roas', 'website_purchases_value', 'cpm', 'unique_ctr', 'frequency', 'impressions']
+    frame[numeric] = frame[numeric].astype(float)
+    for column in ('website_purchases', 'video_3s_views', 'thru_plays'):
+        frame[column] = frame[column].astype(float).astype(np.int64)
+
+    impressions = frame['impressions'].to_numpy()
+    views = frame['video_3s_views'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frame['hook_rate'] = np.where(impressions > 0, views / impressions * 100, 0.0)
+        frame['hold_rate'] = np.where(views > 0, frame['thru_plays'].to_numpy() / views * 100, 0.0)
+    return frame
+
+
+def build_frame(ad_data_map: Dict[str, Dict], creatives_map: Dict[str, Dict],
+                insights_map: Dict[str, Dict]) -> pd.DataFrame:
+    """Une ligne par publicité ayant une créative et des insights, avec les métriques en colonnes."""
+    rows = []
+    for ad_id, ad_data in ad_data_map.items():
+        creative_info = creatives_map.get(ad_id)
+        insight_data = insights_map.get(ad_id)
+        if not creative_info or not insight_data:
+            continue
+        rows.append((
+            ad_id, ad_data['name'], ad_data.get('created_time'),
+            creative_info.get('creative_id'), creative_info.get('video_id'),
+            creative_info.get('image_url'), creative_info.get('image_hash'),
+        ) + _insight_values(insight_data))
+
+    frame = pd.DataFrame(rows, columns=[
+        'id', 'name', 'created_time', 'creative_id', 'video_id', 'image_url', 'image_hash',
+    ] + METRIC_COLUMNS)
+    return _finish_frame(frame)
+
+
+def build_insights_frame(insight_rows: List[Dict]) -> pd.DataFrame:
+    """Métriques seules (une ligne par ligne d'insights), pour classer une page sans les détails des annonces."""
+    frame = pd.DataFrame(
+        [(row['ad_id'],) + _insight_values(row) for row in insight_rows],
+        columns=['id'] + METRIC_COLUMNS
+    )
+    return _finish_frame(frame)
+
+
+def created_in_range(created_time: Optional[str], date_start: str = None, date_end: str = None) -> bool:
+    """Filtre de date de création de `rank_ads`, pour une seule annonce."""
+    if not (date_start or date_end):
+        return True
+    created_day = (created_time or '')[:10]
+    if not created_day:
+        return False
+    return (not date_start or created_day >= date_start) and (not date_end or created_day <= date_end)
+
+
+def rank_ads(frame: pd.DataFrame, min_spend: float = None, target_cpa: float = None,
+             target_roas: float = None, date_start: str = None, date_end: str = None,
+             spend_floor: float = None, weights: Optional[Dict[str, float]] = None,
+             top_n: Optional[int] = None) -> pd.DataFrame:
+    """
+    Filtre puis classe les publicités de `frame` par score décroissant.
+    - seules les annonces avec dépense, CPA et ROAS strictement positifs sont gardées ;
+    - `spend_floor` (seuil par défaut) exige une dépense strictement supérieure ;
+    - la date de création (AAAA-MM-JJ) doit être dans [date_start, date_end] si l'une est fournie.
+    Retourne au plus `top_n` lignes (toutes si None), avec une colonne 'score'.
+    À score égal, l'ordre d'origine est conservé.
+    """
+    if frame.empty:
+        return frame.assign(score=pd.Series(dtype=float))
+
+    spend = frame['spend'].to_numpy()
+    cpa = frame['cpa'].to_numpy()
+    roas = frame['roas'].to_numpy()
+
+    mask = (spend > 0) & (cpa > 0) & (roas > 0)
+    if min_spend is not None:
+        mask &= spend >= min_spend
+    if target_cpa is not None:
+        mask &= cpa <= target_cpa
+    if target_roas is not None:
+        mask &= roas >= target_roas
+    if spend_floor is not None:
+        mask &= spend > spend_floor
+    if date_start or date_end:
+        # Les dates ISO se comparent comme des chaînes
+        created_day = frame['created_time'].fillna('').str[:10].to_numpy(dtype=object)
+        mask &= created_day != ''
+        if date_start:
+            mask &= created_day >= date_start
+        if date_end:
+            mask &= created_day <= date_end
+
+    qualified = frame[mask]
+    if qualified.empty:
+        return qualified.assign(score=pd.Series(dtype=float))
+
+    weights = weights or DEFAULT_WEIGHTS
+    if list(weights) == ['roas']:
+        score = qualified['roas'].to_numpy()
+    else:
+        score = np.zeros(len(qualified))
+        for metric, weight in weights.items():
+            percentile = qualified[metric].rank(pct=True, ascending=SCORABLE_METRICS[metric]).to_numpy()
+            score += weight * percentile
+
+    positions = np.arange(len(qualified))
+    if top_n is not None and 0 < top_n < len(qualified):
+        # Sélection partielle : les top_n meilleurs scores, puis tri de ce seul sous-ensemble
+        threshold = np.partition(-score, top_n - 1)[top_n - 1]
+        # Toutes les annonces à égalité avec la dernière place sont candidates, pour un départage stable
+        positions = np.flatnonzero(-score <= threshold)
+    order = positions[np.lexsort((positions, -score[positions]))]
+    if top_n is not None:
+        order = order[:max(top_n, 0)]
+    return qualified.iloc[order].assign(score=score[order])
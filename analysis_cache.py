@@ -0,0 +1,164 @@
+"""
+Cache global des analyses Gemini, partagé entre tous les rapports et tous les clients.
+
+La clé est dérivée du contenu du média (hash SHA-256), des métriques injectées dans le prompt,
+de la version des prompts et du modèle utilisé : une créative déjà analysée hier avec les mêmes
+métriques n'est pas renvoyée à Gemini aujourd'hui, même si elle apparaît dans un nouveau rapport
+ou chez un autre client. Des métriques différentes donnent une autre analyse, donc une autre clé. Les entrées expirent
+après ANALYSIS_CACHE_TTL_DAYS et les moins récemment utilisées sont évincées au-delà de
+ANALYSIS_CACHE_MAX_MB.
+
+Le module fournit aussi AdAnalysisStore, le cache des résultats par annonce d'une exécution
+(utilisé pour ne pas refaire une annonce déjà terminée lors d'une nouvelle tentative).
+"""
+
+import hashlib
+import json
+import time
+from typing import Dict, Optional
+
+import database
+from config import ANALYSIS_CACHE_TTL_DAYS, ANALYSIS_CACHE_MAX_MB
+
+
+def compute_media_hash(media_path: str) -> str:
+    """Calcule le hash SHA-256 du contenu d'un fichier média, par blocs."""
+    digest = hashlib.sha256()
+    with open(media_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def make_cache_key(media_hash: str, media_type: str, prompt_version: str, model_name: str, metrics_hash: str) -> str:
+    """Construit la clé de cache d'une analyse (`metrics_hash` : hash du bloc de métriques du prompt)."""
+    return hashlib.sha256(
+        f"{media_hash}:{media_type}:{prompt_version}:{model_name}:{metrics_hash}".encode('utf-8')
+    ).hexdigest()
+
+
+def _increment_stat(conn, name: str, amount: int = 1):
+    conn.execute('UPDATE analysis_cache_stats SET value = value + ? WHERE name = ?', (amount, name))
+
+
+def get_cached_analysis(cache_key: str) -> Optional[Dict]:
+    """Retourne le résultat d'analyse stocké pour cette clé, ou None (absent ou expiré)."""
+    now = time.time()
+    conn = database.get_db_connection()
+    row = conn.execute(
+        'SELECT payload, created_at FROM analysis_cache WHERE cache_key = ?', (cache_key,)
+    ).fetchone()
+
+    if row and now - row['created_at'] < ANALYSIS_CACHE_TTL_DAYS * 86400:
+        conn.execute(
+            'UPDATE analysis_cache SET last_accessed_at = ?, hits = hits + 1 WHERE cache_key = ?',
+            (now, cache_key)
+        )
+        _increment_stat(conn, 'hits')
+        conn.commit()
+        conn.close()
+        return json.loads(row['payload'])
+
+    _increment_stat(conn, 'misses')
+    conn.commit()
+    conn.close()
+    return None
+
+
+def store_analysis(cache_key: str, media_hash: str, prompt_version: str, model_name: str, result: Dict):
+    """Enregistre un résultat d'analyse puis applique les règles d'éviction."""
+    payload = json.dumps(result)
+    now = time.time()
+    conn = database.get_db_connection()
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO analysis_cache
+            (cache_key, media_hash, prompt_version, model_name, payload, size_bytes, created_at, last_accessed_at, hits)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+        """,
+        (cache_key, media_hash, prompt_version, model_name, payload, len(payload), now, now)
+    )
+    _evict(conn, now)
+    conn.commit()
+    conn.close()
+
+
+def _evict(conn, now: float):
+    """Supprime les entrées expirées, puis les moins récemment utilisées si la taille maximale est dépassée."""
+    expired = conn.execute(
+        'DELETE FROM analysis_cache WHERE created_at < ?', (now - ANALYSIS_CACHE_TTL_DAYS * 86400,)
+    ).rowcount
+
+    max_bytes = ANALYSIS_CACHE_MAX_MB * 1024 * 1024
+    total_bytes = conn.execute('SELECT COALESCE(SUM(size_bytes), 0) FROM analysis_cache').fetchone()[0]
+    oversized = []
+    if total_bytes > max_bytes:
+        for row in conn.execute('SELECT cache_key, size_bytes FROM analysis_cache ORDER BY last_accessed_at'):
+            if total_bytes <= max_bytes:
+                break
+            oversized.append((row['cache_key'],))
+            total_bytes -= row['size_bytes']
+        conn.executemany('DELETE FROM analysis_cache WHERE cache_key = ?', oversized)
+
+    if expired or oversized:
+        _increment_stat(conn, 'evictions', expired + len(oversized))
+
+
+def get_cache_stats() -> Dict:
+    """Retourne les compteurs du cache (hits, misses, évictions) et son occupation actuelle."""
+    conn = database.get_db_connection()
+    counters = {row['name']: row['value'] for row in conn.execute('SELECT name, value FROM analysis_cache_stats')}
+    usage = conn.execute('SELECT COUNT(*) AS entries, COALESCE(SUM(size_bytes), 0) AS size_bytes FROM analysis_cache').fetchone()
+    conn.close()
+
+    lookups = counters.get('hits', 0) + counters.get('misses', 0)
+    return {
+        'hits': counters.get('hits', 0),
+        'misses': counters.get('misses', 0),
+        'evictions': counters.get('evictions', 0),
+        'hit_rate': counters.get('hits', 0) / lookups if lookups else 0.0,
+        'entries': usage['entries'],
+        'size_bytes': usage['size_bytes'],
+        'max_bytes': ANALYSIS_CACHE_MAX_MB * 1024 * 1024,
+        'ttl_days': ANALYSIS_CACHE_TTL_DAYS,
+    }
+
+
+class AdAnalysisStore:
+    """
+    Résultats d'analyse par annonce pour un périmètre donné (un rapport), stockés en base.
+
+    Chaque annonce est une ligne écrite dans sa propre transaction : l'écriture est atomique,
+    sûre avec plusieurs writers concurrents, et une lecture ne coûte qu'un accès par clé,
+    quelle que soit la taille totale du cache. S'utilise comme un dictionnaire ad_id -> résultat.
+    """
+
+    def __init__(self, cache_scope: str):
+        self.cache_scope = cache_scope
+
+    def get(self, ad_id: str, default: Optional[Dict] = None) -> Optional[Dict]:
+        conn = database.get_db_connection()
+        row = conn.execute(
+            'SELECT payload FROM ad_analysis_records WHERE cache_scope = ? AND ad_id = ?',
+            (self.cache_scope, ad_id)
+        ).fetchone()
+        conn.close()
+        return json.loads(row['payload']) if row else default
+
+    def __contains__(self, ad_id: str) -> bool:
+        return self.get(ad_id) is not None
+
+    def __getitem__(self, ad_id: str) -> Dict:
+        record = self.get(ad_id)
+        if record is None:
+            raise KeyError(ad_id)
+        return record
+
+    def __setitem__(self, ad_id: str, record: Dict):
+        conn = database.get_db_connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO ad_analysis_records (cache_scope, ad_id, payload, updated_at) VALUES (?, ?, ?, ?)',
+            (self.cache_scope, ad_id, json.dumps(record), time.time())
+        )
+        conn.commit()
+        conn.close()
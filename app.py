@@ -4,13 +4,15 @@ from dateutil import parser
 import database
 from database import get_report_by_id, get_ad_script, update_ad_script
 import threading
-import pipeline
+import worker
+import analysis_cache
+import timings
 import pytz
 import logging
 import os
 import facebook_client
 from functools import wraps
-from config import config, WINNING_ADS_SPEND_THRESHOLD
+from config import config, WINNING_ADS_SPEND_THRESHOLD, EMBEDDED_WORKER, JOB_MAX_CONCURRENCY, JOB_MAX_ATTEMPTS, ANALYSIS_DEFAULT_WINDOW_DAYS
 import json
 
 # --- FILTRE DE LOGS ---
@@ -26,6 +28,12 @@ app = Flask(__name__)
 database.init_db()
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'une-super-cle-secrete-a-changer-en-prod')
 
+# Les analyses sont exécutées par worker.py à partir de la table `jobs`. Avec EMBEDDED_WORKER=1
+# (déploiement sans processus worker séparé), on en démarre un dans le processus web : les jobs
+# restent durables car un job interrompu est repris à l'expiration de son bail.
+if EMBEDDED_WORKER:
+    worker.start_workers(JOB_MAX_CONCURRENCY, threading.Event())
+
 # --- FILTRES DE TEMPLATE ---
 @app.template_filter('format_datetime')
 def format_datetime_filter(s):
@@ -141,7 +149,7 @@ def get_report_status(report_id):
     report = conn.execute('SELECT status FROM analyses WHERE id = ?', (report_id,)).fetchone()
     conn.close()
 
-    if report and report['status'] in ('IN_PROGRESS', 'RUNNING'):
+    if report and report['status'] in ('IN_PROGRESS', 'RUNNING', 'CANCELLING'):
         return "", 204
     else:
         source = request.args.get('source')
@@ -301,15 +309,9 @@ def run_top_n_analysis(client_id):
     print("---------------------------------------------------------")
 
     created_at_local = datetime.now(pytz.timezone("America/Mexico_City"))
-    conn = database.get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO analyses (client_id, status, media_type, created_at) VALUES (?, ?, ?, ?)",
-        (client_id, 'IN_PROGRESS', f'Top {top_n}', created_at_local.strftime('%Y-%m-%d %H:%M:%S'))
+    report_id = database.create_analysis_report(
+        client_id, f'Top {top_n}', created_at_local.strftime('%Y-%m-%d %H:%M:%S')
     )
-    report_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
 
     analysis_args = {
         'client_id': client_id,
@@ -322,8 +324,8 @@ def run_top_n_analysis(client_id):
         'date_end': date_end,
         'analysis_code': analysis_code
     }
-    thread = threading.Thread(target=pipeline.run_top_n_analysis_for_client, kwargs=analysis_args)
-    thread.start()
+    # L'analyse est confiée à la file d'attente durable : elle survit au recyclage du worker web
+    database.enqueue_job('top_n_analysis', analysis_args, report_id=report_id, max_attempts=JOB_MAX_ATTEMPTS)
 
     flash(f"Análisis Top {top_n} para '{client_name}' ha comenzado. El informe aparecerá aquí en breve.", 'info')
 
@@ -335,6 +337,40 @@ def run_top_n_analysis(client_id):
     })
     return response
 
+@app.route('/resume_report/<int:report_id>', methods=['POST'])
+@login_required
+def resume_report(report_id):
+    """Relance un rapport interrompu : seules les annonces non terminées sont analysées."""
+    report = get_report_by_id(report_id)
+    if not report:
+        flash(f"No se encontró el informe ID {report_id}.", "warning")
+    elif report.status in ('IN_PROGRESS', 'RUNNING', 'CANCELLING'):
+        flash(f"El informe ID {report_id} ya está en curso.", "info")
+    else:
+        database.update_analysis_status(report_id, 'IN_PROGRESS')
+        database.enqueue_job('resume_top_n_analysis', {'report_id': report_id}, report_id=report_id, max_attempts=JOB_MAX_ATTEMPTS)
+        flash(f"Reanudando el informe ID {report_id}. Solo se analizarán los anuncios pendientes.", "info")
+
+    response = make_response("")
+    response.headers['HX-Trigger'] = json.dumps({"loadClientList": None, "loadFlash": None})
+    return response
+
+@app.route('/cancel_report/<int:report_id>', methods=['POST'])
+@login_required
+def cancel_report(report_id):
+    """Annule un rapport en file ou en cours : le pipeline s'arrête à la prochaine vérification."""
+    new_status = database.request_report_cancellation(report_id)
+    if new_status is None:
+        flash(f"El informe ID {report_id} no está en curso.", "warning")
+    elif new_status == 'CANCELLING':
+        flash(f"Cancelando el informe ID {report_id}...", "info")
+    else:
+        flash(f"El informe ID {report_id} ha sido cancelado.", "info")
+
+    response = make_response("")
+    response.headers['HX-Trigger'] = json.dumps({"loadClientList": None, "loadFlash": None})
+    return response
+
 @app.route('/clients')
 def get_clients_list():
     conn = database.get_db_connection()
@@ -358,6 +394,11 @@ def get_clients_list():
             
             # Récupérer les erreurs associées à ce rapport
             analysis_dict['errors'] = database.get_errors_for_report(analysis_dict['id'])
+            # Un rapport en échec ou annulé avec des annonces restantes peut être repris
+            analysis_dict['resumable'] = (
+                analysis_dict['status'] in ('FAILED', 'CANCELLED')
+                and database.count_pending_checkpoints(analysis_dict['id']) > 0
+            )
             
             analyses_list.append(analysis_dict)
 
@@ -372,10 +413,10 @@ def get_analysis_modal(client_id):
     # Récupérer la dépense minimale par défaut depuis la configuration
     default_min_spend = WINNING_ADS_SPEND_THRESHOLD
     
-    # Calculer les dates par défaut (les 10 derniers jours)
+    # Calculer les dates par défaut (les N derniers jours, période préchauffée chaque nuit)
     today = datetime.now()
     default_date_end = today.strftime('%Y-%m-%d')
-    default_date_start = (today - timedelta(days=10)).strftime('%Y-%m-%d')
+    default_date_start = (today - timedelta(days=ANALYSIS_DEFAULT_WINDOW_DAYS)).strftime('%Y-%m-%d')
 
     return render_template('_analysis_modal_form.html', 
                            client_id=client_id, 
@@ -416,6 +457,20 @@ def update_ad_script(report_id, ad_id):
     conn.close()
     return jsonify(status='success', message='Script actualizado.')
 
+@app.route('/analysis_cache/stats')
+@login_required
+def analysis_cache_stats():
+    """Compteurs du cache global des analyses (hits, misses, évictions, occupation)."""
+    return jsonify(analysis_cache.get_cache_stats())
+
+@app.route('/pipeline_timings/stats')
+@login_required
+def pipeline_timings_stats():
+    """Temps par étape du pipeline (p50/p95), pour un rapport (?report_id=) ou les N derniers jours (?days=)."""
+    report_id = request.args.get('report_id', type=int)
+    days = request.args.get('days', type=float)
+    return jsonify(timings.get_stage_stats(report_id=report_id, days=days))
+
 @app.route('/storage/<path:filename>')
 def serve_storage_file(filename):
     return send_from_directory(os.path.join(app.root_path, 'data', 'storage'), filename)
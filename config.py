@@ -12,8 +12,88 @@ load_dotenv(os.path.join(project_root, '.env'))
 # Ces valeurs définissent la logique métier pour identifier une "winning ad"
 WINNING_ADS_SPEND_THRESHOLD = 3000.0  # Dépense minimale pour être considérée
 WINNING_ADS_CPA_THRESHOLD = 600.0     # Coût par acquisition maximal
+# Score de classement des annonces (voir ad_ranking.py) : métriques pondérées parmi roas, cpa,
+# hook_rate, hold_rate, par exemple "roas:0.6,hook_rate:0.2,hold_rate:0.2"
+RANKING_WEIGHTS = os.getenv("RANKING_WEIGHTS", "roas:1").strip('\'"')
 CACHE_DURATION_HOURS = 24             # Durée de validité du cache en heures
 FACEBOOK_CACHE_DIR = "data/facebook_cache" # Dossier pour les caches par compte
+# Au-delà de CACHE_DURATION_HOURS et jusqu'à cet âge, le cache est servi pendant qu'un
+# rafraîchissement tourne en arrière-plan ; au-delà, la récupération est bloquante
+FACEBOOK_CACHE_STALE_HOURS = int(os.getenv("FACEBOOK_CACHE_STALE_HOURS", "168").strip('\'"'))
+# Nombre de caches de comptes (et de classements) gardés décodés en mémoire par processus
+FACEBOOK_CACHE_LRU_SIZE = int(os.getenv("FACEBOOK_CACHE_LRU_SIZE", "16").strip('\'"'))
+FACEBOOK_REFRESH_LOCK_SECONDS = int(os.getenv("FACEBOOK_REFRESH_LOCK_SECONDS", "3600").strip('\'"'))
+# Durée de validité d'une validation de token Facebook (voir token_cache.py) ; un token refusé
+# est gardé moins longtemps
+TOKEN_VALIDATION_TTL_SECONDS = int(os.getenv("TOKEN_VALIDATION_TTL_SECONDS", "3600").strip('\'"'))
+TOKEN_VALIDATION_INVALID_TTL_SECONDS = int(os.getenv("TOKEN_VALIDATION_INVALID_TTL_SECONDS", "300").strip('\'"'))
+# Préchauffage quotidien des caches de tous les clients à cette heure (heure de Mexico), -1 pour désactiver
+FACEBOOK_PREWARM_HOUR = int(os.getenv("FACEBOOK_PREWARM_HOUR", "5").strip('\'"'))
+# Période d'analyse proposée par défaut dans le formulaire (les N derniers jours), préchauffée
+# chaque nuit avec la période par défaut de l'API (30 jours)
+ANALYSIS_DEFAULT_WINDOW_DAYS = int(os.getenv("ANALYSIS_DEFAULT_WINDOW_DAYS", "10").strip('\'"'))
+
+# Nombre maximal d'annonces analysées en parallèle dans un rapport Top N
+ANALYSIS_MAX_WORKERS = int(os.getenv("ANALYSIS_MAX_WORKERS", "3").strip('\'"'))
+# Concurrence propre à chaque étape du pipeline d'analyse (par défaut ANALYSIS_MAX_WORKERS)
+ANALYSIS_DOWNLOAD_WORKERS = int(os.getenv("ANALYSIS_DOWNLOAD_WORKERS", str(ANALYSIS_MAX_WORKERS)).strip('\'"'))
+ANALYSIS_UPLOAD_WORKERS = int(os.getenv("ANALYSIS_UPLOAD_WORKERS", str(ANALYSIS_MAX_WORKERS)).strip('\'"'))
+ANALYSIS_GENERATE_WORKERS = int(os.getenv("ANALYSIS_GENERATE_WORKERS", str(ANALYSIS_MAX_WORKERS)).strip('\'"'))
+# Taille des files entre étapes : borne le nombre de médias téléchargés en attente
+ANALYSIS_STAGE_QUEUE_SIZE = int(os.getenv("ANALYSIS_STAGE_QUEUE_SIZE", "2").strip('\'"'))
+
+# Nombre de résultats d'annonces regroupés dans une même transaction SQLite. Par défaut chaque
+# résultat est validé aussitôt : au-delà de 1, un arrêt brutal fait refaire (et repayer à Gemini)
+# les analyses terminées mais pas encore écrites
+PIPELINE_DB_FLUSH_EVERY = int(os.getenv("PIPELINE_DB_FLUSH_EVERY", "1").strip('\'"'))
+
+# Requêtes simultanées vers l'API Graph lors de la récupération des annonces d'un compte
+FACEBOOK_FETCH_CONCURRENCY = int(os.getenv("FACEBOOK_FETCH_CONCURRENCY", "4").strip('\'"'))
+# Au-delà de ce nombre d'annonces actives, les insights sont demandés via un rapport asynchrone
+FACEBOOK_ASYNC_INSIGHTS_MIN_ADS = int(os.getenv("FACEBOOK_ASYNC_INSIGHTS_MIN_ADS", "500").strip('\'"'))
+FACEBOOK_ASYNC_INSIGHTS_TIMEOUT_SECONDS = int(os.getenv("FACEBOOK_ASYNC_INSIGHTS_TIMEOUT_SECONDS", "600").strip('\'"'))
+# Insights quotidiens stockés en base (voir insights_store.py) : seuls les jours manquants sont téléchargés,
+# les N derniers jours sont toujours relus (attribution des conversions encore en cours).
+# Désactivé par défaut : le CTR unique et la fréquence, calculés sur des personnes uniques, ne
+# s'agrègent pas exactement d'un jour à l'autre et diffèrent des valeurs de l'API sur la période.
+FACEBOOK_DAILY_INSIGHTS = os.getenv("FACEBOOK_DAILY_INSIGHTS", "0").strip('\'"').lower() in ("1", "true", "yes")
+FACEBOOK_INSIGHTS_REFRESH_DAYS = int(os.getenv("FACEBOOK_INSIGHTS_REFRESH_DAYS", "3").strip('\'"'))
+# Mode mémoire bornée : avec un top N, les insights sont classés page par page sans cache
+# du compte entier (voir facebook_client._stream_winning_ads)
+FACEBOOK_LOW_MEMORY = os.getenv("FACEBOOK_LOW_MEMORY", "0").strip('\'"').lower() in ("1", "true", "yes")
+# Limites de débit de l'API Graph (voir facebook_throttle.py) : ralentissement au-delà du seuil
+# d'utilisation annoncé dans les en-têtes, nouvelles tentatives espacées en cas d'erreur temporaire
+FACEBOOK_THROTTLE_USAGE_PCT = float(os.getenv("FACEBOOK_THROTTLE_USAGE_PCT", "75").strip('\'"'))
+FACEBOOK_THROTTLE_MAX_PAUSE_SECONDS = float(os.getenv("FACEBOOK_THROTTLE_MAX_PAUSE_SECONDS", "60").strip('\'"'))
+FACEBOOK_API_MAX_RETRIES = int(os.getenv("FACEBOOK_API_MAX_RETRIES", "5").strip('\'"'))
+FACEBOOK_RETRY_BASE_SECONDS = float(os.getenv("FACEBOOK_RETRY_BASE_SECONDS", "2").strip('\'"'))
+FACEBOOK_RETRY_MAX_SECONDS = float(os.getenv("FACEBOOK_RETRY_MAX_SECONDS", "300").strip('\'"'))
+# Lectures d'objets regroupées via /batch (voir graph_batch.py) : taille des paquets (50 au plus)
+# et délai d'attente pour regrouper des demandes concurrentes
+FACEBOOK_BATCH_SIZE = int(os.getenv("FACEBOOK_BATCH_SIZE", "50").strip('\'"'))
+FACEBOOK_BATCH_WINDOW_MS = int(os.getenv("FACEBOOK_BATCH_WINDOW_MS", "50").strip('\'"'))
+
+# Cache global des analyses, partagé entre rapports et clients (voir analysis_cache.py)
+ANALYSIS_CACHE_TTL_DAYS = int(os.getenv("ANALYSIS_CACHE_TTL_DAYS", "30").strip('\'"'))
+ANALYSIS_CACHE_MAX_MB = int(os.getenv("ANALYSIS_CACHE_MAX_MB", "50").strip('\'"'))   # Taille maximale des résultats stockés
+
+# File d'attente durable des analyses (voir worker.py)
+JOB_MAX_CONCURRENCY = int(os.getenv("JOB_MAX_CONCURRENCY", "2").strip('\'"'))   # Jobs en cours, tous workers confondus
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300").strip('\'"'))     # Durée d'un bail avant reprise par un autre worker
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3").strip('\'"'))         # Tentatives avant abandon définitif
+JOB_POLL_INTERVAL_SECONDS = 5                                                    # Attente entre deux recherches de job
+JOB_CANCEL_POLL_SECONDS = int(os.getenv("JOB_CANCEL_POLL_SECONDS", "2").strip('\'"'))  # Fréquence de vérification des annulations
+# Lance un worker dans le processus web. Désactivé par défaut : les analyses sont exécutées
+# par un processus dédié (python worker.py). À n'activer que pour un déploiement à service unique.
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "0").strip('\'"').lower() in ("1", "true", "yes")
+
+# Analyses groupées en ligne de commande (python pipeline.py batch)
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", "4").strip('\'"'))                 # Clients analysés en parallèle
+BATCH_MAX_PER_AD_ACCOUNT = int(os.getenv("BATCH_MAX_PER_AD_ACCOUNT", "1").strip('\'"'))   # Analyses simultanées par compte publicitaire
+
+# Mesure des temps d'exécution par étape du pipeline (table `pipeline_timings`)
+PIPELINE_TIMINGS_ENABLED = os.getenv("PIPELINE_TIMINGS_ENABLED", "1").strip('\'"').lower() in ("1", "true", "yes")
+PIPELINE_TIMINGS_RETENTION_DAYS = int(os.getenv("PIPELINE_TIMINGS_RETENTION_DAYS", "30").strip('\'"'))
 
 class FacebookConfig(BaseSettings):
     access_token: Optional[str] = None # Rendu optionnel car fourni via l'UI
@@ -1,7 +1,8 @@
 import sqlite3
 import os
+import time
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Dict, Any
 import json
 from datetime import datetime
 
@@ -41,7 +42,9 @@ def get_db_connection():
     """Crée et retourne une connexion à la base de données."""
     # S'assurer que le répertoire de la base de données existe
     os.makedirs(os.path.dirname(DATABASE_FILE), exist_ok=True)
-    conn = sqlite3.connect(DATABASE_FILE)
+    # Le worker et le serveur web écrivent dans la même base : on attend un verrou
+    # plutôt que d'échouer immédiatement avec "database is locked".
+    conn = sqlite3.connect(DATABASE_FILE, timeout=30)
     conn.row_factory = sqlite3.Row  # Permet d'accéder aux colonnes par leur nom
     return conn
 
@@ -49,6 +52,8 @@ def init_db():
     """Initialise la base de données et crée les tables si elles n'existent pas."""
     print("Inicializando las tablas de la base de datos...")
     conn = get_db_connection()
+    # Le mode WAL permet aux lectures du serveur web de ne pas bloquer les écritures des workers
+    conn.execute('PRAGMA journal_mode=WAL')
     cursor = conn.cursor()
     
     # Créer la table des clients si elle n'existe pas, avec la nouvelle structure
@@ -146,6 +151,176 @@ def init_db():
         )
     ''')
 
+    # File d'attente durable des jobs d'analyse, consommée par worker.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER,
+            job_type TEXT NOT NULL,
+            payload TEXT NOT NULL, -- Arguments du job en JSON
+            status TEXT NOT NULL DEFAULT 'QUEUED', -- 'QUEUED', 'RUNNING', 'DONE' ou 'FAILED'
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            lease_owner TEXT,
+            lease_expires_at REAL, -- Timestamp Unix d'expiration du bail
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (report_id) REFERENCES analyses (id) ON DELETE CASCADE
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, lease_expires_at)')
+
+    # Cache global des analyses Gemini, adressé par le contenu du média (voir analysis_cache.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analysis_cache (
+            cache_key TEXT PRIMARY KEY,
+            media_hash TEXT NOT NULL,
+            prompt_version TEXT NOT NULL,
+            model_name TEXT NOT NULL,
+            payload TEXT NOT NULL, -- Résultat de la génération en JSON
+            size_bytes INTEGER NOT NULL,
+            created_at REAL NOT NULL, -- Timestamps Unix
+            last_accessed_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_analysis_cache_access ON analysis_cache (last_accessed_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analysis_cache_stats (
+            name TEXT PRIMARY KEY, -- 'hits', 'misses', 'evictions'
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.executemany(
+        'INSERT OR IGNORE INTO analysis_cache_stats (name, value) VALUES (?, 0)',
+        [('hits',), ('misses',), ('evictions',)]
+    )
+
+    # Résultats d'analyse par annonce d'une exécution donnée (un enregistrement par ligne,
+    # écrit dès que l'annonce est terminée). Remplace les anciens fichiers analysis_*.json.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ad_analysis_records (
+            cache_scope TEXT NOT NULL, -- ex: 'analysis_<client>_<rapport>_top<n>'
+            ad_id TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (cache_scope, ad_id)
+        )
+    ''')
+
+    # Points de reprise par annonce des rapports Top N : la sélection d'annonces d'origine
+    # et le résultat de chaque annonce terminée, pour reprendre un rapport interrompu.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_checkpoints (
+            report_id INTEGER NOT NULL,
+            rank INTEGER NOT NULL, -- Position dans le Top N (0 = meilleure annonce)
+            ad_id TEXT NOT NULL,
+            ad_data TEXT NOT NULL, -- L'annonce sélectionnée, en JSON
+            status TEXT NOT NULL DEFAULT 'PENDING', -- 'PENDING', 'DONE' ou 'FAILED'
+            report_part TEXT, -- Fragment du rapport final (JSON) une fois l'annonce terminée
+            cost_analysis REAL,
+            cost_generation REAL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (report_id, rank),
+            FOREIGN KEY (report_id) REFERENCES analyses (id) ON DELETE CASCADE
+        )
+    ''')
+
+    # Index persistant des médias déjà présents dans data/storage, par source (vidéo ou image)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_files (
+            source_key TEXT PRIMARY KEY, -- 'video:<video_id>' ou 'image:<image_url>'
+            ad_id TEXT,
+            media_type TEXT NOT NULL,
+            file_path TEXT NOT NULL,
+            content_hash TEXT,
+            size_bytes INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+    # Temps d'exécution de chaque étape du pipeline, par rapport et par annonce
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_timings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER,
+            ad_id TEXT,
+            stage TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            duration_ms REAL NOT NULL,
+            bytes INTEGER,
+            tokens INTEGER,
+            status TEXT NOT NULL -- OK, ERROR
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pipeline_timings_stage ON pipeline_timings (stage, started_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pipeline_timings_report ON pipeline_timings (report_id)')
+
+    # Insights quotidiens par annonce (voir insights_store.py) et jours déjà récupérés par compte
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ad_daily_insights (
+            ad_account_id TEXT NOT NULL,
+            ad_id TEXT NOT NULL,
+            day TEXT NOT NULL, -- AAAA-MM-JJ
+            spend REAL NOT NULL DEFAULT 0,
+            impressions INTEGER NOT NULL DEFAULT 0,
+            purchases INTEGER NOT NULL DEFAULT 0,
+            purchase_value REAL NOT NULL DEFAULT 0,
+            video_3s_views INTEGER NOT NULL DEFAULT 0,
+            thru_plays INTEGER NOT NULL DEFAULT 0,
+            unique_ctr REAL NOT NULL DEFAULT 0,
+            frequency REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (ad_account_id, ad_id, day)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ad_daily_insights_day ON ad_daily_insights (ad_account_id, day)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ad_insights_coverage (
+            ad_account_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (ad_account_id, day)
+        )
+    ''')
+
+    # Index persistant des publicités vues par compte (voir ad_index.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ad_index (
+            ad_account_id TEXT NOT NULL,
+            ad_id TEXT NOT NULL,
+            name TEXT,
+            created_time TEXT,
+            creative_id TEXT,
+            video_id TEXT,
+            image_url TEXT,
+            image_hash TEXT,
+            metrics TEXT, -- JSON : métriques calculées (spend, cpa, roas, hook_rate...)
+            metrics_since TEXT, -- Période couverte par les métriques (AAAA-MM-JJ)
+            metrics_until TEXT,
+            metrics_fetched_at REAL, -- Date de récupération des métriques depuis l'API
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (ad_account_id, ad_id)
+        )
+    ''')
+    for column, column_type in (('metrics_since', 'TEXT'), ('metrics_until', 'TEXT'), ('metrics_fetched_at', 'REAL')):
+        try:
+            cursor.execute(f'ALTER TABLE ad_index ADD COLUMN {column} {column_type};')
+        except sqlite3.OperationalError:
+            pass
+
+    # Résultats de validation des tokens Facebook, indexés par empreinte du token (voir token_cache.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS token_validations (
+            token_hash TEXT PRIMARY KEY,
+            is_valid INTEGER NOT NULL,
+            message TEXT,
+            accounts TEXT, -- JSON : comptes publicitaires actifs
+            debug_info TEXT, -- JSON : métadonnées de /debug_token (expiration, scopes...)
+            checked_at REAL NOT NULL
+        )
+    ''')
+
     conn.commit()
     conn.close()
     print("La base de données et les tables existent déjà ou ont été créées.")
@@ -311,6 +486,19 @@ def delete_setting(key: str):
     conn.commit()
     conn.close()
 
+def create_analysis_report(client_id: int, media_type: str, created_at: str) -> int:
+    """Crée un rapport IN_PROGRESS pour un client et retourne son ID."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO analyses (client_id, status, media_type, created_at) VALUES (?, ?, ?, ?)",
+        (client_id, 'IN_PROGRESS', media_type, created_at)
+    )
+    report_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return report_id
+
 def update_analysis_status(report_id: int, status: str, failure_reason: Optional[str] = None):
     """Met à jour le statut et la raison de l'échec d'un rapport d'analyse."""
     conn = get_db_connection()
@@ -321,6 +509,363 @@ def update_analysis_status(report_id: int, status: str, failure_reason: Optional
     conn.commit()
     conn.close()
 
+# --- POINTS DE REPRISE DES RAPPORTS ---
+
+def get_report_checkpoints(report_id: int) -> List[sqlite3.Row]:
+    """Récupère les points de reprise d'un rapport, dans l'ordre du Top N."""
+    conn = get_db_connection()
+    rows = conn.execute(
+        'SELECT * FROM report_checkpoints WHERE report_id = ? ORDER BY rank', (report_id,)
+    ).fetchall()
+    conn.close()
+    return rows
+
+def count_pending_checkpoints(report_id: int) -> int:
+    """Nombre d'annonces d'un rapport qui restent à analyser."""
+    conn = get_db_connection()
+    count = conn.execute(
+        "SELECT COUNT(*) FROM report_checkpoints WHERE report_id = ? AND status = 'PENDING'", (report_id,)
+    ).fetchone()[0]
+    conn.close()
+    return count
+
+class ReportRunStore:
+    """
+    Persistance d'une exécution du pipeline Top N sur une seule connexion.
+
+    Les scripts, erreurs et points de reprise des annonces terminées sont mis en tampon puis
+    écrits par `executemany`, dans une transaction validée tous les `flush_every` résultats
+    et à chaque étape clé (démarrage, sélection des annonces, fin ou échec du rapport).
+    Une annonce dont le résultat n'a pas encore été validé reste PENDING et sera refaite
+    lors d'une reprise : par défaut, chaque résultat est donc validé aussitôt (`flush_every=1`).
+    À utiliser depuis un seul thread.
+    """
+
+    def __init__(self, report_id: int, flush_every: int = 1):
+        self.report_id = report_id
+        self.flush_every = max(1, flush_every)
+        self.conn = get_db_connection()
+        self._results = []
+        self._errors = []
+
+    def get_client(self, client_id: int) -> Optional[sqlite3.Row]:
+        return self.conn.execute('SELECT * FROM clients WHERE id = ?', (client_id,)).fetchone()
+
+    def mark_running(self, params: Dict[str, Any]) -> bool:
+        """
+        Passe le rapport en RUNNING et enregistre ses paramètres (nécessaires à une reprise).
+        Retourne False si une annulation a été demandée entre-temps : le rapport n'est pas relancé.
+        """
+        updated = self.conn.execute(
+            """
+            UPDATE analyses
+            SET status = 'RUNNING', failure_reason = NULL, num_ads_to_analyze = ?, min_spend_param = ?,
+                target_cpa_param = ?, target_roas_param = ?, date_start_param = ?, date_end_param = ?,
+                analysis_code_param = ?
+            WHERE id = ? AND status NOT IN ('CANCELLING', 'CANCELLED')
+            """,
+            (params.get('num_ads'), params.get('min_spend'), params.get('target_cpa'), params.get('target_roas'),
+             params.get('date_start'), params.get('date_end'), params.get('analysis_code'), self.report_id)
+        ).rowcount
+        self.conn.commit()
+        return updated > 0
+
+    def get_checkpoints(self) -> List[sqlite3.Row]:
+        """Points de reprise du rapport, dans l'ordre du Top N."""
+        return self.conn.execute(
+            'SELECT * FROM report_checkpoints WHERE report_id = ? ORDER BY rank', (self.report_id,)
+        ).fetchall()
+
+    def create_checkpoints(self, ads: list) -> List[sqlite3.Row]:
+        """Enregistre la sélection d'annonces (une ligne PENDING par rang) et la liste de leurs IDs."""
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO report_checkpoints (report_id, rank, ad_id, ad_data) VALUES (?, ?, ?, ?)',
+            [(self.report_id, rank, ad.id, json.dumps(ad.model_dump())) for rank, ad in enumerate(ads)]
+        )
+        self.conn.execute('UPDATE analyses SET ad_id = ? WHERE id = ?', (','.join(ad.id for ad in ads), self.report_id))
+        self.conn.commit()
+        return self.get_checkpoints()
+
+    def add_result(self, rank: int, ad_id: str, script_html: str, report_part: dict,
+                   cost_analysis: float, cost_generation: float):
+        """Met en tampon le résultat d'une annonce terminée."""
+        self._results.append((rank, ad_id, script_html, json.dumps(report_part), cost_analysis, cost_generation))
+        self._flush_if_needed()
+
+    def add_error(self, rank: int, ad_id: str, error_message: str):
+        """Met en tampon l'échec d'une annonce."""
+        self._errors.append((rank, ad_id, error_message))
+        self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if len(self._results) + len(self._errors) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Écrit les résultats et erreurs en tampon dans une seule transaction (étape db_write)."""
+        if not self._results and not self._errors:
+            return
+        # Import local : timings importe database
+        import timings
+        with timings.span('db_write'):
+            self._write_buffers()
+        print(f"Persistance : {len(self._results)} résultat(s) et {len(self._errors)} erreur(s) enregistrés pour le rapport {self.report_id}.")
+        self._results = []
+        self._errors = []
+
+    def _write_buffers(self):
+        try:
+            # Un script laissé par une exécution interrompue est remplacé (pas de doublon)
+            self.conn.executemany(
+                'DELETE FROM ad_scripts WHERE report_id = ? AND ad_id = ?',
+                [(self.report_id, ad_id) for _, ad_id, *_ in self._results]
+            )
+            self.conn.executemany(
+                'INSERT INTO ad_scripts (report_id, ad_id, original_script_html) VALUES (?, ?, ?)',
+                [(self.report_id, ad_id, script_html) for _, ad_id, script_html, *_ in self._results]
+            )
+            self.conn.executemany(
+                """
+                UPDATE report_checkpoints
+                SET status = 'DONE', report_part = ?, cost_analysis = ?, cost_generation = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE report_id = ? AND rank = ?
+                """,
+                [(part, cost_analysis, cost_generation, self.report_id, rank)
+                 for rank, _, _, part, cost_analysis, cost_generation in self._results]
+            )
+            self.conn.executemany(
+                'INSERT INTO analysis_errors (report_id, ad_id, error_message) VALUES (?, ?, ?)',
+                [(self.report_id, ad_id, message) for _, ad_id, message in self._errors]
+            )
+            self.conn.executemany(
+                "UPDATE report_checkpoints SET status = 'FAILED', updated_at = CURRENT_TIMESTAMP WHERE report_id = ? AND rank = ?",
+                [(self.report_id, rank) for rank, _, _ in self._errors]
+            )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def complete(self, report_structure: str, cost_analysis: float, cost_generation: float):
+        """Valide les derniers résultats puis marque le rapport COMPLETED avec son contenu final."""
+        self.flush()
+        import timings
+        with timings.span('db_write'):
+            self.conn.execute(
+                """
+                UPDATE analyses
+                SET status = ?, analysis_html = ?, cost_analysis = ?, cost_generation = ?, total_cost = ?
+                WHERE id = ?
+                """,
+                ('COMPLETED', report_structure, cost_analysis, cost_generation, cost_analysis + cost_generation, self.report_id)
+            )
+            self.conn.commit()
+
+    def fail(self, failure_reason: str):
+        """Marque le rapport FAILED en conservant les résultats déjà obtenus (pour une reprise)."""
+        try:
+            self.flush()
+        except Exception as flush_error:
+            print(f"⚠️ Impossible d'enregistrer les derniers résultats du rapport {self.report_id} : {flush_error}")
+        self.conn.execute(
+            'UPDATE analyses SET status = ?, failure_reason = ? WHERE id = ?',
+            ('FAILED', failure_reason, self.report_id)
+        )
+        self.conn.commit()
+
+    def cancel(self):
+        """Valide les résultats déjà obtenus puis marque le rapport CANCELLED."""
+        try:
+            self.flush()
+        except Exception as flush_error:
+            print(f"⚠️ Impossible d'enregistrer les derniers résultats du rapport {self.report_id} : {flush_error}")
+        self.conn.execute(
+            'UPDATE analyses SET status = ?, failure_reason = ? WHERE id = ?',
+            ('CANCELLED', "Análisis cancelado por el usuario.", self.report_id)
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+# --- FILE D'ATTENTE DES JOBS ---
+# Les jobs sont réclamés avec un bail (lease) : un worker qui meurt sans terminer son job
+# laisse expirer le bail et le job redevient disponible pour un autre worker.
+
+def enqueue_job(job_type: str, payload: Dict[str, Any], report_id: Optional[int] = None, max_attempts: int = 3) -> int:
+    """Ajoute un job dans la file d'attente et retourne son ID."""
+    conn = get_db_connection()
+    cursor = conn.execute(
+        'INSERT INTO jobs (report_id, job_type, payload, max_attempts) VALUES (?, ?, ?, ?)',
+        (report_id, job_type, json.dumps(payload), max_attempts)
+    )
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+def claim_job(worker_id: str, lease_seconds: int, max_running: int) -> Optional[Dict[str, Any]]:
+    """
+    Réclame le prochain job disponible (en attente ou dont le bail a expiré) pour `worker_id`.
+    Respecte une limite globale de jobs en cours, partagée par tous les workers.
+    Les jobs dont le bail a expiré trop de fois sont marqués FAILED, ainsi que leur rapport.
+    Retourne le job (payload décodé) ou None s'il n'y a rien à faire.
+    """
+    conn = get_db_connection()
+    try:
+        # BEGIN IMMEDIATE prend le verrou d'écriture : deux workers ne peuvent pas réclamer le même job
+        conn.execute('BEGIN IMMEDIATE')
+        now = time.time()
+
+        abandoned = conn.execute(
+            "SELECT id, report_id FROM jobs WHERE status = 'RUNNING' AND lease_expires_at <= ? AND attempts >= max_attempts",
+            (now,)
+        ).fetchall()
+        for job in abandoned:
+            conn.execute(
+                "UPDATE jobs SET status = 'FAILED', last_error = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                ("Bail expiré après le nombre maximal de tentatives.", job['id'])
+            )
+            if job['report_id'] is not None:
+                # Un rapport dont l'annulation était demandée reste annulé
+                conn.execute(
+                    """
+                    UPDATE analyses
+                    SET status = CASE WHEN status = 'CANCELLING' THEN 'CANCELLED' ELSE 'FAILED' END,
+                        failure_reason = CASE WHEN status = 'CANCELLING' THEN failure_reason ELSE ? END
+                    WHERE id = ?
+                    """,
+                    ("El análisis se interrumpió varias veces y no pudo completarse.", job['report_id'])
+                )
+
+        running = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'RUNNING' AND lease_expires_at > ?", (now,)
+        ).fetchone()[0]
+        if running >= max_running:
+            conn.commit()
+            return None
+
+        job = conn.execute(
+            """
+            SELECT * FROM jobs
+            WHERE status = 'QUEUED' OR (status = 'RUNNING' AND lease_expires_at <= ?)
+            ORDER BY id
+            LIMIT 1
+            """, (now,)
+        ).fetchone()
+        if not job:
+            conn.commit()
+            return None
+
+        conn.execute(
+            """
+            UPDATE jobs
+            SET status = 'RUNNING', lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            """,
+            (worker_id, now + lease_seconds, job['id'])
+        )
+        conn.commit()
+
+        claimed = dict(job)
+        claimed['payload'] = json.loads(claimed['payload'])
+        claimed['attempts'] += 1
+        return claimed
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def renew_job_lease(job_id: int, worker_id: str, lease_seconds: int) -> bool:
+    """Prolonge le bail d'un job. Retourne False si le worker n'en est plus propriétaire."""
+    conn = get_db_connection()
+    cursor = conn.execute(
+        """
+        UPDATE jobs SET lease_expires_at = ?, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ? AND lease_owner = ? AND status = 'RUNNING'
+        """,
+        (time.time() + lease_seconds, job_id, worker_id)
+    )
+    conn.commit()
+    conn.close()
+    return cursor.rowcount > 0
+
+def request_report_cancellation(report_id: int) -> Optional[str]:
+    """
+    Demande l'annulation d'un rapport en cours et retourne son nouveau statut (None s'il n'était pas en cours).
+    Les jobs encore en file sont annulés : un rapport qui n'avait pas démarré passe directement
+    en CANCELLED, sinon il passe en CANCELLING et le pipeline s'arrête à la prochaine vérification.
+    """
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        report = conn.execute('SELECT status FROM analyses WHERE id = ?', (report_id,)).fetchone()
+        if not report or report['status'] not in ('IN_PROGRESS', 'RUNNING'):
+            conn.rollback()
+            return None
+
+        conn.execute(
+            "UPDATE jobs SET status = 'CANCELLED', updated_at = CURRENT_TIMESTAMP WHERE report_id = ? AND status = 'QUEUED'",
+            (report_id,)
+        )
+        running = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE report_id = ? AND status = 'RUNNING'", (report_id,)
+        ).fetchone()[0]
+        new_status = 'CANCELLING' if running else 'CANCELLED'
+        conn.execute(
+            'UPDATE analyses SET status = ?, failure_reason = ? WHERE id = ?',
+            (new_status, "Análisis cancelado por el usuario.", report_id)
+        )
+        conn.commit()
+        return new_status
+    finally:
+        conn.close()
+
+def is_cancellation_requested(report_id: int) -> bool:
+    """Indique si l'annulation d'un rapport a été demandée."""
+    conn = get_db_connection()
+    row = conn.execute('SELECT status FROM analyses WHERE id = ?', (report_id,)).fetchone()
+    conn.close()
+    return bool(row) and row['status'] in ('CANCELLING', 'CANCELLED')
+
+def finish_job(job_id: int, worker_id: str, error: Optional[str] = None, retryable: bool = True):
+    """
+    Termine un job détenu par `worker_id` : DONE en cas de succès.
+    En cas d'erreur, le job est remis en file s'il lui reste des tentatives (et si l'erreur est
+    `retryable`), sinon il passe en FAILED. Un rapport dont le job est remis en file repasse en
+    IN_PROGRESS. Rien n'est enregistré si le job n'est plus en cours pour ce worker (bail perdu ou annulé).
+    """
+    conn = get_db_connection()
+    if error is None:
+        conn.execute(
+            """
+            UPDATE jobs SET status = 'DONE', lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND lease_owner = ? AND status = 'RUNNING'
+            """,
+            (job_id, worker_id)
+        )
+    else:
+        conn.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN ? AND attempts < max_attempts THEN 'QUEUED' ELSE 'FAILED' END,
+                last_error = ?, lease_owner = NULL, lease_expires_at = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND lease_owner = ? AND status = 'RUNNING'
+            """,
+            (1 if retryable else 0, error, job_id, worker_id)
+        )
+        conn.execute(
+            """
+            UPDATE analyses SET status = 'IN_PROGRESS'
+            WHERE status = 'FAILED' AND id = (SELECT report_id FROM jobs WHERE id = ? AND status = 'QUEUED')
+            """,
+            (job_id,)
+        )
+    conn.commit()
+    conn.close()
+
 if __name__ == '__main__':
     # Permet d'initialiser la DB en exécutant `python database.py`
     init_db() 
\ No newline at end of file
@@ -1,19 +1,39 @@
 from __future__ import annotations
 import os
 import json
+import time
+import threading
 from datetime import datetime, timedelta
-from typing import List, Dict, Optional, Tuple
+import heapq
+import itertools
+import zlib
+from collections import OrderedDict
+from typing import Iterator, List, Dict, Optional, Tuple
 from pydantic import BaseModel
 from facebook_business.api import FacebookAdsApi
+from facebook_business.session import FacebookSession
 from facebook_business.adobjects.adaccount import AdAccount
 from facebook_business.adobjects.user import User
-from facebook_business.adobjects.ad import Ad as FBAd
 from facebook_business.exceptions import FacebookRequestError
 import requests
 from facebook_business.adobjects.adcreative import AdCreative
+from facebook_business.adobjects.adreportrun import AdReportRun
 import traceback
-
-from config import config, WINNING_ADS_SPEND_THRESHOLD, WINNING_ADS_CPA_THRESHOLD, CACHE_DURATION_HOURS, FACEBOOK_CACHE_DIR
+from concurrent.futures import ThreadPoolExecutor
+
+import insights_store
+import ad_ranking
+import ad_index
+import token_cache
+import graph_batch
+import timings
+from facebook_throttle import ThrottledFacebookAdsApi, FacebookRateLimitError, is_throttling_error, is_transient_error
+from config import (
+    config, WINNING_ADS_SPEND_THRESHOLD, WINNING_ADS_CPA_THRESHOLD, CACHE_DURATION_HOURS, FACEBOOK_CACHE_DIR,
+    FACEBOOK_FETCH_CONCURRENCY, FACEBOOK_ASYNC_INSIGHTS_MIN_ADS, FACEBOOK_ASYNC_INSIGHTS_TIMEOUT_SECONDS,
+    FACEBOOK_DAILY_INSIGHTS, FACEBOOK_CACHE_STALE_HOURS, FACEBOOK_REFRESH_LOCK_SECONDS, FACEBOOK_LOW_MEMORY,
+    FACEBOOK_CACHE_LRU_SIZE
+)
 
 # --- Définition des schémas de données (anciennement dans schemas.py) ---
 class AdInsights(BaseModel):
@@ -39,6 +59,7 @@ class Ad(BaseModel):
     creative_id: Optional[str] = None
     video_id: Optional[str] = None
     image_url: Optional[str] = None
+    image_hash: Optional[str] = None
     insights: Optional[AdInsights] = None
     created_time: Optional[str] = None
 
@@ -58,245 +79,753 @@ def init_facebook_api(access_token: Optional[str] = None, ad_account_id: Optiona
     if not final_access_token:
         raise ValueError("Le token d'accès Facebook est manquant.")
 
-    # On force la version de l'API à "v19.0" pour toutes les requêtes
-    FacebookAdsApi.init(
+    # On force la version de l'API à "v19.0" pour toutes les requêtes.
+    # L'instance retournée doit être passée explicitement aux appels : l'API par défaut
+    # est globale au processus et plusieurs analyses peuvent tourner en parallèle.
+    # Les limites de débit de l'API sont respectées (voir facebook_throttle.py), par quota de compte
+    api = ThrottledFacebookAdsApi.init(
         access_token=final_access_token,
         api_version="v19.0"
     )
+    api.ad_account_id = ad_account_id
+    return api
+
+
+AD_DETAIL_FIELDS = ['id', 'name', 'created_time', 'creative{id,image_url,image_hash,video_id}']
+
+# Filtre côté serveur : seules les publicités réellement diffusées sont renvoyées
+ACTIVE_ADS_FILTER = [{'field': 'effective_status', 'operator': 'IN', 'value': ['ACTIVE']}]
+
 
+def _chunks(items: list, size: int) -> List[list]:
+    """Découpe une liste en morceaux de `size` éléments, dans l'ordre."""
+    return [items[i:i+size] for i in range(0, len(items), size)]
 
-def _fetch_insights_batch(account: AdAccount, ad_ids: List[str], 
-                           date_start: str = None, date_end: str = None) -> Dict[str, Dict]:
+
+def _fetch_ad_details_chunk(ad_ids: List[str], api: Optional[FacebookAdsApi] = None) -> List[Dict]:
+    """
+    Récupère le nom, la date de création et la créative d'un lot d'au plus 50 publicités,
+    en une requête /batch. Une publicité illisible (supprimée entre-temps...) est ignorée
+    sans faire échouer le lot. Une limite de débit toujours atteinte après les nouvelles
+    tentatives (FacebookRateLimitError) ou une erreur temporaire persistante fait échouer
+    le lot : le classement ne doit pas perdre silencieusement des gagnantes.
     """
-    Récupère les insights pour une liste d'ad_ids en utilisant un filtre
+    futures = graph_batch.get_batcher(api).get_many(ad_ids, AD_DETAIL_FIELDS)
+    details = []
+    for ad_id, future in futures.items():
+        try:
+            details.append(future.result())
+        except FacebookRequestError as e:
+            if is_throttling_error(e) or is_transient_error(e):
+                raise
+            print(f"⚠️ Détails de l'annonce {ad_id} indisponibles : {e.api_error_message()}")
+    return details
+
+
+INSIGHT_FIELDS = [
+    'ad_id', 
+    'spend', 
+    'cost_per_action_type',
+    'impressions',
+    'cpm',
+    'unique_ctr',
+    'frequency',
+    'purchase_roas',
+    'actions',
+    'action_values',
+    'video_play_actions', # Base pour le "Hook Rate" (vues de 3s)
+    'video_thruplay_watched_actions' # Base pour le "Hold Rate"
+]
+
+
+def _insights_params(date_start: str = None, date_end: str = None) -> Dict:
+    """Paramètres communs des requêtes d'insights au niveau annonce."""
+    return {
+        'level': 'ad',
+        'fields': INSIGHT_FIELDS,
+        'time_range': {
+            'since': date_start or (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d'),
+            'until': date_end or datetime.now().strftime('%Y-%m-%d')
+        },
+        'limit': 500
+    }
+
+
+def _fetch_insights_chunk(account: AdAccount, ad_ids: List[str],
+                          date_start: str = None, date_end: str = None) -> List[Dict]:
+    """
+    Récupère les insights d'un lot d'au plus 100 publicités en utilisant un filtre
     sur le compte publicitaire, ce qui est une forme de batching efficace.
     """
-    insights_map = {}
-    insight_fields = [
-        'ad_id', 
-        'spend', 
-        'cost_per_action_type',
-        'impressions',
-        'cpm',
-        'unique_ctr',
-        'frequency',
-        'purchase_roas',
-        'actions',
-        'action_values',
-        'video_play_actions', # Base pour le "Hook Rate" (vues de 3s)
-        'video_thruplay_watched_actions' # Base pour le "Hold Rate"
+    params = _insights_params(date_start, date_end)
+    params['filtering'] = [{'field': 'ad.id', 'operator': 'IN', 'value': ad_ids}]
+    print(f"Exécution de la requête d'insights pour {len(ad_ids)} publicités...")
+    # La pagination est parcourue ici, dans le thread qui a lancé la requête
+    return [insight.export_all_data() for insight in account.get_insights(params=params)]
+
+
+def _run_async_report(account: AdAccount, params: Dict) -> List[Dict]:
+    """
+    Exécute une requête d'insights sous forme de rapport asynchrone (AdReportRun) : le job est
+    interrogé avec un intervalle croissant, puis ses résultats sont parcourus page par page.
+    """
+    report_run = account.get_insights(params=params, is_async=True)
+
+    started = time.time()
+    delay = 1.0
+    while True:
+        report_run = report_run.api_get(fields=[AdReportRun.Field.async_status, AdReportRun.Field.async_percent_completion])
+        status = report_run[AdReportRun.Field.async_status]
+        if status == 'Job Completed':
+            break
+        if status in ('Job Failed', 'Job Skipped'):
+            raise RuntimeError(f"Le rapport d'insights asynchrone a échoué (statut : {status}).")
+        if time.time() - started > FACEBOOK_ASYNC_INSIGHTS_TIMEOUT_SECONDS:
+            raise TimeoutError(f"Le rapport d'insights asynchrone n'est pas terminé après {FACEBOOK_ASYNC_INSIGHTS_TIMEOUT_SECONDS} secondes.")
+        print(f"  Rapport asynchrone : {status} ({report_run.get(AdReportRun.Field.async_percent_completion, 0)}%)")
+        time.sleep(delay)
+        delay = min(delay * 2, 30.0)
+
+    rows = [insight.export_all_data() for insight in report_run.get_result(params={'limit': 500})]
+    print(f"Rapport asynchrone terminé en {time.time() - started:.0f}s.")
+    return rows
+
+
+def _fetch_insights_async(account: AdAccount, ad_ids: List[str],
+                          date_start: str = None, date_end: str = None) -> Dict[str, Dict]:
+    """
+    Récupère les insights de tout le compte via un rapport asynchrone : un seul job côté
+    serveur au lieu de nombreuses requêtes filtrées par `ad.id IN [...]`.
+    Seules les publicités de `ad_ids` sont conservées.
+    """
+    wanted = set(ad_ids)
+    print(f"Lancement d'un rapport d'insights asynchrone pour {len(ad_ids)} publicités...")
+    rows = _run_async_report(account, _insights_params(date_start, date_end))
+    return {row['ad_id']: row for row in rows if row['ad_id'] in wanted}
+
+
+def _fetch_insights(account: AdAccount, ad_ids: List[str], executor: ThreadPoolExecutor,
+                    date_start: str = None, date_end: str = None) -> Dict[str, Dict]:
+    """
+    Récupère les insights d'une liste de publicités, indexés par ad_id.
+    Au-delà de FACEBOOK_ASYNC_INSIGHTS_MIN_ADS publicités, un rapport asynchrone est utilisé ;
+    sinon (ou s'il échoue) les lots de 100 sont demandés en parallèle sur `executor` et
+    fusionnés dans l'ordre des lots.
+    """
+    if len(ad_ids) >= FACEBOOK_ASYNC_INSIGHTS_MIN_ADS:
+        try:
+            return _fetch_insights_async(account, ad_ids, date_start, date_end)
+        except (FacebookRequestError, RuntimeError, TimeoutError) as e:
+            print(f"⚠️ Rapport asynchrone indisponible ({e}), repli sur les requêtes par lots.")
+
+    futures = [
+        timings.submit(executor, _fetch_insights_chunk, account, chunk, date_start, date_end)
+        for chunk in _chunks(ad_ids, 100)
     ]
+    return {insight['ad_id']: insight for future in futures for insight in future.result()}
+
+
+def _is_reduce_data_error(error: FacebookRequestError) -> bool:
+    """Indique si l'API demande de réduire le volume de données d'une requête."""
+    message = (error.api_error_message() or '').lower()
+    return error.api_error_subcode() == 99 or 'reduce the amount of data' in message
+
+
+def _parse_ad_details(details: List[Dict]) -> Tuple[Dict[str, Dict], Dict[str, Dict]]:
+    """Sépare les détails bruts des publicités en (nom/date de création, créative) indexés par ad_id."""
+    ad_data_map = {}
+    creatives_map = {}
+    for ad in details:
+        ad_data_map[ad['id']] = {'name': ad['name'], 'created_time': ad.get('created_time')}
+        if 'creative' in ad:
+            creative_info = ad['creative']
+            
+            # Nous ne pouvons pas demander le champ 'video' directement sur AdCreative.
+            # Nous utilisons le video_id directement de la créative.
+            final_video_id = creative_info.get('video_id')
+            
+            print(f"DEBUG: Ad ID {ad['id']}, Creative ID: {creative_info.get('id')}, Extracted Video ID: {final_video_id}")
+
+            creatives_map[ad['id']] = {
+                'creative_id': creative_info.get('id'),
+                'video_id': final_video_id,
+                'image_url': creative_info.get('image_url'),
+                'image_hash': creative_info.get('image_hash')
+            }
+    return ad_data_map, creatives_map
 
-    # Découpe les IDs en morceaux de 100 pour le filtre 'IN'
-    for i in range(0, len(ad_ids), 100):
-        chunk = ad_ids[i:i+100]
+
+def _count_active_ads(account: AdAccount) -> int:
+    """Nombre de publicités actives du compte, via le résumé de la liste (une seule requête légère)."""
+    cursor = account.get_ads(fields=['id'], params={'filtering': ACTIVE_ADS_FILTER, 'summary': 'true', 'limit': 1})
+    return cursor.total() or 0
+
+
+def _fetch_active_ad_details(account: AdAccount) -> Tuple[Dict[str, Dict], Dict[str, Dict]]:
+    """Nom, date de création et créative de toutes les publicités actives, en un appel paginé."""
+    details = [ad.export_all_data() for ad in account.get_ads(
+        fields=AD_DETAIL_FIELDS, params={'filtering': ACTIVE_ADS_FILTER, 'limit': 500}
+    )]
+    return _parse_ad_details(details)
+
+
+def _fetch_active_ad_details_chunked(account: AdAccount, api: Optional[FacebookAdsApi] = None) -> Tuple[Dict[str, Dict], Dict[str, Dict]]:
+    """Variante de `_fetch_active_ad_details` par lots de 50, pour les réponses trop volumineuses."""
+    active_ad_ids = [ad['id'] for ad in account.get_ads(fields=['id'], params={'filtering': ACTIVE_ADS_FILTER, 'limit': 500})]
+    with ThreadPoolExecutor(max_workers=max(1, FACEBOOK_FETCH_CONCURRENCY), thread_name_prefix="fb-fetch") as executor:
+        futures = [timings.submit(executor, _fetch_ad_details_chunk, chunk, api) for chunk in _chunks(active_ad_ids, 50)]
+        details = [ad for future in futures for ad in future.result()]
+    return _parse_ad_details(details)
+
+
+def _sync_daily_insights(account: AdAccount, ad_account_id: str, since: str, until: str) -> Dict[str, Dict]:
+    """
+    Met à jour le stock d'insights quotidiens du compte (voir insights_store) pour [since, until] :
+    seuls les jours manquants et les jours récents sont demandés à l'API, avec time_increment=1.
+    Retourne les insights agrégés sur la période, indexés par ad_id.
+    """
+    for range_since, range_until in insights_store.missing_ranges(ad_account_id, since, until):
+        print(f"Récupération des insights quotidiens {range_since} → {range_until}...")
         params = {
             'level': 'ad',
-            'fields': insight_fields,
-            'filtering': [{'field': 'ad.id', 'operator': 'IN', 'value': chunk}],
-            'time_range': {
-                'since': date_start or (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d'),
-                'until': date_end or datetime.now().strftime('%Y-%m-%d')
-            },
+            'fields': insights_store.DAILY_INSIGHT_FIELDS,
+            'time_range': {'since': range_since, 'until': range_until},
+            'time_increment': 1,
             'limit': 500
         }
-        print(f"Exécution de la requête d'insights pour {len(chunk)} publicités...")
-        insights_cursor = account.get_insights(params=params)
-        for insight in insights_cursor:
-            insights_map[insight['ad_id']] = insight
-    
+        try:
+            rows = [insight.export_all_data() for insight in account.get_insights(params=params)]
+        except FacebookRequestError as e:
+            if not _is_reduce_data_error(e):
+                raise
+            print("⚠️ Réponse trop volumineuse pour l'API, repli sur un rapport asynchrone...")
+            rows = _run_async_report(account, params)
+        insights_store.save_daily_insights(ad_account_id, range_since, range_until, rows)
+    return insights_store.aggregate_insights(ad_account_id, since, until)
+
+
+def _expanded_insights_field(date_start: str = None, date_end: str = None) -> str:
+    """Champ `insights` expansé, pour obtenir les métriques de la période avec les détails des annonces."""
+    time_range = _insights_params(date_start, date_end)['time_range']
+    return f"insights.time_range({json.dumps(time_range)}){{{','.join(INSIGHT_FIELDS)}}}"
+
+
+def _expanded_insights(details: List[Dict]) -> Dict[str, Dict]:
+    """Insights expansés des détails d'annonces, indexés par ad_id."""
+    insights_map = {}
+    for ad in details:
+        # Les insights expansés arrivent sous forme de liste (une ligne pour la période demandée)
+        rows = (ad.get('insights') or {}).get('data') or []
+        if rows:
+            insights_map[ad['id']] = rows[0]
     return insights_map
 
 
+def _fetch_account_ads(account: AdAccount, api: Optional[FacebookAdsApi] = None,
+                       date_start: str = None, date_end: str = None) -> Tuple[Dict, Dict, Dict]:
+    """
+    Récupère les publicités actives avec leur nom, leur créative et leurs insights, en
+    s'appuyant sur l'expansion de champs de l'API Graph :
+    - compte de taille normale : un seul appel paginé à /ads renvoie tout, insights compris ;
+    - au-delà de FACEBOOK_ASYNC_INSIGHTS_MIN_ADS publicités : /ads renvoie les détails et les
+      insights sont calculés par un rapport asynchrone.
+    Retourne (ad_data_map, creatives_map, insights_map).
+    """
+    active_count = _count_active_ads(account)
+    print(f"{active_count} publicités actives trouvées.")
+    if not active_count:
+        return {}, {}, {}
+
+    if active_count >= FACEBOOK_ASYNC_INSIGHTS_MIN_ADS:
+        ad_data_map, creatives_map = _fetch_active_ad_details(account)
+        with ThreadPoolExecutor(max_workers=max(1, FACEBOOK_FETCH_CONCURRENCY), thread_name_prefix="fb-fetch") as executor:
+            insights_map = _fetch_insights(account, list(ad_data_map), executor, date_start, date_end)
+        return ad_data_map, creatives_map, insights_map
+
+    print("Récupération des publicités, créatives et métriques en un seul appel paginé...")
+    details = [ad.export_all_data() for ad in account.get_ads(
+        fields=AD_DETAIL_FIELDS + [_expanded_insights_field(date_start, date_end)],
+        params={'filtering': ACTIVE_ADS_FILTER, 'limit': 100}
+    )]
+    ad_data_map, creatives_map = _parse_ad_details(details)
+    return ad_data_map, creatives_map, _expanded_insights(details)
+
+
+def _fetch_account_ads_chunked(account: AdAccount, api: Optional[FacebookAdsApi] = None,
+                               date_start: str = None, date_end: str = None) -> Tuple[Dict, Dict, Dict]:
+    """
+    Variante de `_fetch_account_ads` par petites requêtes, utilisée quand l'API refuse une
+    réponse trop volumineuse : IDs des publicités actives, puis détails (lots de 50) et insights
+    demandés en parallèle, avec au plus FACEBOOK_FETCH_CONCURRENCY requêtes simultanées.
+    Les résultats sont fusionnés dans l'ordre des lots.
+    """
+    print("Récupération des IDs de toutes les publicités actives...")
+    active_ad_ids = [ad['id'] for ad in account.get_ads(fields=['id'], params={'filtering': ACTIVE_ADS_FILTER, 'limit': 500})]
+    print(f"{len(active_ad_ids)} publicités actives trouvées.")
+    if not active_ad_ids:
+        return {}, {}, {}
+
+    print(f"\\nRécupération groupée des détails, des créatives et des métriques "
+          f"({FACEBOOK_FETCH_CONCURRENCY} requêtes en parallèle)...")
+    with ThreadPoolExecutor(max_workers=max(1, FACEBOOK_FETCH_CONCURRENCY), thread_name_prefix="fb-fetch") as executor:
+        detail_futures = [timings.submit(executor, _fetch_ad_details_chunk, chunk, api) for chunk in _chunks(active_ad_ids, 50)]
+        # Pendant que les détails arrivent, ce thread récupère les insights
+        insights_map = _fetch_insights(account, active_ad_ids, executor, date_start, date_end)
+        details = [ad for future in detail_futures for ad in future.result()]
+
+    ad_data_map, creatives_map = _parse_ad_details(details)
+    return ad_data_map, creatives_map, insights_map
+
+
+def _raw_cache_path(ad_account_id: str, since: str, until: str) -> str:
+    until_day = datetime.strptime(until, '%Y-%m-%d').date()
+    if until_day == datetime.now().date():
+        # Période glissante (les N derniers jours jusqu'à aujourd'hui, comme celles du formulaire) :
+        # une seule entrée par compte et par durée, qui reste servie (périmée) le lendemain pendant
+        # son rafraîchissement au lieu de devenir un cache introuvable
+        days = (until_day - datetime.strptime(since, '%Y-%m-%d').date()).days
+        return os.path.join(FACEBOOK_CACHE_DIR, f"facebook_raw_{ad_account_id}_last{days}d.json.z")
+    return os.path.join(FACEBOOK_CACHE_DIR, f"facebook_raw_{ad_account_id}_{since}_{until}.json.z")
+
+
+def prune_raw_caches(max_age_hours: float = FACEBOOK_CACHE_STALE_HOURS) -> int:
+    """
+    Supprime les caches bruts plus vieux que `max_age_hours` (au-delà, ils ne seraient plus servis)
+    ainsi que les fichiers temporaires abandonnés. Retourne le nombre de fichiers supprimés.
+    """
+    if not os.path.isdir(FACEBOOK_CACHE_DIR):
+        return 0
+    removed = 0
+    for name in os.listdir(FACEBOOK_CACHE_DIR):
+        if not name.startswith('facebook_raw_') or name.endswith('.refresh'):
+            continue
+        path = os.path.join(FACEBOOK_CACHE_DIR, name)
+        try:
+            if (time.time() - os.path.getmtime(path)) / 3600 > max_age_hours:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+# Caches déjà décodés dans ce processus, par (fichier, mtime) : une nouvelle version du fichier
+# (rafraîchissement, autre processus) change la clé, l'ancienne entrée sort par l'ordre LRU
+_raw_cache_lru = OrderedDict()
+_raw_cache_lru_lock = threading.Lock()
+
+
+def _remember_raw_cache(key: Tuple[str, int], cached: Dict):
+    with _raw_cache_lru_lock:
+        _raw_cache_lru[key] = cached
+        _raw_cache_lru.move_to_end(key)
+        while len(_raw_cache_lru) > FACEBOOK_CACHE_LRU_SIZE:
+            _raw_cache_lru.popitem(last=False)
+
+
+def _read_raw_cache(cache_file: str) -> Optional[Tuple[Dict, float]]:
+    """
+    Retourne (contenu du cache, âge en heures), ou None si le cache est absent ou illisible.
+    Le fichier (JSON compact compressé par zlib) n'est décodé qu'une fois par version.
+    """
+    try:
+        stat = os.stat(cache_file)
+    except FileNotFoundError:
+        return None
+    age_hours = (time.time() - stat.st_mtime) / 3600
+    key = (cache_file, stat.st_mtime_ns)
+    with _raw_cache_lru_lock:
+        cached = _raw_cache_lru.get(key)
+        if cached is not None:
+            _raw_cache_lru.move_to_end(key)
+            return cached, age_hours
+
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = json.loads(zlib.decompress(f.read()))
+        if not {'ad_data_map', 'creatives_map', 'insights_map'} <= cached.keys():
+            raise KeyError("données incomplètes")
+    except (OSError, zlib.error, ValueError, TypeError, KeyError) as e:
+        print(f"⚠️ Erreur de lecture du cache ({e}), récupération depuis l'API.")
+        return None
+    _remember_raw_cache(key, cached)
+    return cached, age_hours
+
+
+def _write_raw_cache(cache_file: str, cached: Dict):
+    """Écrit le cache (JSON compact compressé) et le garde décodé en mémoire."""
+    os.makedirs(FACEBOOK_CACHE_DIR, exist_ok=True)
+    # Écriture dans un fichier temporaire puis renommage : un lecteur ne voit jamais un cache partiel
+    temp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_file, 'wb') as f:
+        f.write(zlib.compress(json.dumps(cached, separators=(',', ':')).encode('utf-8'), 6))
+    os.replace(temp_file, cache_file)
+    _remember_raw_cache((cache_file, os.stat(cache_file).st_mtime_ns), cached)
+
+
+def _fetch_raw_ads(ad_account_id: str, api: Optional[FacebookAdsApi], since: str, until: str,
+                   cache_file: str) -> Tuple[Dict, Dict, Dict]:
+    """Récupère les données brutes du compte depuis l'API et les écrit dans `cache_file`."""
+    account = AdAccount(ad_account_id, api=api)
+    if FACEBOOK_DAILY_INSIGHTS:
+        # Détails des publicités depuis l'API, métriques depuis le stock quotidien (jours manquants seulement)
+        try:
+            ad_data_map, creatives_map = _fetch_active_ad_details(account)
+        except FacebookRequestError as e:
+            if not _is_reduce_data_error(e):
+                raise
+            print("⚠️ Réponse trop volumineuse pour l'API, repli sur les requêtes par lots...")
+            ad_data_map, creatives_map = _fetch_active_ad_details_chunked(account, api)
+        print(f"{len(ad_data_map)} publicités actives trouvées.")
+        daily_insights = _sync_daily_insights(account, ad_account_id, since, until)
+        insights_map = {ad_id: daily_insights[ad_id] for ad_id in ad_data_map if ad_id in daily_insights}
+    else:
+        try:
+            ad_data_map, creatives_map, insights_map = _fetch_account_ads(account, api, since, until)
+        except FacebookRequestError as e:
+            if not _is_reduce_data_error(e):
+                raise
+            print("⚠️ Réponse trop volumineuse pour l'API, repli sur les requêtes par lots...")
+            ad_data_map, creatives_map, insights_map = _fetch_account_ads_chunked(account, api, since, until)
+
+    print(f"Sauvegarde des données brutes dans le cache : {cache_file}")
+    _write_raw_cache(cache_file, {
+        'since': since, 'until': until,
+        'ad_data_map': ad_data_map, 'creatives_map': creatives_map, 'insights_map': insights_map
+    })
+    _index_ads(ad_account_id, ad_data_map, creatives_map, insights_map, since, until)
+    return ad_data_map, creatives_map, insights_map
+
+
+def _index_ads(ad_account_id: str, ad_data_map: Dict[str, Dict], creatives_map: Dict[str, Dict],
+               insights_map: Dict[str, Dict], since: str, until: str) -> List[Dict]:
+    """
+    Enregistre toutes les publicités récupérées dans l'index persistant (voir ad_index.py), avec
+    leurs métriques de la période [since, until] quand elles ont une créative et des insights.
+    Retourne les enregistrements.
+    """
+    frame = ad_ranking.build_frame(ad_data_map, creatives_map, insights_map)
+    metric_columns = ad_ranking.METRIC_COLUMNS + ['hook_rate', 'hold_rate']
+    metrics_by_id = {row['id']: {column: row[column] for column in metric_columns} for row in frame.to_dict('records')}
+
+    records = []
+    for ad_id, ad_data in ad_data_map.items():
+        creative_info = creatives_map.get(ad_id, {})
+        records.append({
+            'id': ad_id, 'name': ad_data['name'], 'created_time': ad_data.get('created_time'),
+            'creative_id': creative_info.get('creative_id'), 'video_id': creative_info.get('video_id'),
+            'image_url': creative_info.get('image_url'), 'image_hash': creative_info.get('image_hash'),
+            'metrics': metrics_by_id.get(ad_id),
+        })
+    try:
+        ad_index.save_ads(ad_account_id, records, since, until)
+    except Exception as e:
+        # L'index n'est qu'un accélérateur : son échec ne doit pas faire échouer la récupération
+        print(f"⚠️ Impossible de mettre à jour l'index des annonces : {e}")
+    return records
+
+
+# Rafraîchissements en arrière-plan en cours dans ce processus, par fichier de cache
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _refresh_in_background(ad_account_id: str, api: Optional[FacebookAdsApi], since: str, until: str,
+                           cache_file: str) -> bool:
+    """
+    Lance le rafraîchissement de `cache_file` dans un thread, sauf s'il est déjà en cours :
+    dans ce processus (ensemble `_refreshing`) ou dans un autre (fichier verrou récent).
+    Retourne True si un rafraîchissement a été lancé.
+    """
+    with _refreshing_lock:
+        if cache_file in _refreshing:
+            return False
+        _refreshing.add(cache_file)
+
+    lock_file = f"{cache_file}.refresh"
+    try:
+        os.makedirs(FACEBOOK_CACHE_DIR, exist_ok=True)
+        # Un verrou plus vieux que le délai maximal d'un rafraîchissement est abandonné
+        if os.path.exists(lock_file) and time.time() - os.path.getmtime(lock_file) > FACEBOOK_REFRESH_LOCK_SECONDS:
+            os.remove(lock_file)
+        os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        with _refreshing_lock:
+            _refreshing.discard(cache_file)
+        return False
+
+    def refresh():
+        try:
+            _fetch_raw_ads(ad_account_id, api, since, until, cache_file)
+            print(f"✅ Cache du compte {ad_account_id} rafraîchi en arrière-plan.")
+        except Exception as e:
+            print(f"⚠️ Échec du rafraîchissement en arrière-plan du compte {ad_account_id} : {e}")
+        finally:
+            try:
+                os.remove(lock_file)
+            except OSError:
+                pass
+            with _refreshing_lock:
+                _refreshing.discard(cache_file)
+
+    threading.Thread(target=refresh, name=f"fb-refresh-{ad_account_id}", daemon=True).start()
+    return True
+
+
+def _get_raw_ads(ad_account_id: str, api: Optional[FacebookAdsApi] = None,
+                 date_start: str = None, date_end: str = None) -> Tuple[Dict, Dict, Dict]:
+    """
+    Retourne (ad_data_map, creatives_map, insights_map) des publicités actives du compte pour
+    la période demandée (30 derniers jours par défaut), sans aucun filtre de performance.
+    Avec FACEBOOK_DAILY_INSIGHTS, les métriques sont agrégées depuis le stock quotidien en base.
+
+    Le résultat est mis en cache par (compte, période), une période finissant aujourd'hui étant
+    glissante (voir `_raw_cache_path`) :
+    - moins de CACHE_DURATION_HOURS, pour exactement la même période : servi tel quel ;
+    - moins de FACEBOOK_CACHE_STALE_HOURS (ou période glissante décalée d'un jour) : servi
+      immédiatement, et un seul rafraîchissement par fichier est lancé en arrière-plan
+      (stale-while-revalidate) ;
+    - au-delà, ou sans cache : récupération bloquante depuis l'API.
+    """
+    time_range = _insights_params(date_start, date_end)['time_range']
+    since, until = time_range['since'], time_range['until']
+    cache_file = _raw_cache_path(ad_account_id, since, until)
+
+    cache = _read_raw_cache(cache_file)
+    if cache is not None:
+        cached, age_hours = cache
+        period = f"{cached.get('since', since)} → {cached.get('until', until)}"
+        same_period = (cached.get('since'), cached.get('until')) == (since, until)
+        if age_hours < CACHE_DURATION_HOURS and same_period:
+            print(f"ℹ️ Données du compte pour la période {period} chargées depuis le cache.")
+            return cached['ad_data_map'], cached['creatives_map'], cached['insights_map']
+        if age_hours < FACEBOOK_CACHE_STALE_HOURS:
+            print(f"ℹ️ Cache périmé ({age_hours:.0f}h) servi pour la période {period}, rafraîchissement en arrière-plan.")
+            _refresh_in_background(ad_account_id, api, since, until, cache_file)
+            return cached['ad_data_map'], cached['creatives_map'], cached['insights_map']
+
+    print(f"ℹ️ Cache non trouvé ou expiré pour la période {since} → {until}. Récupération des données depuis l'API Facebook...")
+    return _fetch_raw_ads(ad_account_id, api, since, until, cache_file)
+
+
+def refresh_account_cache(ad_account_id: str, api: Optional[FacebookAdsApi] = None, min_age_hours: float = 0,
+                          days: int = 30) -> bool:
+    """
+    Rafraîchit de façon bloquante le cache de la période glissante des `days` derniers jours du
+    compte, sauf s'il couvre déjà cette période et a moins de `min_age_hours`. Utilisé pour
+    préchauffer les caches en heures creuses. Retourne True si l'API a été interrogée.
+    """
+    today = datetime.now()
+    since, until = (today - timedelta(days=days)).strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d')
+    cache_file = _raw_cache_path(ad_account_id, since, until)
+    cache = _read_raw_cache(cache_file)
+    if cache is not None and cache[1] < min_age_hours and (cache[0].get('since'), cache[0].get('until')) == (since, until):
+        return False
+    _fetch_raw_ads(ad_account_id, api, since, until, cache_file)
+    return True
+
+
+def _build_ad(values: Dict) -> Ad:
+    """
+    Construit un Ad à partir d'une ligne classée (détails de l'annonce et métriques).
+    Les valeurs viennent de notre propre classement et sont déjà typées ici : les modèles sont
+    construits sans revalidation (model_construct).
+    """
+    return Ad.model_construct(
+        id=str(values['id']),
+        name=values['name'],
+        creative_id=values['creative_id'],
+        video_id=values.get('video_id'),
+        image_url=values.get('image_url'),
+        image_hash=values.get('image_hash'),
+        insights=AdInsights.model_construct(
+            spend=float(values['spend']),
+            cpa=float(values['cpa']),
+            roas=float(values['roas']),
+            website_purchases=int(values['website_purchases']),
+            website_purchases_value=float(values['website_purchases_value']),
+            cpm=float(values['cpm']),
+            unique_ctr=float(values['unique_ctr']),
+            frequency=float(values['frequency']),
+            hook_rate=float(values['hook_rate']),
+            hold_rate=float(values['hold_rate'])
+        ),
+        created_time=values.get('created_time')
+    )
+
+
+# Derniers classements calculés, par version des données brutes et paramètres : les appels
+# répétés (get_ad_by_id, get_specific_winning_ad) ne refont ni le classement ni les objets Ad
+_ranked_lru = OrderedDict()
+_ranked_lru_lock = threading.Lock()
+
+
+def _insight_pages(account: AdAccount, params: Dict) -> Iterator[List[Dict]]:
+    """Parcourt les insights page par page : une seule page est en mémoire à la fois."""
+    cursor = iter(account.get_insights(params=params))
+    while True:
+        page = [insight.export_all_data() for insight in itertools.islice(cursor, params['limit'])]
+        if not page:
+            return
+        yield page
+
+
+def _stream_winning_ads(ad_account_id: str, api: Optional[FacebookAdsApi], date_start: Optional[str],
+                        date_end: Optional[str], top_n: int, min_spend: float = None, target_cpa: float = None,
+                        target_roas: float = None, spend_floor: float = None) -> List[Ad]:
+    """
+    Variante de `get_winning_ads` à mémoire bornée (FACEBOOK_LOW_MEMORY), pour le tri par ROAS.
+    Les pages d'insights sont filtrées et classées dès leur arrivée ; seul le top N courant est
+    gardé dans un tas. Les détails (nom, créative, date de création) ne sont demandés que pour
+    les annonces qui entrent dans le tas : à la fin sans filtre de date, page par page sinon.
+    Sans filtre de date, le tas garde 2 × N annonces pour remplacer celles sans créative.
+    """
+    params = _insights_params(date_start, date_end)
+    params['filtering'] = [{'field': 'ad.effective_status', 'operator': 'IN', 'value': ['ACTIVE']}]
+    account = AdAccount(ad_account_id, api=api)
+    needs_details = bool(date_start or date_end)
+    capacity = top_n if needs_details else top_n * 2
+
+    # Entrées (ROAS, -ordre d'arrivée, ligne) : la moins bonne en tête, départage stable comme `rank_ads`
+    heap = []
+    seen = 0
+    print(f"Classement en flux des insights (top {top_n}, mémoire bornée)...")
+    for page in _insight_pages(account, params):
+        candidates = ad_ranking.rank_ads(
+            ad_ranking.build_insights_frame(page), min_spend=min_spend, target_cpa=target_cpa,
+            target_roas=target_roas, spend_floor=spend_floor, top_n=capacity
+        )
+        entries = [
+            (row['score'], -(seen + position), row)
+            for position, row in zip(candidates.index, candidates.to_dict('records'))
+        ]
+        entries = [entry for entry in entries if len(heap) < capacity or entry[:2] > heap[0][:2]]
+        seen += len(page)
+
+        if needs_details and entries:
+            ad_data_map, creatives_map = _parse_ad_details(_fetch_ad_details_chunk([entry[2]['id'] for entry in entries], api))
+            kept = []
+            for entry in entries:
+                ad_id = entry[2]['id']
+                if ad_id in creatives_map and ad_ranking.created_in_range(ad_data_map[ad_id].get('created_time'), date_start, date_end):
+                    entry[2].update(ad_data_map[ad_id], **creatives_map[ad_id])
+                    kept.append(entry)
+            entries = kept
+
+        for entry in entries:
+            if len(heap) < capacity:
+                heapq.heappush(heap, entry)
+            elif entry[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, entry)
+
+    print(f"{seen} insights parcourus, {len(heap)} candidates retenues.")
+    rows = [entry[2] for entry in sorted(heap, key=lambda entry: entry[:2], reverse=True)]
+    if not needs_details and rows:
+        ad_data_map, creatives_map = _parse_ad_details(_fetch_ad_details_chunk([row['id'] for row in rows], api))
+        rows = [dict(row, **ad_data_map[row['id']], **creatives_map[row['id']]) for row in rows if row['id'] in creatives_map]
+
+    winners = [_build_ad(row) for row in rows[:top_n]]
+    try:
+        ad_index.save_ads(ad_account_id, [
+            {**{key: row.get(key) for key in ['id'] + ad_index.DETAIL_COLUMNS},
+             'metrics': {column: row[column] for column in ad_ranking.METRIC_COLUMNS + ['hook_rate', 'hold_rate']}}
+            for row in rows
+        ], params['time_range']['since'], params['time_range']['until'])
+    except Exception as e:
+        print(f"⚠️ Impossible de mettre à jour l'index des annonces : {e}")
+    print(f"✅ {len(winners)} publicités classées.")
+    return winners
+
+
 def get_winning_ads(ad_account_id: str, 
                     min_spend: float = None, 
                     target_cpa: float = None, 
                     target_roas: float = None, 
                     date_start: str = None, 
-                    date_end: str = None) -> List[Ad]:
+                    date_end: str = None,
+                    api: Optional[FacebookAdsApi] = None,
+                    top_n: Optional[int] = None,
+                    weights: Optional[Dict[str, float]] = None) -> List[Ad]:
     """
     Récupère les publicités les plus performantes en se basant sur un filtre de dépense
-    et un tri par ROAS.
+    et un score (ROAS par défaut, voir ad_ranking.py et RANKING_WEIGHTS).
     1. Filtre les annonces pour ne garder que celles dépassant un seuil de dépense.
-    2. Trie les annonces restantes par ROAS décroissant.
+    2. Trie les annonces restantes par score décroissant ; avec `top_n`, seules les
+       `top_n` meilleures sont triées et retournées.
+
+    Les données brutes du compte sont mises en cache par période (voir `_get_raw_ads`) :
+    les filtres de dépense, CPA, ROAS et date de création sont appliqués localement, et
+    relancer une analyse avec d'autres seuils ne coûte aucun appel à l'API.
     """
-    CACHE_FILE = os.path.join(FACEBOOK_CACHE_DIR, f"facebook_cache_{ad_account_id}.json")
-    
-    # Déterminer si les filtres sont actifs pour décider de l'utilisation du cache
+    # Déterminer si des filtres sont actifs (le seuil de dépense par défaut ne s'applique que sans filtre)
     filters_active = any([min_spend is not None, target_cpa is not None, target_roas is not None, date_start is not None, date_end is not None])
-    
-    # --- Étape 0: Vérification du cache (uniquement si aucun filtre n'est appliqué) ---
-    if not filters_active and os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, 'r') as f:
-                cached_data = json.load(f)
-            cache_time = datetime.fromtimestamp(os.path.getmtime(CACHE_FILE))
-            if datetime.now() - cache_time < timedelta(hours=CACHE_DURATION_HOURS):
-                print("ℹ️ Données triées par ROAS chargées depuis le cache.")
-                return [Ad(**ad_data) for ad_data in cached_data]
-        except (json.JSONDecodeError, TypeError) as e:
-            print(f"⚠️ Erreur de lecture du cache ({e}), récupération depuis l'API.")
-
-    if filters_active:
-        print("ℹ️ Des filtres avancés sont appliqués, récupération des données depuis l'API Facebook...")
-    else:
-        print("ℹ️ Cache non trouvé ou expiré. Récupération des données depuis l'API Facebook...")
 
     try:
-        # --- Étape 1 & 2: Récupération des données brutes (IDs, détails, créatives) ---
-        account = AdAccount(ad_account_id)
-        print("Récupération des IDs de toutes les publicités actives...")
-        all_ads_paginated = account.get_ads(fields=[FBAd.Field.status, FBAd.Field.id])
-        
-        active_ad_ids = [ad[FBAd.Field.id] for ad in all_ads_paginated if ad[FBAd.Field.status] == 'ACTIVE']
-        print(f"{len(active_ad_ids)} publicités actives trouvées.")
+        if FACEBOOK_LOW_MEMORY and top_n and list(weights or ad_ranking.DEFAULT_WEIGHTS) == ['roas']:
+            return _stream_winning_ads(
+                ad_account_id, api, date_start, date_end, top_n, min_spend, target_cpa, target_roas,
+                spend_floor=None if filters_active else WINNING_ADS_SPEND_THRESHOLD
+            )
+
+        # --- Étape 1 à 3: Publicités actives, créatives et insights de la période (cache ou API) ---
+        ad_data_map, creatives_map, insights_map = _get_raw_ads(ad_account_id, api, date_start, date_end)
 
-        if not active_ad_ids:
+        if not ad_data_map:
             return []
-            
-        print("\\nRécupération groupée des détails et des créatives...")
-        ad_data_map = {}
-        creatives_map = {}
-        
-        for i in range(0, len(active_ad_ids), 50):
-            chunk = active_ad_ids[i:i+50]
-            ads_details = FBAd.get_by_ids(
-                ids=chunk,
-                fields=['id', 'name', 'created_time', 'creative{id,image_url,video_id}']
-            )
-            for ad in ads_details:
-                ad_data_map[ad['id']] = {'name': ad['name'], 'created_time': ad.get('created_time')}
-                if 'creative' in ad:
-                    creative_info = ad['creative']
-                    
-                    # Nous ne pouvons pas demander le champ 'video' directement sur AdCreative.
-                    # Nous utilisons le video_id directement de la créative.
-                    final_video_id = creative_info.get('video_id')
-                    
-                    print(f"DEBUG: Ad ID {ad['id']}, Creative ID: {creative_info.get('id')}, Extracted Video ID: {final_video_id}")
-
-                    creatives_map[ad['id']] = {
-                        'creative_id': creative_info.get('id'),
-                        'video_id': final_video_id,
-                        'image_url': creative_info.get('image_url')
-                    }
-        
-        ad_ids_with_creatives = list(creatives_map.keys())
-        if not ad_ids_with_creatives:
+
+        if not creatives_map:
             print("Aucune des publicités actives n'a de créative associée.")
             return []
         
-        # --- Étape 3: Récupération des insights ---
-        print(f"\\nRécupération groupée des métriques pour {len(ad_ids_with_creatives)} publicités...")
-        insights_map = _fetch_insights_batch(account, ad_ids_with_creatives, date_start, date_end)
         print(f"{len(insights_map)} insights récupérés.")
 
-        # --- Étape 4: Création des objets Ad et filtrage ---
-        all_ads_data = []
-        print("\\nConstruction des objets de publicités...")
-        
-        for ad_id, ad_data in ad_data_map.items():
-            creative_info = creatives_map.get(ad_id)
-            insight_data = insights_map.get(ad_id)
-
-            if not creative_info or not insight_data:
-                continue
-
-            # FILTRAGE PAR DATE DE CREATION
-            created_time_str = ad_data.get('created_time')
-            if date_start or date_end:
-                if not created_time_str:
-                    continue # On ignore les pubs sans date de création si un filtre est actif
-                
-                created_date = datetime.fromisoformat(created_time_str).date()
-                start_date_obj = datetime.strptime(date_start, '%Y-%m-%d').date() if date_start else None
-                end_date_obj = datetime.strptime(date_end, '%Y-%m-%d').date() if date_end else None
-
-                if start_date_obj and created_date < start_date_obj:
-                    continue
-                if end_date_obj and created_date > end_date_obj:
-                    continue
-
-            spend = float(insight_data.get('spend', 0))
-            cpa = next((float(action['value']) for action in insight_data.get('cost_per_action_type', []) if action['action_type'] == 'purchase'), 0.0)
-            roas = next((float(roas_item['value']) for roas_item in insight_data.get('purchase_roas', [])), 0.0)
-
-            # On ne garde que les annonces qui ont des données de conversion significatives
-            if spend > 0 and cpa > 0 and roas > 0:
-                # Appliquer les filtres s'ils sont fournis
-                if min_spend is not None and spend < min_spend:
-                    continue
-                if target_cpa is not None and cpa > target_cpa:
-                    continue
-                if target_roas is not None and roas < target_roas:
-                    continue
-
-                impressions = float(insight_data.get('impressions', 0))
-                video_3s_views = next((int(action['value']) for action in insight_data.get('video_play_actions', []) if action['action_type'] == 'video_view'), 0)
-                thru_plays = next((int(action['value']) for action in insight_data.get('video_thruplay_watched_actions', []) if action['action_type'] == 'video_view'), 0)
-
-                ad_obj = Ad(
-                    id=ad_id,
-                    name=ad_data['name'],
-                    creative_id=creative_info['creative_id'],
-                    video_id=creative_info.get('video_id'),
-                    image_url=creative_info.get('image_url'),
-                    insights=AdInsights(
-                        spend=spend,
-                        cpa=cpa,
-                        roas=roas,
-                        website_purchases=next((int(action['value']) for action in insight_data.get('actions', []) if action['action_type'] == 'purchase'), 0),
-                        website_purchases_value=next((float(action['value']) for action in insight_data.get('action_values', []) if action['action_type'] == 'purchase'), 0.0),
-                        cpm=float(insight_data.get('cpm', 0)),
-                        unique_ctr=float(insight_data.get('unique_ctr', 0)),
-                        frequency=float(insight_data.get('frequency', 0)),
-                        hook_rate=(video_3s_views / impressions * 100) if impressions > 0 else 0,
-                        hold_rate=(thru_plays / video_3s_views * 100) if video_3s_views > 0 else 0
-                    ),
-                    created_time=ad_data.get('created_time')
-                )
-                all_ads_data.append(ad_obj)
-        
-        if not all_ads_data:
-            print("Aucune publicité avec des données de conversion suffisantes n'a été trouvée.")
-            return []
+        # Les données brutes en cache sont partagées (même objet tant que le fichier ne change pas)
+        ranking_key = (id(ad_data_map), min_spend, target_cpa, target_roas, date_start, date_end, top_n,
+                       tuple(sorted((weights or ad_ranking.DEFAULT_WEIGHTS).items())))
+        with _ranked_lru_lock:
+            ranked = _ranked_lru.get(ranking_key)
+            if ranked is not None and ranked[0] is ad_data_map:
+                _ranked_lru.move_to_end(ranking_key)
+                print(f"✅ {len(ranked[1])} publicités classées (classement en mémoire).")
+                return list(ranked[1])
+
+        # --- Étape 4: Filtrage et classement vectorisés (voir ad_ranking.py) ---
+        frame = ad_ranking.build_frame(ad_data_map, creatives_map, insights_map)
 
-        # --- Étape 5: Tri final ---
         # Si aucun filtre de KPI n'est appliqué, on filtre par le seuil de dépense par défaut
-        # avant de trier par ROAS.
-        # Sinon, le filtrage a déjà été fait plus haut.
         if not filters_active:
-             print(f"\\nFiltrage des annonces avec une dépense supérieure à {WINNING_ADS_SPEND_THRESHOLD}$...")
-             qualifying_ads = [ad for ad in all_ads_data if ad.insights and ad.insights.spend > WINNING_ADS_SPEND_THRESHOLD]
+            print(f"\nFiltrage des annonces avec une dépense supérieure à {WINNING_ADS_SPEND_THRESHOLD}$...")
         else:
-             print("\\nPas de filtre de dépense par défaut car des filtres avancés sont actifs.")
-             qualifying_ads = all_ads_data
-
-        print(f"{len(qualifying_ads)} annonces qualifiées trouvées. Tri par ROAS...")
-        
-        # Tri des publicités qualifiées par ROAS décroissant
-        sorted_ads = sorted(
-            qualifying_ads, 
-            key=lambda ad: ad.insights.roas if ad.insights else 0, 
-            reverse=True
+            print("\nPas de filtre de dépense par défaut car des filtres avancés sont actifs.")
+        winners = ad_ranking.rank_ads(
+            frame, min_spend=min_spend, target_cpa=target_cpa, target_roas=target_roas,
+            date_start=date_start, date_end=date_end,
+            spend_floor=None if filters_active else WINNING_ADS_SPEND_THRESHOLD,
+            weights=weights, top_n=top_n
         )
+        if winners.empty:
+            print("Aucune publicité avec des données de conversion suffisantes n'a été trouvée.")
+            return []
+        # Les valeurs manquantes (NaN côté pandas) redeviennent None pour les modèles pydantic
+        winners = winners.astype(object).where(winners.notna(), None)
 
-        print(f"✅ {len(sorted_ads)} publicités triées par ROAS.")
+        # --- Étape 5: Objets Ad pour les seules gagnantes, dans l'ordre du classement ---
+        sorted_ads = [_build_ad(row) for row in winners.to_dict('records')]
+        with _ranked_lru_lock:
+            # La référence aux données brutes garde l'id() de la clé valide
+            _ranked_lru[ranking_key] = (ad_data_map, sorted_ads)
+            while len(_ranked_lru) > FACEBOOK_CACHE_LRU_SIZE:
+                _ranked_lru.popitem(last=False)
+        sorted_ads = list(sorted_ads)
 
-        # --- Étape 6: Sauvegarde dans le cache (uniquement si aucun filtre n'est appliqué) ---
-        if not filters_active:
-            print(f"Sauvegarde des données dans le cache : {CACHE_FILE}")
-            # Assurer que le répertoire du cache existe
-            os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
-            with open(CACHE_FILE, 'w') as f:
-                # Pydantic's model_dump_json est parfait pour ça
-                json_data = [ad.model_dump() for ad in sorted_ads]
-                json.dump(json_data, f, indent=4)
-        else:
-            print("CACHE: Sauvegarde ignorée car des filtres avancés ont été utilisés.")
+        print(f"✅ {len(sorted_ads)} publicités classées sur {len(frame)}.")
 
         return sorted_ads
 
+    except FacebookRateLimitError:
+        # Une limite de débit n'est pas une absence d'annonces : l'analyse doit échouer clairement
+        print("❌ Limite de débit de l'API Facebook atteinte malgré les nouvelles tentatives.")
+        raise
     except FacebookRequestError as e:
         print(f"❌ Erreur API Facebook : {e}")
         return []
@@ -334,74 +863,135 @@ def get_specific_winning_ad(ad_account_id: str, media_type: str, spend_threshold
     print(f"Meilleure annonce de type '{media_type}' trouvée : {best_ad.name} (CPA: {best_ad.insights.cpa})")
     return best_ad
 
-def get_ad_by_id(ad_id: str, ad_account_id: str) -> Optional[Ad]:
+def _ad_from_record(record: Dict) -> Ad:
+    """Construit un Ad à partir d'un enregistrement de l'index (métriques facultatives)."""
+    if record.get('metrics'):
+        return _build_ad({**record, **record['metrics']})
+    return Ad.model_construct(
+        id=record['id'],
+        name=record['name'],
+        creative_id=record.get('creative_id'),
+        video_id=record.get('video_id'),
+        image_url=record.get('image_url'),
+        image_hash=record.get('image_hash'),
+        insights=None,
+        created_time=record.get('created_time')
+    )
+
+
+def get_ad_by_id(ad_id: str, ad_account_id: str, api: Optional[FacebookAdsApi] = None,
+                 date_start: str = None, date_end: str = None) -> Optional[Ad]:
     """
-    Récupère une publicité spécifique par son ID en utilisant le cache des "winning ads".
-    Nécessite le ad_account_id pour localiser le bon fichier de cache.
+    Récupère une publicité spécifique par son ID via l'index persistant des annonces du compte
+    (voir ad_index.py), qui couvre toutes les annonces déjà récupérées, gagnantes ou non.
+    Les métriques indexées doivent couvrir exactement la période demandée : `date_start`/`date_end`,
+    ou à défaut la période par défaut des insights (`_insights_params`, les 30 derniers jours).
+    En cas d'absence (ou de période différente), seule cette publicité est relue depuis l'API
+    avec `api`, de préférence l'API du client (à défaut, l'API par défaut du processus, qui peut
+    être celle d'un autre client), puis ajoutée à l'index : jamais de récupération complète du compte.
     """
-    # On réutilise get_winning_ads qui contient la logique de cache.
-    # On met des seuils très bas pour s'assurer de récupérer toutes les pubs
-    # possibles du cache, car on ne connaît pas les seuils du rapport original.
-    all_cached_ads = get_winning_ads(ad_account_id)
-    
-    # On cherche l'annonce spécifique dans la liste chargée.
-    for ad in all_cached_ads:
-        if ad.id == ad_id:
-            return ad
-            
-    # Si non trouvée dans le cache, on tente un appel direct à l'API (fallback)
-    print(f"⚠️ Annonce {ad_id} non trouvée dans le cache, tentative de récupération directe via l'API...")
+    api = api or FacebookAdsApi.get_default_api()
+    time_range = _insights_params(date_start, date_end)['time_range']
+    record = ad_index.get_ad(ad_account_id, ad_id)
+    if record is not None and (record['metrics_since'], record['metrics_until']) == (time_range['since'], time_range['until']):
+        return _ad_from_record(record)
+
+    print(f"⚠️ Annonce {ad_id} absente de l'index pour cette période, récupération de cette seule annonce via l'API...")
     try:
-        ad_object = FBAd(ad_id).api_get(fields=['id', 'name', 'creative{id,image_url,video_id}'])
-        return Ad(
-            id=ad_object['id'],
-            name=ad_object['name'],
-            creative_id=ad_object.get('creative', {}).get('id'),
-            video_id=ad_object.get('creative', {}).get('video_id'),
-            image_url=ad_object.get('creative', {}).get('image_url'),
-        )
-    except FacebookRequestError:
+        # Les recherches concurrentes sont regroupées dans une même requête /batch
+        ad_object = graph_batch.get_batcher(api).get(
+            ad_id, AD_DETAIL_FIELDS + [_expanded_insights_field(date_start, date_end)]
+        ).result()
+    except FacebookRateLimitError as e:
+        print(f"❌ Limite de débit atteinte lors de la récupération directe de l'annonce {ad_id} : {e}")
+        return None
+    except (FacebookRequestError, RuntimeError):
         print(f"❌ Échec de la récupération directe de l'annonce {ad_id}.")
-    return None
+        return None
+
+    ad_data_map, creatives_map = _parse_ad_details([ad_object])
+    records = _index_ads(ad_account_id, ad_data_map, creatives_map, _expanded_insights([ad_object]),
+                         time_range['since'], time_range['until'])
+    return _ad_from_record(records[0])
+
+# Métadonnées de /debug_token conservées avec la validation du token
+TOKEN_DEBUG_FIELDS = ['app_id', 'application', 'type', 'user_id', 'is_valid', 'expires_at', 'data_access_expires_at', 'scopes']
+
+
+def _debug_token(api: FacebookAdsApi, token: str) -> Dict:
+    """Métadonnées du token (expiration, permissions...) ; vide si /debug_token est inaccessible."""
+    try:
+        data = api.call('GET', ('debug_token',), params={'input_token': token}).json().get('data', {})
+    except FacebookRequestError as e:
+        if e.api_error_code() == token_cache.AUTH_ERROR_CODE:
+            raise
+        return {}
+    return {field: data[field] for field in TOKEN_DEBUG_FIELDS if field in data}
+
 
-def check_token_validity(token: str) -> Tuple[bool, str, Optional[List[AdAccount]]]:
+def check_token_validity(token: str, use_cache: bool = True) -> Tuple[bool, str, Optional[List[Dict]]]:
     """
     Vérifie si un token d'accès Facebook est valide et peut accéder à des comptes publicitaires.
     Retourne un tuple: (est_valide, message, liste_comptes_pub)
+    Le résultat est mis en cache par empreinte du token (voir token_cache.py).
     """
+    if use_cache:
+        cached = token_cache.get(token)
+        if cached is not None:
+            return cached['is_valid'], cached['message'], cached['accounts']
+
     try:
-        # Initialise l'API temporairement avec le token fourni
-        api = FacebookAdsApi.init(access_token=token)
+        # API locale à cet appel : l'API par défaut du processus, utilisée par les analyses, n'est pas modifiée.
+        # Appelée depuis une requête web : pas d'attente sur les pauses des analyses en arrière-plan.
+        api = ThrottledFacebookAdsApi(FacebookSession(access_token=token), api_version="v19.0", interactive=True)
+        debug_info = _debug_token(api, token)
         
         # Tente de récupérer les comptes publicitaires de l'utilisateur associé au token
         me = User(fbid='me', api=api)
         # On demande le nom, l'id et le statut du compte pour l'affichage et le filtrage
-        ad_accounts = list(me.get_ad_accounts(fields=[
+        ad_accounts = [account.export_all_data() for account in me.get_ad_accounts(fields=[
             AdAccount.Field.id,
             AdAccount.Field.name, 
             AdAccount.Field.account_id,
             AdAccount.Field.account_status
-        ]))
+        ], params={'limit': 500})]
         
         if ad_accounts:
             # On ne garde que les comptes actifs (statut 1)
             active_accounts = [acc for acc in ad_accounts if acc[AdAccount.Field.account_status] == 1]
             if active_accounts:
-                return True, "Token válido y con acceso a cuentas publicitarias.", active_accounts
+                result = (True, "Token válido y con acceso a cuentas publicitarias.", active_accounts)
             else:
-                return False, "Token válido, pero sin acceso a ninguna cuenta publicitaria activa.", []
+                result = (False, "Token válido, pero sin acceso a ninguna cuenta publicitaria activa.", [])
         else:
-            return False, "Token válido, pero sin acceso a ninguna cuenta publicitaria.", []
+            result = (False, "Token válido, pero sin acceso a ninguna cuenta publicitaria.", [])
+        token_cache.save(token, result[0], result[1], result[2], debug_info)
+        return result
             
     except FacebookRequestError as e:
-        # L'API a renvoyé une erreur (ex: token invalide, expiré, etc.)
+        # L'API a renvoyé une erreur (ex: token invalide, expiré, etc.) ; une erreur d'authentification
+        # a déjà été enregistrée dans le cache par ThrottledFacebookAdsApi
         error_message = e.api_error_message()
         return False, f"Token inválido: {error_message}", None
+    except FacebookRateLimitError as e:
+        # Limite de débit atteinte : le token n'est pas en cause, rien n'est mis en cache
+        return False, str(e), None
     except Exception as e:
         # Autre erreur inattendue
         print(f"Error inesperado al validar el token: {e}")
         return False, f"Error inesperado al validar el token: {e}", None
 
+
+def cached_token_error(token: str) -> Optional[str]:
+    """
+    Message d'erreur si le cache sait déjà que le token est refusé ou expiré, sans appel à l'API.
+    Retourne None si le token n'est pas connu comme invalide.
+    """
+    cached = token_cache.get(token)
+    if cached is not None and not cached['is_valid'] and cached['accounts'] is None:
+        return cached['message']
+    return None
+
 # --- Test local (optionnel) ---
 if __name__ == '__main__':
     pass 
\ No newline at end of file
@@ -0,0 +1,293 @@
+"""
+Client de l'API Graph qui respecte les limites de débit de Facebook.
+
+`ThrottledFacebookAdsApi` remplace FacebookAdsApi : chaque réponse (ou erreur) est lue pour
+ses en-têtes d'utilisation (x-app-usage, x-ad-account-usage, x-business-use-case-usage).
+Au-delà de FACEBOOK_THROTTLE_USAGE_PCT, les appels suivants sont espacés, d'autant plus que
+l'on approche de 100 %. Chaque pause porte sur le quota concerné : x-app-usage met en pause
+tous les appels du processus, x-ad-account-usage seulement ceux du même compte publicitaire
+et x-business-use-case-usage ceux du même business. Un compte très sollicité ne ralentit
+donc pas les analyses des autres clients.
+
+Une API créée avec `interactive=True` (requêtes web, comme la validation d'un token) n'attend
+jamais une pause et n'est pas retentée : la requête HTTP ne doit pas dépasser le délai du
+worker gunicorn. Ses en-têtes d'utilisation alimentent tout de même les pauses des autres appels.
+
+Les erreurs de limitation et les erreurs temporaires sont retentées avec un délai exponentiel
+et aléatoire ; si la limite est toujours atteinte après FACEBOOK_API_MAX_RETRIES tentatives,
+`FacebookRateLimitError` est levée (un rapport vide ne doit pas passer pour « aucune annonce »).
+
+Les attentes sont mesurées dans pipeline_timings (étapes facebook_throttle et facebook_retry)
+et comptées dans `get_metrics()`.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from facebook_business.api import FacebookAdsApi
+from facebook_business.exceptions import FacebookRequestError
+
+import timings
+import token_cache
+from config import (
+    FACEBOOK_THROTTLE_USAGE_PCT, FACEBOOK_THROTTLE_MAX_PAUSE_SECONDS, FACEBOOK_API_MAX_RETRIES,
+    FACEBOOK_RETRY_BASE_SECONDS, FACEBOOK_RETRY_MAX_SECONDS
+)
+
+# Codes d'erreur de limitation : application, utilisateur, page, compte, cas d'usage business
+THROTTLING_ERROR_CODES = {4, 17, 32, 341, 613} | set(range(80000, 80015))
+# Limitation du quota de l'application : concerne tous les appels du processus
+APP_THROTTLING_ERROR_CODES = {4}
+# Service temporairement indisponible
+TRANSIENT_ERROR_CODES = {2}
+
+# Clé de la pause commune à tous les appels (quota de l'application)
+APP_PAUSE_KEY = 'app'
+
+
+class FacebookRateLimitError(Exception):
+    """La limite de débit de l'API Facebook est toujours atteinte après toutes les tentatives."""
+
+    def __init__(self, retry_after: float = 0):
+        self.retry_after = retry_after
+        minutes = max(1, round(retry_after / 60))
+        super().__init__(
+            f"Se alcanzó el límite de uso de la API de Facebook. Vuelve a intentarlo en unos {minutes} minuto(s)."
+        )
+
+
+_lock = threading.Lock()
+# Fin de pause (timestamp) par quota : 'app', 'account:<id>' ou 'business:<id>'
+_pause_until = {}
+_metrics = {
+    'calls': 0,
+    'throttle_pauses': 0,
+    'throttle_wait_seconds': 0.0,
+    'retries': 0,
+    'throttling_errors': 0,
+    'rate_limit_failures': 0,
+    'last_usage_pct': 0.0,
+    'max_usage_pct': 0.0,
+}
+
+
+def get_metrics() -> Dict:
+    """Compteurs du processus : appels, pauses, nouvelles tentatives et utilisation observée."""
+    with _lock:
+        return dict(_metrics)
+
+
+def _count(name: str, value: float = 1):
+    with _lock:
+        _metrics[name] += value
+
+
+def _json_header(headers, name: str) -> Optional[dict]:
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            try:
+                return json.loads(value)
+            except (TypeError, ValueError):
+                return None
+    return None
+
+
+def parse_usage(headers) -> Dict[str, Tuple[float, float]]:
+    """
+    Utilisation par quota d'après les en-têtes de la réponse :
+    {'app': (pourcentage, secondes avant le retour de l'accès), 'account': (...), 'business:<id>': (...)}.
+    Seuls les quotas présents dans les en-têtes sont retournés.
+    """
+    usage = {}
+
+    app_usage = _json_header(headers, 'x-app-usage')
+    if app_usage:
+        usage[APP_PAUSE_KEY] = (max(float(app_usage.get(key, 0)) for key in ('call_count', 'total_cputime', 'total_time')), 0.0)
+
+    account_usage = _json_header(headers, 'x-ad-account-usage')
+    if account_usage:
+        usage['account'] = (float(account_usage.get('acc_id_util_pct', 0)), float(account_usage.get('reset_time_duration', 0)))
+
+    business_usage = _json_header(headers, 'x-business-use-case-usage') or {}
+    for business_id, entries in business_usage.items():
+        usage_pct = 0.0
+        regain_seconds = 0.0
+        for entry in entries:
+            usage_pct = max([usage_pct] + [float(entry.get(key, 0)) for key in ('call_count', 'total_cputime', 'total_time')])
+            # Le délai annoncé est exprimé en minutes
+            regain_seconds = max(regain_seconds, float(entry.get('estimated_time_to_regain_access', 0)) * 60)
+        usage[f'business:{business_id}'] = (usage_pct, regain_seconds)
+
+    return usage
+
+
+def _pause_for_usage(usage_pct: float, regain_seconds: float) -> float:
+    """Pause à observer avant le prochain appel pour un niveau d'utilisation donné."""
+    if usage_pct >= 100:
+        return min(FACEBOOK_RETRY_MAX_SECONDS, max(regain_seconds, FACEBOOK_THROTTLE_MAX_PAUSE_SECONDS))
+    if usage_pct < FACEBOOK_THROTTLE_USAGE_PCT:
+        return 0.0
+    # Croissance quadratique : quelques secondes au seuil, la pause maximale près de 100 %
+    ratio = (usage_pct - FACEBOOK_THROTTLE_USAGE_PCT) / (100 - FACEBOOK_THROTTLE_USAGE_PCT)
+    return FACEBOOK_THROTTLE_MAX_PAUSE_SECONDS * ratio * ratio
+
+
+def _extend_pause(keys: List[str], seconds: float):
+    if seconds <= 0:
+        return
+    with _lock:
+        for key in keys:
+            _pause_until[key] = max(_pause_until.get(key, 0.0), time.time() + seconds)
+
+
+def _record_usage(headers, account_key: Optional[str]) -> Tuple[float, List[str]]:
+    """
+    Met à jour les pauses de chaque quota d'après les en-têtes.
+    Retourne (secondes avant le retour de l'accès, clés des business concernés).
+    """
+    usage = parse_usage(headers)
+    with _lock:
+        highest = max([0.0] + [usage_pct for usage_pct, _ in usage.values()])
+        _metrics['last_usage_pct'] = highest
+        _metrics['max_usage_pct'] = max(_metrics['max_usage_pct'], highest)
+
+    regain = 0.0
+    business_keys = []
+    for scope, (usage_pct, regain_seconds) in usage.items():
+        if scope == 'account':
+            # Sans compte connu, la pause ne peut être attribuée à personne
+            key = account_key
+        else:
+            key = scope
+            if scope != APP_PAUSE_KEY:
+                business_keys.append(scope)
+        regain = max(regain, regain_seconds)
+        if key:
+            _extend_pause([key], _pause_for_usage(usage_pct, regain_seconds))
+    return regain, business_keys
+
+
+def _wait_for_budget(keys: List[str]):
+    """Attend la fin des pauses des quotas utilisés par l'appel, s'il y en a une."""
+    with _lock:
+        wait = max([0.0] + [_pause_until.get(key, 0.0) for key in keys]) - time.time()
+    if wait <= 0:
+        return
+    print(f"⏳ Utilisation de l'API Facebook élevée, pause de {wait:.1f}s...")
+    _count('throttle_pauses')
+    _count('throttle_wait_seconds', wait)
+    with timings.span('facebook_throttle'):
+        time.sleep(wait)
+
+
+def backoff_delay(attempt: int, minimum: float = 0) -> float:
+    """Délai exponentiel avec une moitié aléatoire, pour désynchroniser les threads."""
+    ceiling = min(FACEBOOK_RETRY_MAX_SECONDS, FACEBOOK_RETRY_BASE_SECONDS * (2 ** attempt))
+    return min(FACEBOOK_RETRY_MAX_SECONDS, max(minimum, ceiling / 2 + random.uniform(0, ceiling / 2)))
+
+
+def is_throttling_error(error: FacebookRequestError) -> bool:
+    return error.api_error_code() in THROTTLING_ERROR_CODES
+
+
+def sleep_before_retry(reason: str, attempt: int, max_retries: int, delay: float):
+    """Compte la nouvelle tentative `attempt` puis attend `delay` secondes (étape facebook_retry)."""
+    _count('retries')
+    print(f"⚠️ Erreur temporaire de l'API Facebook ({reason}), nouvelle tentative {attempt}/{max_retries} dans {delay:.1f}s...")
+    with timings.span('facebook_retry'):
+        time.sleep(delay)
+
+
+def is_transient_error(error: FacebookRequestError) -> bool:
+    if error.api_error_code() in TRANSIENT_ERROR_CODES or error.api_transient_error():
+        return True
+    return (error.http_status() or 0) >= 500
+
+
+class ThrottledFacebookAdsApi(FacebookAdsApi):
+    """
+    FacebookAdsApi qui ralentit à l'approche des limites et retente les erreurs temporaires.
+    `ad_account_id` rattache les appels au quota du compte (sinon il est déduit du chemin) ;
+    `interactive` désactive attentes et nouvelles tentatives pour les requêtes web.
+    """
+
+    def __init__(self, session, api_version=None, enable_debug_logger=False,
+                 ad_account_id: Optional[str] = None, interactive: bool = False):
+        super().__init__(session, api_version, enable_debug_logger=enable_debug_logger)
+        self.ad_account_id = ad_account_id
+        self.interactive = interactive
+        # Business dont les quotas ont été signalés dans les réponses de cette API ; l'instance
+        # est partagée par les threads de récupération, d'où le verrou
+        self._business_keys = set()
+        self._business_keys_lock = threading.Lock()
+
+    def _account_key(self, path) -> Optional[str]:
+        account_id = self.ad_account_id
+        if not account_id:
+            path_text = path if isinstance(path, str) else '/'.join(str(part) for part in path or ())
+            match = re.search(r'act_\d+', path_text)
+            account_id = match.group(0) if match else None
+        return f'account:{account_id}' if account_id else None
+
+    def _pause_keys(self, account_key: Optional[str]) -> List[str]:
+        with self._business_keys_lock:
+            business_keys = sorted(self._business_keys)
+        return [APP_PAUSE_KEY] + ([account_key] if account_key else []) + business_keys
+
+    def _record(self, headers, account_key: Optional[str]) -> float:
+        regain_seconds, business_keys = _record_usage(headers, account_key)
+        with self._business_keys_lock:
+            self._business_keys.update(business_keys)
+        return regain_seconds
+
+    def call(self, method, path, params=None, headers=None, files=None, url_override=None, api_version=None):
+        account_key = self._account_key(path)
+        max_retries = 0 if self.interactive else FACEBOOK_API_MAX_RETRIES
+        attempt = 0
+        while True:
+            if not self.interactive:
+                _wait_for_budget(self._pause_keys(account_key))
+            _count('calls')
+            try:
+                response = super().call(
+                    method, path, params=params, headers=headers, files=files,
+                    url_override=url_override, api_version=api_version
+                )
+            except FacebookRequestError as e:
+                if e.api_error_code() == token_cache.AUTH_ERROR_CODE and self._session.access_token:
+                    token_cache.mark_invalid(self._session.access_token, e.api_error_message())
+                regain_seconds = self._record(e.http_headers(), account_key)
+                throttled = is_throttling_error(e)
+                if throttled:
+                    _count('throttling_errors')
+                if not (throttled or is_transient_error(e)):
+                    raise
+                if attempt >= max_retries:
+                    if throttled:
+                        _count('rate_limit_failures')
+                        raise FacebookRateLimitError(regain_seconds) from e
+                    raise
+                delay = backoff_delay(attempt, regain_seconds if throttled else 0)
+                if throttled:
+                    # Les autres appels sur le même quota attendent aussi : inutile qu'ils consomment ce qui reste
+                    if e.api_error_code() in APP_THROTTLING_ERROR_CODES:
+                        _extend_pause([APP_PAUSE_KEY], delay)
+                    else:
+                        _extend_pause(self._pause_keys(account_key)[1:], delay)
+                reason = f"code {e.api_error_code()}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+                reason = type(e).__name__
+            else:
+                self._record(response.headers(), account_key)
+                return response
+
+            attempt += 1
+            sleep_before_retry(reason, attempt, max_retries, delay)
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import hashlib
 import os
 import time
 from typing import TYPE_CHECKING, Dict, Tuple
@@ -6,6 +7,7 @@ import google.generativeai as genai
 from dotenv import load_dotenv
 
 import database
+import timings
 
 # Uso de TYPE_CHECKING para evitar una importación circular en tiempo de ejecución,
 # al tiempo que se proporcionan los tipos al linter. Este es el método más robusto.
@@ -20,6 +22,8 @@ load_dotenv()
 GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-pro-latest").strip('\'"')
 MODEL_FALLBACK_1 = os.getenv("MODEL_FALLBACK_1")
 MODEL_FALLBACK_2 = os.getenv("MODEL_FALLBACK_2")
+# À incrémenter à chaque modification des prompts : invalide le cache global des analyses.
+PROMPT_VERSION = "v2"
 # --- FIN CONFIGURATION ---
 
 def _format_ad_metrics_for_prompt(ad_data: Ad) -> str:
@@ -41,31 +45,23 @@ def _format_ad_metrics_for_prompt(ad_data: Ad) -> str:
     return "\\n".join(metrics)
 
 
-def analyze_image(image_path: str, ad_data: Ad) -> Tuple[str, Dict]:
-    """
-    Analyse une image et ses métriques pour fournir une explication textuelle de sa performance.
+def metrics_prompt_hash(ad_data: Ad) -> str:
+    """Hash du bloc de métriques injecté dans le prompt, pour la clé du cache global des analyses."""
+    return hashlib.sha256(_format_ad_metrics_for_prompt(ad_data).encode('utf-8')).hexdigest()
 
-    Args:
-        image_path: Le chemin local vers le fichier image.
-        ad_data: L'objet contenant les données de la publicité.
 
-    Returns:
-        Un tuple contenant l'analyse marketing et les métadonnées d'utilisation, 
-        ou un message d'erreur et un dictionnaire vide.
-    """
-    print(f"  🧠 Iniciando análisis de marketing para la imagen del anuncio '{ad_data.name}'...")
-    try:
-        api_key = database.get_setting("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("La clé API Gemini n'est pas configurée dans la base de données.")
-        genai.configure(api_key=api_key)
-        
-        # Le nom du modèle est maintenant lu depuis la variable de configuration
-        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+def _configure_api():
+    """Configure le SDK Gemini avec la clé stockée en base de données."""
+    api_key = database.get_setting("GEMINI_API_KEY")
+    if not api_key:
+        raise ValueError("La clé API Gemini n'est pas configurée dans la base de données.")
+    genai.configure(api_key=api_key)
 
-        ad_metrics_text = _format_ad_metrics_for_prompt(ad_data)
-        
-        prompt = f"""
+
+def _build_image_prompt(ad_data: Ad) -> str:
+    ad_metrics_text = _format_ad_metrics_for_prompt(ad_data)
+    
+    prompt = f"""
         **Contexto:** Eres un Director de Marketing y un experto en estrategia de publicidad, especializado en analizar el rendimiento de creatividades en redes sociales. Se te presenta una imagen publicitaria considerada "ganadora" junto con sus métricas clave.
 
         **Métricas del Anuncio Ganador:**
@@ -88,74 +84,13 @@ def analyze_image(image_path: str, ad_data: Ad) -> Tuple[str, Dict]:
         2. Después del análisis, inserta una línea separadora: `---`
         3. Inmediatamente después del separador, inserta la tabla Markdown con los conceptos (Parte 2). No añadas ningún texto introductorio antes de la tabla.
         """
-        
-        print("    ▶️ Enviando prompt en español e imagen al modelo...")
-        image_file = genai.upload_file(path=image_path, display_name=f"Ad Image: {ad_data.id}")
-        response = model.generate_content([prompt, image_file])
-
-        print("    ✅ Respuesta recibida.")
-        
-        # On vérifie que la réponse n'est pas vide et ne contient pas de message d'erreur connu
-        if not response.text or "Rate limit" in response.text or "API key" in response.text:
-            raise ValueError("Réponse invalide ou vide de l'API Gemini.")
-
-        return response.text.strip(), response.usage_metadata
-
-    except Exception as e:
-        print(f"    ❌ Ocurrió un error durante el análisis de Gemini: {e}")
-        # On relève l'exception pour que le pipeline puisse la capturer
-        raise e
-
-
-def analyze_video(video_path: str, ad_data: Ad) -> Dict:
-    """
-    Analiza un video y sus métricas usando una cadena de modelos de fallback.
+    return prompt
 
-    Args:
-        video_path: La ruta local al archivo de video.
-        ad_data: El objeto que contiene los datos del anuncio.
 
-    Returns:
-        Un dictionnaire contenant 'analysis_text', 'usage_metadata', 'model_used', 
-        et 'is_fallback' ou un message d'erreur.
-    """
-    print(f"  🧠 Iniciando análisis de marketing para el anuncio '{ad_data.name}'...")
-    video_file = None
-
-    models_to_try = [
-        GEMINI_MODEL_NAME,
-        MODEL_FALLBACK_1,
-        MODEL_FALLBACK_2
-    ]
-    # Filtrer les modèles non définis dans .env
-    models_to_try = [model for model in models_to_try if model]
-
-    try:
-        api_key = database.get_setting("GEMINI_API_KEY")
-        if not api_key:
-            raise ValueError("La clé API Gemini n'est pas configurée dans la base de données.")
-        genai.configure(api_key=api_key)
-        
-        print("    ⏳ Subiendo el archivo de video a la API de Gemini...")
-        video_file = genai.upload_file(path=video_path)
-        
-        processing_start_time = time.time()
-        timeout_seconds = 300
-        while video_file.state.name == "PROCESSING":
-            print(f"      Esperando el procesamiento... estado actual: {video_file.state.name}")
-            if time.time() - processing_start_time > timeout_seconds:
-                raise Exception(f"Timeout: El procesamiento del video superó los {timeout_seconds} segundos.")
-            time.sleep(10)
-            video_file = genai.get_file(video_file.name)
-        
-        if video_file.state.name == "FAILED":
-            raise Exception("Falló el procesamiento del video en Gemini.")
-            
-        print("    ✅ Video subido y procesado.")
-        
-        ad_metrics_text = _format_ad_metrics_for_prompt(ad_data)
-        
-        prompt = f"""
+def _build_video_prompt(ad_data: Ad) -> str:
+    ad_metrics_text = _format_ad_metrics_for_prompt(ad_data)
+    
+    prompt = f"""
         **Contexto:** Eres un Director de Marketing y un experto en estrategia de publicidad en video, especializado en analizar el rendimiento de creatividades en redes sociales. Se te presenta un video publicitario considerado "ganador" junto con sus métricas clave de rendimiento.
 
         **Métricas del Anuncio Ganador:**
@@ -179,14 +114,119 @@ def analyze_video(video_path: str, ad_data: Ad) -> Dict:
         2. Después del análisis, inserta una línea separadora: `---`
         3. Inmediatamente después del separador, inserta la tabla Markdown con los guiones (Parte 2). No añadas ningún texto introductorio antes de la tabla.
         """
-        
+    return prompt
+
+
+def delete_uploaded_file(uploaded_file):
+    """Supprime un fichier distant de l'API Gemini, sans lever d'exception."""
+    if not uploaded_file:
+        return
+    try:
+        genai.delete_file(uploaded_file.name)
+    except Exception as delete_error:
+        print(f"      - Attention: impossible de supprimer le fichier distant {uploaded_file.name}: {delete_error}")
+
+
+def upload_media(media_path: str, media_type: str, ad_data: Ad, cancel_event=None):
+    """
+    Envoie un média à l'API Gemini et attend la fin de son traitement côté serveur.
+    Première moitié de l'analyse : elle ne consomme aucun token de génération.
+    Si `cancel_event` (threading.Event) est levé pendant l'attente, le fichier est supprimé
+    et une exception est levée.
+
+    Returns:
+        Le fichier Gemini prêt à être passé à `generate_analysis`.
+    """
+    _configure_api()
+
+    if media_type == 'image':
+        print("    ▶️ Subiendo la imagen a la API de Gemini...")
+        with timings.span('gemini_upload', bytes=os.path.getsize(media_path)):
+            return genai.upload_file(path=media_path, display_name=f"Ad Image: {ad_data.id}")
+
+    print("    ⏳ Subiendo el archivo de video a la API de Gemini...")
+    with timings.span('gemini_upload', bytes=os.path.getsize(media_path)):
+        video_file = genai.upload_file(path=media_path)
+    try:
+        with timings.span('gemini_processing'):
+            processing_start_time = time.time()
+            timeout_seconds = 300
+            while video_file.state.name == "PROCESSING":
+                print(f"      Esperando el procesamiento... estado actual: {video_file.state.name}")
+                if time.time() - processing_start_time > timeout_seconds:
+                    raise Exception(f"Timeout: El procesamiento del video superó los {timeout_seconds} segundos.")
+                if cancel_event is not None:
+                    if cancel_event.wait(10):
+                        raise Exception("Procesamiento del video interrumpido: análisis cancelado.")
+                else:
+                    time.sleep(10)
+                video_file = genai.get_file(video_file.name)
+            
+            if video_file.state.name == "FAILED":
+                raise Exception("Falló el procesamiento del video en Gemini.")
+    except Exception:
+        delete_uploaded_file(video_file)
+        raise
+
+    print("    ✅ Video subido y procesado.")
+    return video_file
+
+
+def _raise_if_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise Exception("Generación interrumpida: análisis cancelado.")
+
+
+def generate_analysis(uploaded_file, media_type: str, ad_data: Ad, cancel_event=None) -> Dict:
+    """
+    Lance la génération sur un média déjà envoyé par `upload_media`.
+    Pour les vidéos, la chaîne de modèles de fallback est utilisée et le fichier distant
+    est supprimé à la fin, qu'il y ait succès ou échec.
+    Si `cancel_event` (threading.Event) est levé, aucun nouvel appel au modèle (ni fallback)
+    n'est lancé : une exception est levée à la place.
+
+    Returns:
+        Un dictionnaire contenant 'analysis_text', 'usage_metadata', 'model_used' et 'is_fallback'.
+    """
+    _configure_api()
+
+    if media_type == 'image':
+        _raise_if_cancelled(cancel_event)
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        print("    ▶️ Enviando prompt en español e imagen al modelo...")
+        response = model.generate_content([_build_image_prompt(ad_data), uploaded_file])
+        print("    ✅ Respuesta recibida.")
+
+        # On vérifie que la réponse n'est pas vide et ne contient pas de message d'erreur connu
+        if not response.text or "Rate limit" in response.text or "API key" in response.text:
+            raise ValueError("Réponse invalide ou vide de l'API Gemini.")
+
+        return {
+            "analysis_text": response.text.strip(),
+            "usage_metadata": response.usage_metadata,
+            "model_used": GEMINI_MODEL_NAME,
+            "is_fallback": False
+        }
+
+    models_to_try = [
+        GEMINI_MODEL_NAME,
+        MODEL_FALLBACK_1,
+        MODEL_FALLBACK_2
+    ]
+    # Filtrer les modèles non définis dans .env
+    models_to_try = [model for model in models_to_try if model]
+    prompt = _build_video_prompt(ad_data)
+
+    try:
         last_error = None
         for i, model_name in enumerate(models_to_try):
+            # Annulation : inutile de consommer des tokens pour un résultat qui ne sera pas utilisé
+            _raise_if_cancelled(cancel_event)
             try:
                 print(f"    ▶️ Tentative #{i+1} avec le modèle '{model_name}'...")
                 model = genai.GenerativeModel(model_name)
                 response = model.generate_content(
-                    [prompt, video_file],
+                    [prompt, uploaded_file],
                     request_options={"timeout": 150}  # Timeout de 2.5 minutes
                 )
                 
@@ -195,7 +235,6 @@ def analyze_video(video_path: str, ad_data: Ad) -> Dict:
                      raise ValueError(f"Réponse invalide ou vide de l'API Gemini avec le modèle {model_name}.")
 
                 print(f"    ✅ Réponse reçue avec '{model_name}'.")
-                genai.delete_file(video_file.name)
                 return {
                     "analysis_text": response.text.strip(),
                     "usage_metadata": response.usage_metadata,
@@ -211,14 +250,50 @@ def analyze_video(video_path: str, ad_data: Ad) -> Dict:
         # Si la boucle se termine sans succès
         # On lève l'exception pour que le pipeline puisse la capturer
         raise Exception(f"Toutes les tentatives d'analyse ont échoué. Dernière erreur: {last_error}")
+    finally:
+        # On s'assure que le fichier vidéo est supprimé même en cas d'erreur
+        delete_uploaded_file(uploaded_file)
+
 
+def analyze_image(image_path: str, ad_data: Ad) -> Tuple[str, Dict]:
+    """
+    Analyse une image et ses métriques pour fournir une explication textuelle de sa performance.
+
+    Args:
+        image_path: Le chemin local vers le fichier image.
+        ad_data: L'objet contenant les données de la publicité.
+
+    Returns:
+        Un tuple contenant l'analyse marketing et les métadonnées d'utilisation.
+    """
+    print(f"  🧠 Iniciando análisis de marketing para la imagen del anuncio '{ad_data.name}'...")
+    try:
+        image_file = upload_media(image_path, 'image', ad_data)
+        result = generate_analysis(image_file, 'image', ad_data)
+        return result["analysis_text"], result["usage_metadata"]
+    except Exception as e:
+        print(f"    ❌ Ocurrió un error durante el análisis de Gemini: {e}")
+        # On relève l'exception pour que le pipeline puisse la capturer
+        raise e
+
+
+def analyze_video(video_path: str, ad_data: Ad) -> Dict:
+    """
+    Analiza un video y sus métricas usando una cadena de modelos de fallback.
+
+    Args:
+        video_path: La ruta local al archivo de video.
+        ad_data: El objeto que contiene los datos del anuncio.
+
+    Returns:
+        Un dictionnaire contenant 'analysis_text', 'usage_metadata', 'model_used', 
+        et 'is_fallback'.
+    """
+    print(f"  🧠 Iniciando análisis de marketing para el anuncio '{ad_data.name}'...")
+    try:
+        video_file = upload_media(video_path, 'video', ad_data)
+        return generate_analysis(video_file, 'video', ad_data)
     except Exception as e:
         print(f"    ❌ Ocurrió un error general en el análisis de video: {e}")
-        # On s'assure que le fichier vidéo est supprimé même en cas d'erreur
-        if video_file:
-            try:
-                genai.delete_file(video_file.name)
-            except Exception as delete_error:
-                print(f"      - Attention: impossible de supprimer le fichier vidéo distant {video_file.name}: {delete_error}")
         # On relève l'exception pour que le pipeline puisse la capturer
-        raise e 
\ No newline at end of file
+        raise e
@@ -0,0 +1,165 @@
+"""
+Regroupement des lectures d'objets Graph (annonces, créatives, vidéos) via l'endpoint /batch.
+
+Chaque appel à `GraphBatcher.get(node_id, fields)` retourne immédiatement un Future. Les
+demandes sont envoyées par paquets d'au plus FACEBOOK_BATCH_SIZE (limite de l'API : 50) dans
+une seule requête HTTP, dès qu'un paquet est plein ou après FACEBOOK_BATCH_WINDOW_MS : des
+appels concurrents (plusieurs `get_ad_by_id` en rafale, par exemple) partagent ainsi le même
+aller-retour. Une erreur sur un objet n'échoue que son Future.
+
+La requête /batch passe par l'API fournie : avec ThrottledFacebookAdsApi, elle respecte les
+limites de débit comme les autres appels. Le /batch lui-même répond 200 même si certains objets
+sont limités : ces réponses individuelles (limitation, erreur temporaire) sont renvoyées dans un
+nouveau paquet avec le même délai exponentiel, puis échouent en FacebookRateLimitError si la
+limite est toujours atteinte.
+"""
+
+import threading
+import weakref
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from facebook_business.api import FacebookAdsApi
+
+import facebook_throttle
+from config import FACEBOOK_BATCH_SIZE, FACEBOOK_BATCH_WINDOW_MS, FACEBOOK_API_MAX_RETRIES
+
+# Nombre d'envois successifs des demandes restées sans réponse dans un paquet
+_MAX_BATCH_ATTEMPTS = 3
+
+
+class GraphBatcher:
+    """Accumule des lectures d'objets Graph et les envoie par paquets via /batch."""
+
+    def __init__(self, api: FacebookAdsApi, batch_size: int = FACEBOOK_BATCH_SIZE,
+                 window_seconds: float = FACEBOOK_BATCH_WINDOW_MS / 1000):
+        self.api = api
+        self.batch_size = max(1, min(batch_size, 50))
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._pending = []
+        self._timer = None
+
+    def get(self, node_id: str, fields: List[str]) -> Future:
+        """Demande la lecture de `node_id` ; le Future reçoit le dictionnaire de l'objet."""
+        future = Future()
+        with self._lock:
+            self._pending.append((node_id, ','.join(fields), future))
+            if len(self._pending) >= self.batch_size:
+                ready = self._take_pending()
+            else:
+                ready = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window_seconds, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if ready:
+            self._send(ready)
+        return future
+
+    def get_many(self, node_ids: List[str], fields: List[str]) -> Dict[str, Future]:
+        """Lecture de plusieurs objets : un Future par ID, dans l'ordre des IDs."""
+        futures = {node_id: self.get(node_id, fields) for node_id in node_ids}
+        self.flush()
+        return futures
+
+    def flush(self):
+        """Envoie immédiatement les demandes en attente."""
+        with self._lock:
+            ready = self._take_pending()
+        if ready:
+            self._send(ready)
+
+    def _take_pending(self) -> list:
+        # Appelé avec le verrou
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        ready, self._pending = self._pending, []
+        return ready
+
+    def _send(self, pending: list):
+        for start in range(0, len(pending), self.batch_size):
+            chunk = pending[start:start + self.batch_size]
+            try:
+                self._execute(chunk)
+            except Exception as e:
+                # Échec de la requête /batch elle-même : toutes ses demandes échouent
+                for _, _, future in chunk:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _execute(self, chunk: list):
+        # Une API interactive (requête web) ne retente pas : voir facebook_throttle
+        max_retries = 0 if getattr(self.api, 'interactive', False) else FACEBOOK_API_MAX_RETRIES
+        attempt = 0
+        while True:
+            retryable = self._execute_once(chunk)
+            if not retryable:
+                return
+            throttled = any(facebook_throttle.is_throttling_error(error) for _, error in retryable)
+            if attempt >= max_retries:
+                for (_, _, future), error in retryable:
+                    if facebook_throttle.is_throttling_error(error):
+                        rate_limit_error = facebook_throttle.FacebookRateLimitError()
+                        rate_limit_error.__cause__ = error
+                        future.set_exception(rate_limit_error)
+                    else:
+                        future.set_exception(error)
+                return
+            attempt += 1
+            facebook_throttle.sleep_before_retry(
+                f"{len(retryable)} objet(s) du /batch {'limités' if throttled else 'en erreur temporaire'}",
+                attempt, max_retries, facebook_throttle.backoff_delay(attempt - 1)
+            )
+            chunk = [item for item, _ in retryable]
+
+    def _execute_once(self, chunk: list) -> list:
+        """Envoie un paquet ; retourne les (demande, erreur) limitées ou temporaires, à renvoyer."""
+        retryable = []
+
+        def on_failure(response, item):
+            error = response.error()
+            if facebook_throttle.is_throttling_error(error) or facebook_throttle.is_transient_error(error):
+                retryable.append((item, error))
+            else:
+                item[2].set_exception(error)
+
+        batch = self.api.new_batch()
+        for item in chunk:
+            node_id, fields, future = item
+            batch.add(
+                'GET', (node_id,), params={'fields': fields},
+                success=lambda response, future=future: future.set_result(response.json()),
+                failure=lambda response, item=item: on_failure(response, item),
+            )
+
+        # Les demandes sans réponse (délai dépassé côté Facebook) sont renvoyées dans un nouveau paquet
+        attempts = 1
+        batch = batch.execute()
+        while batch is not None and attempts < _MAX_BATCH_ATTEMPTS:
+            attempts += 1
+            batch = batch.execute()
+
+        pending_retry = {id(item) for item, _ in retryable}
+        for item in chunk:
+            node_id, _, future = item
+            if not future.done() and id(item) not in pending_retry:
+                future.set_exception(RuntimeError(f"Aucune réponse de l'API Graph pour l'objet {node_id}."))
+        return retryable
+
+
+_batchers = weakref.WeakKeyDictionary()
+_batchers_lock = threading.Lock()
+
+
+def get_batcher(api: Optional[FacebookAdsApi] = None) -> GraphBatcher:
+    """Batcher partagé de l'API donnée (l'API par défaut si aucune n'est fournie)."""
+    api = api or FacebookAdsApi.get_default_api()
+    if api is None:
+        raise ValueError("L'API Facebook n'est pas initialisée.")
+    with _batchers_lock:
+        batcher = _batchers.get(api)
+        if batcher is None:
+            batcher = _batchers[api] = GraphBatcher(api)
+        return batcher
@@ -0,0 +1,155 @@
+"""
+Stockage local des insights quotidiens par annonce (requêtes Graph avec time_increment=1).
+
+Chaque jour d'un compte n'est téléchargé qu'une fois : une demande sur une période quelconque
+ne récupère que les jours absents de la base, plus les FACEBOOK_INSIGHTS_REFRESH_DAYS derniers
+jours, toujours relus car l'attribution des conversions évolue encore. Les métriques sont
+ensuite agrégées localement sur la période demandée.
+
+Les valeurs agrégées sont renvoyées au format des insights de l'API Graph, pour être traitées
+comme une réponse de l'API par facebook_client. Le CTR unique et la fréquence, fondés sur des
+personnes uniques, n'en sont que des approximations (moyennes pondérées) : ce mode est donc
+optionnel (FACEBOOK_DAILY_INSIGHTS, désactivé par défaut).
+"""
+
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Tuple
+
+import database
+from config import FACEBOOK_INSIGHTS_REFRESH_DAYS
+
+# Champs demandés pour chaque jour ; les métriques additives sont sommées sur la période
+DAILY_INSIGHT_FIELDS = [
+    'ad_id',
+    'spend',
+    'impressions',
+    'unique_ctr',
+    'frequency',
+    'actions',
+    'action_values',
+    'video_play_actions',
+    'video_thruplay_watched_actions',
+]
+
+
+def _action_value(actions: list, action_type: str) -> float:
+    return next((float(action['value']) for action in actions or [] if action['action_type'] == action_type), 0.0)
+
+
+def _days(since: str, until: str) -> List[str]:
+    start = datetime.strptime(since, '%Y-%m-%d').date()
+    end = datetime.strptime(until, '%Y-%m-%d').date()
+    return [(start + timedelta(days=offset)).isoformat() for offset in range((end - start).days + 1)]
+
+
+def missing_ranges(ad_account_id: str, since: str, until: str) -> List[Tuple[str, str]]:
+    """
+    Périodes (since, until) à télécharger pour couvrir [since, until] : jours jamais récupérés
+    et jours récents à rafraîchir, regroupés en plages contiguës.
+    """
+    conn = database.get_db_connection()
+    covered = {row['day'] for row in conn.execute(
+        'SELECT day FROM ad_insights_coverage WHERE ad_account_id = ? AND day BETWEEN ? AND ?',
+        (ad_account_id, since, until)
+    )}
+    conn.close()
+
+    refresh_from = (date.today() - timedelta(days=FACEBOOK_INSIGHTS_REFRESH_DAYS)).isoformat()
+    ranges = []
+    for day in _days(since, until):
+        if day in covered and day < refresh_from:
+            continue
+        previous_day = (datetime.strptime(day, '%Y-%m-%d').date() - timedelta(days=1)).isoformat()
+        if ranges and ranges[-1][1] == previous_day:
+            ranges[-1] = (ranges[-1][0], day)
+        else:
+            ranges.append((day, day))
+    return ranges
+
+
+def save_daily_insights(ad_account_id: str, since: str, until: str, rows: List[Dict]):
+    """
+    Remplace les insights quotidiens du compte sur [since, until] par `rows` (réponse Graph
+    avec time_increment=1) et marque ces jours comme couverts, dans une seule transaction.
+    """
+    now = time.time()
+    conn = database.get_db_connection()
+    try:
+        conn.execute(
+            'DELETE FROM ad_daily_insights WHERE ad_account_id = ? AND day BETWEEN ? AND ?',
+            (ad_account_id, since, until)
+        )
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO ad_daily_insights
+                (ad_account_id, ad_id, day, spend, impressions, purchases, purchase_value,
+                 video_3s_views, thru_plays, unique_ctr, frequency)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(
+                ad_account_id, row['ad_id'], row['date_start'],
+                float(row.get('spend', 0)), int(row.get('impressions', 0)),
+                int(_action_value(row.get('actions'), 'purchase')),
+                _action_value(row.get('action_values'), 'purchase'),
+                int(_action_value(row.get('video_play_actions'), 'video_view')),
+                int(_action_value(row.get('video_thruplay_watched_actions'), 'video_view')),
+                float(row.get('unique_ctr', 0)), float(row.get('frequency', 0)),
+            ) for row in rows]
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO ad_insights_coverage (ad_account_id, day, fetched_at) VALUES (?, ?, ?)',
+            [(ad_account_id, day, now) for day in _days(since, until)]
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def aggregate_insights(ad_account_id: str, since: str, until: str) -> Dict[str, Dict]:
+    """
+    Agrège les insights quotidiens du compte sur [since, until], par annonce.
+    CPA, ROAS et CPM sont recalculés à partir des sommes ; le CTR unique et la fréquence,
+    qui ne s'additionnent pas d'un jour à l'autre, sont des moyennes pondérées par les impressions.
+    """
+    conn = database.get_db_connection()
+    rows = conn.execute(
+        """
+        SELECT ad_id,
+               SUM(spend) AS spend, SUM(impressions) AS impressions,
+               SUM(purchases) AS purchases, SUM(purchase_value) AS purchase_value,
+               SUM(video_3s_views) AS video_3s_views, SUM(thru_plays) AS thru_plays,
+               SUM(unique_ctr * impressions) AS weighted_unique_ctr,
+               SUM(frequency * impressions) AS weighted_frequency
+        FROM ad_daily_insights
+        WHERE ad_account_id = ? AND day BETWEEN ? AND ?
+        GROUP BY ad_id
+        """,
+        (ad_account_id, since, until)
+    ).fetchall()
+    conn.close()
+
+    insights_map = {}
+    for row in rows:
+        spend, impressions, purchases = row['spend'], row['impressions'], row['purchases']
+        insight = {
+            'ad_id': row['ad_id'],
+            'spend': str(spend),
+            'impressions': str(impressions),
+            'cpm': str(spend / impressions * 1000 if impressions else 0),
+            'unique_ctr': str(row['weighted_unique_ctr'] / impressions if impressions else 0),
+            'frequency': str(row['weighted_frequency'] / impressions if impressions else 0),
+            'actions': [{'action_type': 'purchase', 'value': str(purchases)}],
+            'action_values': [{'action_type': 'purchase', 'value': str(row['purchase_value'])}],
+            'video_play_actions': [{'action_type': 'video_view', 'value': str(row['video_3s_views'])}],
+            'video_thruplay_watched_actions': [{'action_type': 'video_view', 'value': str(row['thru_plays'])}],
+        }
+        if purchases:
+            insight['cost_per_action_type'] = [{'action_type': 'purchase', 'value': str(spend / purchases)}]
+        if spend and row['purchase_value']:
+            insight['purchase_roas'] = [{'action_type': 'omni_purchase', 'value': str(row['purchase_value'] / spend)}]
+        insights_map[row['ad_id']] = insight
+    return insights_map
@@ -24,6 +24,8 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
 from config import config
+import database
+import timings
 
 class MediaDownloader:
     """Télécharge des médias (vidéos, images) en utilisant des stratégies adaptées."""
@@ -32,6 +34,55 @@ class MediaDownloader:
         self.download_folder = "data/storage"
         os.makedirs(self.download_folder, exist_ok=True)
 
+    @staticmethod
+    def media_source_key(video_id: Optional[str] = None, image_url: Optional[str] = None,
+                         image_hash: Optional[str] = None) -> Optional[str]:
+        """
+        Identifie la source d'un média dans l'index local (la vidéo prime sur l'image).
+        Une image est identifiée par son hash Facebook : son URL est signée et change d'une récupération à l'autre.
+        """
+        if video_id:
+            return f"video:{video_id}"
+        if image_hash:
+            return f"image_hash:{image_hash}"
+        if image_url:
+            return f"image:{image_url}"
+        return None
+
+    def find_local_media(self, source_key: str) -> Optional[dict]:
+        """
+        Cherche dans l'index un fichier déjà téléchargé pour cette source.
+        Retourne la ligne de l'index si le fichier est toujours présent et intact, sinon None
+        (l'entrée obsolète est alors supprimée).
+        """
+        if not source_key:
+            return None
+        conn = database.get_db_connection()
+        row = conn.execute('SELECT * FROM media_files WHERE source_key = ?', (source_key,)).fetchone()
+        if row and os.path.exists(row['file_path']) and os.path.getsize(row['file_path']) == row['size_bytes']:
+            conn.close()
+            return dict(row)
+        if row:
+            conn.execute('DELETE FROM media_files WHERE source_key = ?', (source_key,))
+            conn.commit()
+        conn.close()
+        return None
+
+    def index_local_media(self, source_key: str, ad_id: str, media_type: str, file_path: str, content_hash: Optional[str] = None):
+        """Enregistre (ou met à jour) l'emplacement d'un média présent dans le stockage local."""
+        if not source_key or not os.path.exists(file_path):
+            return
+        conn = database.get_db_connection()
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO media_files (source_key, ad_id, media_type, file_path, content_hash, size_bytes, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (source_key, ad_id, media_type, file_path, content_hash, os.path.getsize(file_path), time.time())
+        )
+        conn.commit()
+        conn.close()
+
     def download_image_locally(self, image_url: str, ad_id: str) -> Optional[str]:
         """
         Télécharge une image depuis son URL et la sauvegarde localement.
@@ -39,19 +90,21 @@ class MediaDownloader:
         """
         print(f"Démarrage du téléchargement de l'image pour la pub {ad_id}")
         try:
-            response = requests.get(image_url, stream=True, timeout=60)
-            response.raise_for_status()
+            with timings.span('download') as measure:
+                response = requests.get(image_url, stream=True, timeout=60)
+                response.raise_for_status()
 
-            # Détecter l'extension du fichier à partir de l'URL
-            file_extension = os.path.splitext(image_url.split('?')[0])[-1]
-            if not file_extension:
-                # Fallback sur .jpg si aucune extension n'est trouvée
-                file_extension = '.jpg'
-            
-            local_path = os.path.join(self.download_folder, f"{ad_id}{file_extension}")
-            with open(local_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+                # Détecter l'extension du fichier à partir de l'URL
+                file_extension = os.path.splitext(image_url.split('?')[0])[-1]
+                if not file_extension:
+                    # Fallback sur .jpg si aucune extension n'est trouvée
+                    file_extension = '.jpg'
+                
+                local_path = os.path.join(self.download_folder, f"{ad_id}{file_extension}")
+                with open(local_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        f.write(chunk)
+                measure['bytes'] = os.path.getsize(local_path)
 
             print(f"✅ Image sauvegardée localement : {local_path}")
             return local_path
@@ -68,7 +121,8 @@ class MediaDownloader:
         print(f"Démarrage du téléchargement local pour la pub {ad_id}")
         
         # Tenter d'extraire l'URL directe du .mp4
-        mp4_url = self._extract_mp4_url(video_id)
+        with timings.span('mp4_resolve'):
+            mp4_url = self._extract_mp4_url(video_id)
         if not mp4_url:
             print(f"❌ Impossible d'extraire l'URL du MP4 pour la pub {ad_id}.")
             return None
@@ -76,14 +130,16 @@ class MediaDownloader:
         # Télécharger le contenu de la vidéo
         try:
             print(f"Téléchargement du contenu de la vidéo depuis : {mp4_url[:100]}...")
-            response = requests.get(mp4_url, stream=True, timeout=60)
-            response.raise_for_status()
-            
-            # Sauvegarder le fichier localement
-            local_path = os.path.join(self.download_folder, f"{ad_id}.mp4")
-            with open(local_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            with timings.span('download') as measure:
+                response = requests.get(mp4_url, stream=True, timeout=60)
+                response.raise_for_status()
+                
+                # Sauvegarder le fichier localement
+                local_path = os.path.join(self.download_folder, f"{ad_id}.mp4")
+                with open(local_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=8192):
+                        f.write(chunk)
+                measure['bytes'] = os.path.getsize(local_path)
 
             print(f"✅ Vidéo sauvegardée localement : {local_path}")
             return local_path
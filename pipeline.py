@@ -2,14 +2,18 @@ import os
 import base64
 import re
 import json
+import queue
 import threading
+import time
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 import pytz
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 import shutil
-from typing import Tuple
+from typing import Tuple, Optional
 
 import facebook_client
 from media_downloader import MediaDownloader
@@ -17,6 +21,13 @@ import gemini_analyzer
 import image_generator
 import markdown
 import database
+import analysis_cache
+import timings
+import facebook_throttle
+from config import (
+    ANALYSIS_DOWNLOAD_WORKERS, ANALYSIS_UPLOAD_WORKERS, ANALYSIS_GENERATE_WORKERS, ANALYSIS_STAGE_QUEUE_SIZE,
+    PIPELINE_DB_FLUSH_EVERY, BATCH_MAX_WORKERS, BATCH_MAX_PER_AD_ACCOUNT, JOB_CANCEL_POLL_SECONDS
+)
 
 # On charge les variables d'environnement (comme les clés API et les prix)
 load_dotenv()
@@ -29,31 +40,6 @@ GEMINI_INPUT_PRICE_PER_MILLION_TOKENS = float(os.getenv("GEMINI_INPUT_PRICE_PER_
 GEMINI_OUTPUT_PRICE_PER_MILLION_TOKENS = float(os.getenv("GEMINI_OUTPUT_PRICE_PER_MILLION_TOKENS", "7.50").strip('\'"'))
 IMAGEN_PRICE_PER_IMAGE = float(os.getenv("IMAGEN_PRICE_PER_IMAGE", "0.03").strip('\'"'))
 
-# Le nom du fichier de cache d'analyse est maintenant dynamique et géré dans le pipeline.
-# CACHE_FILE = "analysis_cache.json" # Ancienne constante globale supprimée
-
-ANALYSIS_CACHE_DIR = "data/analysis_cache"
-
-def load_cache(cache_path: str):
-    """Charge les données depuis un fichier de cache JSON."""
-    if os.path.exists(cache_path):
-        try:
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                return json.load(f)  # <-- Indentation ici
-        except (json.JSONDecodeError, IOError):
-            return {}  # Retourne un cache vide en cas d'erreur
-    return {}
-
-def save_cache(cache_path: str, cache_data):
-    """Sauvegarde les données dans un fichier de cache JSON."""
-    try:
-        # S'assure que le répertoire de cache existe
-        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-        with open(cache_path, 'w', encoding='utf-8') as f:
-            json.dump(cache_data, f, indent=4)  # <-- Indentation ici
-    except IOError as e:
-        print(f"Erreur lors de la sauvegarde du cache sur {cache_path}: {e}")
-
 def calculate_analysis_cost(usage_metadata: dict) -> float:
     """Calcule le coût d'un appel à l'API Gemini à partir de ses métadonnées d'utilisation."""
     if not usage_metadata or not isinstance(usage_metadata, dict):
@@ -74,6 +60,14 @@ def calculate_analysis_cost(usage_metadata: dict) -> float:
 
     return input_cost + output_cost
 
+def _total_tokens(usage_metadata) -> int:
+    """Nombre total de tokens d'un appel Gemini (métadonnées sous forme d'objet ou de dict)."""
+    if isinstance(usage_metadata, dict):
+        return usage_metadata.get('total_token_count') or (
+            usage_metadata.get('prompt_token_count', 0) + usage_metadata.get('candidates_token_count', 0)
+        )
+    return getattr(usage_metadata, 'total_token_count', 0) or 0
+
 def generate_report_fragments(analyzed_ad_data) -> Tuple[str, str]:
     """Génère les fragments HTML pour l'analyse et les concepts."""
     
@@ -134,89 +128,164 @@ def create_image_grid_html(image_paths):
     grid_html += "</div>"
     return grid_html
 
-def _perform_single_ad_analysis(ad: facebook_client.Ad, cache: dict) -> dict:
+# --- PIPELINE D'ANALYSE PAR ÉTAPES ---
+# Une analyse se découpe en quatre étapes aux ressources très différentes :
+#   1. download : résolution de l'URL (Selenium) et téléchargement du média
+#   2. upload   : envoi à Gemini et attente du traitement côté serveur
+#   3. generate : appel au modèle (tokens)
+#   4. persist  : déplacement des fichiers, cache, base de données (thread appelant)
+# Chaque étape a son propre pool de threads ; elles sont reliées par des files bornées,
+# ce qui limite le nombre de médias téléchargés en attente (mémoire/disque) tout en
+# gardant chaque ressource occupée.
+
+def _new_analysis_task(index: int, ad: facebook_client.Ad, cancel_event: Optional[threading.Event] = None) -> dict:
+    """Crée la structure de travail qui circule entre les étapes du pipeline."""
+    return {
+        "index": index,
+        "ad": ad,
+        "cancel_event": cancel_event,
+        "cached": False,
+        "media_type": None,
+        "media_path": None,
+        "uploaded_file": None,
+        "media_hash": None,
+        "analysis_cache_key": None,
+        "result": None,
+        "error": None,
+    }
+
+def _resolve_local_media(ad: facebook_client.Ad) -> Tuple[str, Optional[str]]:
     """
-    Exécute le pipeline d'analyse complet (téléchargement, analyse, génération) pour une seule publicité.
-    Utilise et met à jour un dictionnaire de cache fourni.
-    Retourne un dictionnaire contenant toutes les données et les coûts de l'analyse.
+    Retourne (chemin local, hash du contenu si connu) du média de l'annonce.
+    Un média déjà présent dans data/storage (index `media_files`) est réutilisé tel quel ;
+    sinon il est téléchargé (Selenium + HTTP pour les vidéos).
     """
+    downloader = MediaDownloader()
+    indexed = downloader.find_local_media(MediaDownloader.media_source_key(ad.video_id, ad.image_url, ad.image_hash))
+    if indexed:
+        print(f"Média déjà présent localement, pas de nouveau téléchargement : {indexed['file_path']}")
+        return indexed['file_path'], indexed['content_hash']
+
+    local_media_path = None
+    if ad.video_id:
+        local_media_path = downloader.download_video_locally(ad.video_id, ad.id)
+    elif ad.image_url:
+        local_media_path = downloader.download_image_locally(ad.image_url, ad.id)
+
+    if not local_media_path:
+        raise Exception("Échec du téléchargement du média.")
+    return local_media_path, None
+
+def _stage_download(task: dict, cache: analysis_cache.AdAnalysisStore):
+    """Étape 1 : récupère l'entrée de cache éventuelle et télécharge le média."""
+    ad = task['ad']
     print(f"--- Début de l'analyse pour l'annonce : {ad.name} ({ad.id}) ---")
-    
-    cost_analysis = 0.0
-    cost_generation = 0.0
-    
-    if ad.id in cache and all(os.path.exists(p) for p in cache[ad.id].get('generated_image_paths', [])):
-         print(f"Annonce trouvée dans le cache, on utilise les données.")
-         analyzed_ad_data = cache[ad.id]
-         cost_analysis = analyzed_ad_data.get('cost_analysis', 0.0)
-         cost_generation = analyzed_ad_data.get('cost_generation', 0.0)
-
-         print("Re-téléchargement du média au cas où le chemin temporaire serait invalide...")
-         downloader = MediaDownloader()
-         local_media_path = None
-         if ad.video_id:
-             local_media_path = downloader.download_video_locally(ad.video_id, ad.id)
-         elif ad.image_url:
-             local_media_path = downloader.download_image_locally(ad.image_url, ad.id)
-         
-         if not local_media_path:
-             raise Exception("Échec du re-téléchargement du média.")
-             
-         analyzed_ad_data['media_path'] = local_media_path
-    else:
-        print("Analyse complète de l'annonce requise...")
-        downloader = MediaDownloader()
-        local_media_path, media_type = (None, None)
-        
-        if ad.video_id:
-            media_type = 'video'
-            local_media_path = downloader.download_video_locally(ad.video_id, ad.id)
-        elif ad.image_url:
-            media_type = 'image'
-            local_media_path = downloader.download_image_locally(ad.image_url, ad.id)
-
-        if not local_media_path:
-            raise Exception("Échec du téléchargement du média.")
-
-        full_response_text, usage_metadata = "", {}
-        model_used, is_fallback = None, False
-        if media_type == 'video':
-            video_analysis_result = gemini_analyzer.analyze_video(local_media_path, ad)
-            full_response_text = video_analysis_result.get("analysis_text", "")
-            usage_metadata = video_analysis_result.get("usage_metadata", {})
-            model_used = video_analysis_result.get("model_used", "N/A")
-            is_fallback = video_analysis_result.get("is_fallback", False)
-        else: # image
-            full_response_text, usage_metadata = gemini_analyzer.analyze_image(local_media_path, ad)
-            model_used = gemini_analyzer.GEMINI_MODEL_NAME
-            is_fallback = False
-
-        cost_analysis = calculate_analysis_cost(usage_metadata)
-        print(f"💰 Coût de l'analyse Gemini estimé : ${cost_analysis:.4f}")
-        
-        analysis_part, script_part = (full_response_text.split("---", 1) + [""])[:2]
-        
-        print("Génération des images concepts... (Désactivée)")
-        generated_image_paths = []
-        images_generated_count = 0
-        
-        cost_generation = images_generated_count * IMAGEN_PRICE_PER_IMAGE
-        print(f"💰 Coût de la génération d'images estimé : ${cost_generation:.4f}")
 
-        analyzed_ad_data = {
+    cached_entry = cache.get(ad.id)
+
+    if cached_entry and all(os.path.exists(p) for p in cached_entry.get('generated_image_paths', [])):
+        print(f"Annonce trouvée dans le cache, on utilise les données.")
+        task['cached'] = True
+        task['result'] = cached_entry
+        cached_entry['media_path'], task['media_hash'] = _resolve_local_media(ad)
+        task['media_type'] = cached_entry.get('media_type')
+        return
+
+    print("Analyse complète de l'annonce requise...")
+    media_type = 'video' if ad.video_id else 'image'
+    local_media_path, known_hash = _resolve_local_media(ad)
+
+    task['media_type'] = media_type
+    task['media_path'] = local_media_path
+
+    # Cache global : la même créative a peut-être déjà été analysée dans un autre rapport,
+    # avec les mêmes métriques (elles font partie du prompt, donc de l'analyse)
+    task['media_hash'] = known_hash or analysis_cache.compute_media_hash(local_media_path)
+    task['analysis_cache_key'] = analysis_cache.make_cache_key(
+        task['media_hash'], media_type, gemini_analyzer.PROMPT_VERSION, gemini_analyzer.GEMINI_MODEL_NAME,
+        gemini_analyzer.metrics_prompt_hash(ad)
+    )
+    cached_generation = analysis_cache.get_cached_analysis(task['analysis_cache_key'])
+    if cached_generation:
+        print("Analyse de ce média trouvée dans le cache global, Gemini n'est pas rappelé.")
+        task['cached'] = True
+        task['result'] = {
             "ad": ad.model_dump(),
             "media_type": media_type,
             "media_path": local_media_path,
-            "analysis_text": analysis_part.strip(),
-            "script_text": script_part.strip(),
-            "generated_image_paths": generated_image_paths,
-            "cost_analysis": cost_analysis,
-            "cost_generation": cost_generation,
-            "model_used": model_used,
-            "is_fallback": is_fallback
+            **cached_generation,
+            # Rien n'a été dépensé pour ce rapport
+            "cost_analysis": 0.0,
+            "cost_generation": 0.0,
         }
-        cache[ad.id] = analyzed_ad_data
+
+def _stage_upload(task: dict, cache: analysis_cache.AdAnalysisStore):
+    """Étape 2 : envoie le média à Gemini et attend la fin de son traitement."""
+    if task['cached']:
+        return
+    task['uploaded_file'] = gemini_analyzer.upload_media(
+        task['media_path'], task['media_type'], task['ad'], cancel_event=task.get('cancel_event')
+    )
+
+def _stage_generate(task: dict, cache: analysis_cache.AdAnalysisStore):
+    """Étape 3 : génère l'analyse et le script à partir du média envoyé."""
+    if task['cached']:
+        return
+    ad = task['ad']
+    with timings.span('generation') as measure:
+        generation = gemini_analyzer.generate_analysis(
+            task['uploaded_file'], task['media_type'], ad, cancel_event=task.get('cancel_event')
+        )
+        measure['tokens'] = _total_tokens(generation.get("usage_metadata"))
+    task['uploaded_file'] = None
+
+    full_response_text = generation.get("analysis_text", "")
+    usage_metadata = generation.get("usage_metadata", {})
+
+    cost_analysis = calculate_analysis_cost(usage_metadata)
+    print(f"💰 Coût de l'analyse Gemini estimé : ${cost_analysis:.4f}")
+    
+    analysis_part, script_part = (full_response_text.split("---", 1) + [""])[:2]
+    
+    print("Génération des images concepts... (Désactivée)")
+    generated_image_paths = []
+    images_generated_count = 0
     
+    cost_generation = images_generated_count * IMAGEN_PRICE_PER_IMAGE
+    print(f"💰 Coût de la génération d'images estimé : ${cost_generation:.4f}")
+
+    task['result'] = {
+        "ad": ad.model_dump(),
+        "media_type": task['media_type'],
+        "media_path": task['media_path'],
+        "analysis_text": analysis_part.strip(),
+        "script_text": script_part.strip(),
+        "generated_image_paths": generated_image_paths,
+        "cost_analysis": cost_analysis,
+        "cost_generation": cost_generation,
+        "model_used": generation.get("model_used", "N/A"),
+        "is_fallback": generation.get("is_fallback", False)
+    }
+
+    # Seules les réponses du modèle principal alimentent le cache global, pour qu'un
+    # fallback ponctuel ne soit pas resservi indéfiniment à la place du modèle demandé.
+    if not task['result']['is_fallback'] and task.get('analysis_cache_key'):
+        try:
+            analysis_cache.store_analysis(
+                task['analysis_cache_key'], task['media_hash'], gemini_analyzer.PROMPT_VERSION,
+                gemini_analyzer.GEMINI_MODEL_NAME,
+                {key: task['result'][key] for key in (
+                    "analysis_text", "script_text", "generated_image_paths", "model_used", "is_fallback"
+                )}
+            )
+        except Exception as cache_error:
+            print(f"⚠️ Impossible d'enregistrer l'analyse dans le cache global : {cache_error}")
+
+def _stage_finalize(task: dict, cache: analysis_cache.AdAnalysisStore):
+    """Étape 4 : déplace les médias vers le stockage définitif et met à jour le cache."""
+    ad = task['ad']
+    analyzed_ad_data = task['result']
+
     destination_folder = os.path.join('data', 'storage')
     os.makedirs(destination_folder, exist_ok=True)
     
@@ -238,146 +307,433 @@ def _perform_single_ad_analysis(ad: facebook_client.Ad, cache: dict) -> dict:
                 final_generated_image_paths.append(final_path)
     analyzed_ad_data['final_generated_image_paths'] = final_generated_image_paths
 
-    return analyzed_ad_data
+    # Le média est désormais à son emplacement définitif : on l'indexe pour les prochaines exécutions
+    if final_media_path:
+        try:
+            MediaDownloader().index_local_media(
+                MediaDownloader.media_source_key(ad.video_id, ad.image_url, ad.image_hash), ad.id,
+                analyzed_ad_data.get('media_type'), final_media_path,
+                task.get('media_hash') or analysis_cache.compute_media_hash(final_media_path)
+            )
+        except Exception as index_error:
+            print(f"⚠️ Impossible d'indexer le média {final_media_path} : {index_error}")
+
+    # Écriture atomique de l'enregistrement de cette seule annonce
+    cache[ad.id] = analyzed_ad_data
+
+_ANALYSIS_STAGES = [
+    # (nom, fonction, nombre de workers)
+    ('download', _stage_download, ANALYSIS_DOWNLOAD_WORKERS),
+    ('upload', _stage_upload, ANALYSIS_UPLOAD_WORKERS),
+    ('generate', _stage_generate, ANALYSIS_GENERATE_WORKERS),
+]
+
+# Exécutions simultanées de chaque étape pour tout le processus : plusieurs rapports en
+# parallèle (lots, worker intégré) se partagent ces places au lieu de multiplier les appels Gemini
+_STAGE_SLOTS = {stage_name: threading.BoundedSemaphore(max(1, workers)) for stage_name, _, workers in _ANALYSIS_STAGES}
+
+class AnalysisCancelled(Exception):
+    """Levée quand l'annulation d'un rapport a été demandée."""
+
+class AnalysisInputError(Exception):
+    """Échec dû aux paramètres du rapport (client, compte, token, aucune annonce) : inutile de le retenter."""
+
+def _watch_cancellation(report_id: int, cancel_event: threading.Event, stop_event: threading.Event,
+                        abort_event: Optional[threading.Event] = None):
+    """
+    Vérifie régulièrement si l'annulation du rapport a été demandée, ou si `abort_event` a été
+    levé (bail du job perdu), et lève alors `cancel_event`.
+    """
+    while not stop_event.wait(JOB_CANCEL_POLL_SECONDS):
+        if abort_event is not None and abort_event.is_set():
+            print(f"🛑 Exécution du rapport {report_id} interrompue : le job n'appartient plus à ce worker.")
+            cancel_event.set()
+            return
+        try:
+            if database.is_cancellation_requested(report_id):
+                print(f"🛑 Annulation demandée pour le rapport {report_id}.")
+                cancel_event.set()
+                return
+        except Exception as e:
+            print(f"⚠️ Impossible de vérifier l'annulation du rapport {report_id} : {e}")
+
+def _queue_put(q: queue.Queue, item, stop_event: threading.Event) -> bool:
+    """Dépose un élément dans une file bornée en restant attentif à l'arrêt du pipeline."""
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _acquire_stage_slot(stage_name: str, stop_event: threading.Event) -> bool:
+    """Attend une place libre pour l'étape ; retourne False si le pipeline s'arrête entre-temps."""
+    while not stop_event.is_set():
+        if _STAGE_SLOTS[stage_name].acquire(timeout=0.5):
+            return True
+    return False
+
+def _stage_worker(stage_name: str, stage_fn, inbox: queue.Queue, outbox: queue.Queue, done: queue.Queue,
+                  cache: analysis_cache.AdAnalysisStore, stop_event: threading.Event, report_id: Optional[int] = None):
+    """Boucle d'un worker : consomme sa file d'entrée, exécute l'étape, alimente l'étape suivante."""
+    while not stop_event.is_set():
+        try:
+            task = inbox.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if not _acquire_stage_slot(stage_name, stop_event):
+            # Pipeline arrêté : personne ne reprendra cette tâche
+            gemini_analyzer.delete_uploaded_file(task.get('uploaded_file'))
+            return
+        try:
+            # L'annulation est vérifiée entre deux étapes
+            if task['cancel_event'] is not None and task['cancel_event'].is_set():
+                raise AnalysisCancelled("Análisis cancelado por el usuario.")
+            with timings.bind(report_id=report_id, ad_id=task['ad'].id):
+                stage_fn(task, cache)
+        except Exception as stage_error:
+            if not isinstance(stage_error, AnalysisCancelled):
+                traceback.print_exc()
+            task['error'] = stage_error
+            # Un média envoyé mais jamais analysé ne doit pas rester chez Gemini
+            gemini_analyzer.delete_uploaded_file(task.get('uploaded_file'))
+            task['uploaded_file'] = None
+        finally:
+            _STAGE_SLOTS[stage_name].release()
+        # Une tâche en échec saute directement à l'étape de persistance
+        if not _queue_put(outbox if task['error'] is None else done, task, stop_event):
+            # Pipeline arrêté : personne ne reprendra cette tâche
+            gemini_analyzer.delete_uploaded_file(task.get('uploaded_file'))
+
+def _run_staged_analysis(ads: list, cache: analysis_cache.AdAnalysisStore, cancel_event: Optional[threading.Event] = None):
+    """
+    Fait passer les annonces dans les étapes download → upload → generate et renvoie
+    (générateur) chaque tâche terminée, dans l'ordre d'achèvement, après l'étape de
+    persistance exécutée dans le thread appelant. Les tâches en échec ont `error` renseigné.
+
+    Si `cancel_event` est levé, plus aucune étape ne démarre et le générateur s'arrête sans
+    attendre les appels en cours ; les médias déjà envoyés à Gemini sont supprimés.
+    """
+    cancel_event = cancel_event or threading.Event()
+    stop_event = threading.Event()
+    # Les threads ne partagent pas le contexte : le rapport mesuré leur est transmis explicitement
+    report_id = timings.current_report_id()
+    queues = [queue.Queue(maxsize=ANALYSIS_STAGE_QUEUE_SIZE) for _ in range(len(_ANALYSIS_STAGES) + 1)]
+    done_queue = queues[-1]
+
+    threads = []
+    for position, (stage_name, stage_fn, workers) in enumerate(_ANALYSIS_STAGES):
+        for worker_index in range(max(1, workers)):
+            thread = threading.Thread(
+                target=_stage_worker,
+                args=(stage_name, stage_fn, queues[position], queues[position + 1], done_queue, cache, stop_event, report_id),
+                name=f"analysis-{stage_name}-{worker_index}",
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+    def feed():
+        for index, ad in enumerate(ads):
+            if cancel_event.is_set() or not _queue_put(queues[0], _new_analysis_task(index, ad, cancel_event), stop_event):
+                return
+
+    feeder = threading.Thread(target=feed, name="analysis-feeder", daemon=True)
+    feeder.start()
+
+    try:
+        received = 0
+        while received < len(ads) and not cancel_event.is_set():
+            try:
+                task = done_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            received += 1
+            if task['error'] is None:
+                try:
+                    with timings.bind(ad_id=task['ad'].id):
+                        _stage_finalize(task, cache)
+                except Exception as persist_error:
+                    traceback.print_exc()
+                    task['error'] = persist_error
+            yield task
+    finally:
+        stop_event.set()
+        feeder.join()
+        if cancel_event.is_set():
+            # Les tâches restées en file ne seront pas traitées : on libère leurs fichiers Gemini.
+            # Les workers occupés par un appel en cours le termineront seuls (threads daemon).
+            for pending_queue in queues:
+                while True:
+                    try:
+                        gemini_analyzer.delete_uploaded_file(pending_queue.get_nowait().get('uploaded_file'))
+                    except queue.Empty:
+                        break
+        else:
+            for thread in threads:
+                thread.join()
+
+def creative_identity(ad: facebook_client.Ad) -> str:
+    """
+    Identité de la créative d'une annonce : deux annonces de même identité diffusent le même média.
+    On privilégie l'identifiant du média (vidéo, hash d'image) à celui de la créative, car une
+    même vidéo peut être réutilisée dans plusieurs créatives.
+    """
+    if ad.video_id:
+        return f"video:{ad.video_id}"
+    if ad.image_hash:
+        return f"image_hash:{ad.image_hash}"
+    if ad.image_url:
+        return f"image:{ad.image_url}"
+    if ad.creative_id:
+        return f"creative:{ad.creative_id}"
+    return f"ad:{ad.id}"
+
+def _group_by_creative(ranked_ads: list) -> list:
+    """Regroupe des (rang, annonce) par créative, dans l'ordre de première apparition."""
+    groups = {}
+    for rank, ad in ranked_ads:
+        groups.setdefault(creative_identity(ad), []).append((rank, ad))
+    return list(groups.values())
+
+def _perform_single_ad_analysis(ad: facebook_client.Ad, cache: analysis_cache.AdAnalysisStore) -> dict:
+    """
+    Exécute le pipeline d'analyse complet (téléchargement, analyse, génération) pour une seule publicité,
+    en enchaînant les étapes dans le thread courant.
+    Utilise et met à jour le cache d'analyses par annonce fourni.
+    Retourne un dictionnaire contenant toutes les données et les coûts de l'analyse.
+    """
+    task = _new_analysis_task(0, ad)
+    try:
+        for stage_name, stage_fn, _ in _ANALYSIS_STAGES:
+            with _STAGE_SLOTS[stage_name]:
+                stage_fn(task, cache)
+    except Exception:
+        gemini_analyzer.delete_uploaded_file(task.get('uploaded_file'))
+        raise
+    _stage_finalize(task, cache)
+    return task['result']
 
 def run_top_n_analysis_for_client(client_id: int, report_id: int, num_ads: int, 
                                   min_spend: float = None, target_cpa: float = None, 
                                   target_roas: float = None, date_start: str = None, 
-                                  date_end: str = None, analysis_code: str = None):
+                                  date_end: str = None, analysis_code: str = None,
+                                  abort_event: Optional[threading.Event] = None):
     """
     Exécute le pipeline d'analyse pour les N MEILLEURES annonces d'un client,
     génère un rapport HTML consolidé et met à jour un enregistrement de rapport existant.
-    """
-    print(f"--- DÉBUT PIPELINE TOP {num_ads} pour le client ID: {client_id} (Rapport ID: {report_id}) ---")
-    cache_path = os.path.join(ANALYSIS_CACHE_DIR, f"analysis_{client_id}_{report_id}_top{num_ads}.json")
-    
-    total_cost_analysis = 0.0
-    total_cost_generation = 0.0
 
-    try:
-        conn = database.get_db_connection()
-        client = conn.execute('SELECT * FROM clients WHERE id = ?', (client_id,)).fetchone()
-        conn.close()
-        if not client:
-            raise Exception(f"Client {client_id} non trouvé.")
+    Chaque annonce terminée est enregistrée comme point de reprise (`report_checkpoints`).
+    Si le rapport a déjà des points de reprise (exécution interrompue), la sélection
+    d'annonces d'origine est réutilisée et seules les annonces restantes sont analysées.
 
-        ad_account_id = client['ad_account_id']
-        if not ad_account_id or not ad_account_id.startswith('act_'):
-            raise ValueError(f"ID de compte publicitaire manquant ou invalide pour le client {client['name']}.")
-
-        conn = database.get_db_connection()
-        conn.execute('UPDATE analyses SET status = ? WHERE id = ?', ('RUNNING', report_id))
-        conn.commit()
-        conn.close()
-
-        print(f"Récupération des {num_ads} annonces les plus performantes...")
-        facebook_client.init_facebook_api(client['facebook_token'], ad_account_id)
-        
-        all_winning_ads = facebook_client.get_winning_ads(
-            ad_account_id=ad_account_id,
-            min_spend=min_spend,
-            target_cpa=target_cpa,
-            target_roas=target_roas,
-            date_start=date_start,
-            date_end=date_end
-        )
-        
-        top_ads = all_winning_ads[:num_ads]
-
-        if not top_ads:
-            # On utilise un message d'erreur plus descriptif
-            raise Exception("Ningún anuncio coincide con los criterios de filtro (fechas, gasto, etc.) o ninguno de los anuncios encontrados tiene datos de rendimiento suficientes para el análisis.")
+    Toutes les écritures passent par une seule connexion (ReportRunStore) et sont regroupées
+    par lots de PIPELINE_DB_FLUSH_EVERY annonces (par défaut 1 : chaque annonce terminée est
+    validée aussitôt).
 
-        print(f"{len(top_ads)} annonces performantes trouvées. Lancement des analyses...")
-        
-        ad_ids = [ad.id for ad in top_ads]
-        conn = database.get_db_connection()
-        conn.execute('UPDATE analyses SET ad_id = ? WHERE id = ?', (','.join(ad_ids), report_id))
-        conn.commit()
-        conn.close()
-
-        analyzed_ads_data = []
-        cache = load_cache(cache_path)
-        
-        # On va aussi stocker l'HTML de l'analyse principale pour le rapport final
-        final_analysis_html_parts = []
-
-        for ad in top_ads:
-            try:
-                analysis_result = _perform_single_ad_analysis(ad, cache)
-                analyzed_ads_data.append(analysis_result)
-                total_cost_analysis += analysis_result.get('cost_analysis', 0.0)
-                total_cost_generation += analysis_result.get('cost_generation', 0.0)
-                save_cache(cache_path, cache)
-
-                # Étape clé : Sauvegarder le script de cette annonce dans la nouvelle table
-                conn = database.get_db_connection()
-                script_html = markdown.markdown(analysis_result.get('script_text', ''), extensions=['tables'])
-                conn.execute(
-                    "INSERT INTO ad_scripts (report_id, ad_id, original_script_html) VALUES (?, ?, ?)",
-                    (report_id, ad.id, script_html)
-                )
-                conn.commit()
-                conn.close()
-                print(f"Script pour l'annonce {ad.id} sauvegardé dans la base de données.")
-
-                # On prépare l'HTML de l'analyse pour le rapport final
-                # (sans les scripts, qui seront chargés dynamiquement dans le template)
-                analysis_html = markdown.markdown(analysis_result.get('analysis_text', ''), extensions=['tables'])
-                final_analysis_html_parts.append({
-                    "ad": ad.model_dump(),
-                    "analysis_html": analysis_html,
-                    "media_type": analysis_result.get('media_type'),
-                    "final_media_path": analysis_result.get('final_media_path'),
-                    "model_used": analysis_result.get('model_used'),
-                    "is_fallback": analysis_result.get('is_fallback', False),
-                })
-            except Exception as ad_error:
-                error_message = f"Échec de l'analyse pour l'annonce ID {ad.id} ({ad.name}): {ad_error}"
-                print(f"\n[ERREUR] {error_message}\n")
-                traceback.print_exc()
-                # Enregistrer l'erreur dans la base de données et continuer
-                database.add_analysis_error(report_id, ad.id, str(ad_error))
-                continue
-
-        print("Toutes les analyses sont terminées. Assemblage du rapport principal...")
+    `abort_event` (levé par le worker quand le bail du job est perdu) arrête l'exécution comme
+    une annulation, mais sans toucher au statut du rapport : un autre worker en a la charge.
+    """
+    print(f"--- DÉBUT PIPELINE TOP {num_ads} pour le client ID: {client_id} (Rapport ID: {report_id}) ---")
+    cache = analysis_cache.AdAnalysisStore(f"analysis_{client_id}_{report_id}_top{num_ads}")
+    store = database.ReportRunStore(report_id, flush_every=PIPELINE_DB_FLUSH_EVERY)
+    # L'annulation demandée depuis l'interface est détectée par un thread de surveillance
+    cancel_event = threading.Event()
+    watcher_stop = threading.Event()
+    watcher = threading.Thread(
+        target=_watch_cancellation, args=(report_id, cancel_event, watcher_stop, abort_event),
+        name=f"cancel-watcher-{report_id}", daemon=True
+    )
+    watcher.start()
+
+    # Toutes les mesures de temps de cette exécution sont rattachées au rapport
+    with timings.bind(report_id=report_id):
+        try:
+            client = store.get_client(client_id)
+            if not client:
+                raise AnalysisInputError(f"Client {client_id} non trouvé.")
+
+            ad_account_id = client['ad_account_id']
+            if not ad_account_id or not ad_account_id.startswith('act_'):
+                raise AnalysisInputError(f"ID de compte publicitaire manquant ou invalide pour le client {client['name']}.")
+
+            # Les paramètres sont enregistrés dès le départ pour permettre une reprise
+            if not store.mark_running({
+                'num_ads': num_ads, 'min_spend': min_spend, 'target_cpa': target_cpa, 'target_roas': target_roas,
+                'date_start': date_start, 'date_end': date_end, 'analysis_code': analysis_code,
+            }):
+                raise AnalysisCancelled()
+
+            checkpoints = store.get_checkpoints()
+            if checkpoints:
+                # Reprise : on garde exactement la sélection et l'ordre de la première exécution
+                print(f"Reprise du rapport {report_id} à partir de ses points de reprise...")
+                top_ads = [facebook_client.Ad(**json.loads(checkpoint['ad_data'])) for checkpoint in checkpoints]
+            else:
+                print(f"Récupération des {num_ads} annonces les plus performantes...")
+                # Un token déjà connu comme refusé fait échouer l'analyse sans interroger l'API
+                token_error = facebook_client.cached_token_error(client['facebook_token'])
+                if token_error:
+                    raise AnalysisInputError(token_error)
+                with timings.span('facebook_fetch'):
+                    facebook_api = facebook_client.init_facebook_api(client['facebook_token'], ad_account_id)
+                
+                    all_winning_ads = facebook_client.get_winning_ads(
+                        ad_account_id=ad_account_id,
+                        min_spend=min_spend,
+                        target_cpa=target_cpa,
+                        target_roas=target_roas,
+                        date_start=date_start,
+                        date_end=date_end,
+                        api=facebook_api,
+                        top_n=num_ads
+                    )
+            
+                top_ads = all_winning_ads[:num_ads]
+
+                if not top_ads:
+                    # On utilise un message d'erreur plus descriptif
+                    raise AnalysisInputError("Ningún anuncio coincide con los criterios de filtro (fechas, gasto, etc.) o ninguno de los anuncios encontrados tiene datos de rendimiento suficientes para el análisis.")
+
+                print(f"{len(top_ads)} annonces performantes trouvées. Lancement des analyses...")
+                checkpoints = store.create_checkpoints(top_ads)
+
+            pending = [(checkpoint['rank'], ad) for checkpoint, ad in zip(checkpoints, top_ads) if checkpoint['status'] == 'PENDING']
+            # Une même créative diffusée dans plusieurs annonces n'est analysée qu'une fois
+            creative_groups = _group_by_creative(pending)
+            print(f"{len(pending)} annonce(s) à analyser sur {len(top_ads)} ({len(creative_groups)} créative(s) unique(s)).")
+
+            # Les étapes (téléchargement, envoi à Gemini, génération) tournent en parallèle ;
+            # la persistance se fait ici, dans ce seul thread, dans l'ordre d'achèvement.
+            if cancel_event.is_set() or database.is_cancellation_requested(report_id):
+                raise AnalysisCancelled()
+
+            for task in _run_staged_analysis([group[0][1] for group in creative_groups], cache, cancel_event):
+                group = creative_groups[task['index']]
+                if task['error'] is not None and (isinstance(task['error'], AnalysisCancelled) or cancel_event.is_set()):
+                    # Annonce interrompue par l'annulation : elle reste à analyser
+                    continue
+                if task['error'] is not None:
+                    ad_error = task['error']
+                    for rank, ad in group:
+                        error_message = f"Échec de l'analyse pour l'annonce ID {ad.id} ({ad.name}): {ad_error}"
+                        print(f"\n[ERREUR] {error_message}\n")
+                        # Enregistrer l'erreur dans la base de données et continuer
+                        store.add_error(rank, ad.id, str(ad_error))
+                    continue
+
+                analysis_result = task['result']
+                with timings.bind(ad_id=task['ad'].id), timings.span('markdown_render'):
+                    script_html = markdown.markdown(analysis_result.get('script_text', ''), extensions=['tables'])
+
+                    # On prépare l'HTML de l'analyse pour le rapport final
+                    # (sans les scripts, qui seront chargés dynamiquement dans le template)
+                    analysis_html = markdown.markdown(analysis_result.get('analysis_text', ''), extensions=['tables'])
+
+                # Le résultat est repris pour chaque annonce du groupe, avec ses propres métriques ;
+                # le coût n'est compté qu'une fois, sur la première annonce. L'analyse ayant été
+                # générée à partir des métriques de la première annonce, les autres l'indiquent.
+                representative = group[0][1]
+                for position, (rank, ad) in enumerate(group):
+                    is_first = position == 0
+                    report_part = {
+                        "ad": ad.model_dump(),
+                        "analysis_html": analysis_html,
+                        "media_type": analysis_result.get('media_type'),
+                        "final_media_path": analysis_result.get('final_media_path'),
+                        "model_used": analysis_result.get('model_used'),
+                        "is_fallback": analysis_result.get('is_fallback', False),
+                        "analysis_source_ad": None if is_first else {"id": representative.id, "name": representative.name},
+                    }
+                    # Le script et le point de reprise sont écrits ensemble, dans le prochain lot
+                    # (l'écriture du lot est mesurée par le store, étape db_write)
+                    store.add_result(
+                        rank, ad.id, script_html, report_part,
+                        analysis_result.get('cost_analysis', 0.0) if is_first else 0.0,
+                        analysis_result.get('cost_generation', 0.0) if is_first else 0.0
+                    )
+                if len(group) > 1:
+                    print(f"Analyse de la créative de l'annonce {representative.id} réutilisée pour {len(group) - 1} autre(s) annonce(s).")
+
+            # Vérification entre les annonces : l'annulation a pu arrêter le pipeline en cours de route
+            if cancel_event.is_set():
+                raise AnalysisCancelled()
+
+            store.flush()
+            print("Toutes les analyses sont terminées. Assemblage du rapport principal...")
+
+            # Le rapport est assemblé à partir des points de reprise, dans l'ordre du Top N :
+            # le résultat est le même que l'exécution ait été interrompue ou non.
+            completed = [checkpoint for checkpoint in store.get_checkpoints() if checkpoint['status'] == 'DONE']
+            final_analysis_html_parts = [json.loads(checkpoint['report_part']) for checkpoint in completed]
+            total_cost_analysis = sum(checkpoint['cost_analysis'] or 0.0 for checkpoint in completed)
+            total_cost_generation = sum(checkpoint['cost_generation'] or 0.0 for checkpoint in completed)
         
-        # La génération de l'HTML est maintenant simplifiée, car les scripts sont dans leur propre table.
-        # Nous allons juste stocker un JSON ou une structure de base dans 'analysis_html'
-        # que le template pourra utiliser.
-        final_report_structure = json.dumps(final_analysis_html_parts)
+            # La génération de l'HTML est maintenant simplifiée, car les scripts sont dans leur propre table.
+            # Nous allons juste stocker un JSON ou une structure de base dans 'analysis_html'
+            # que le template pourra utiliser.
+            final_report_structure = json.dumps(final_analysis_html_parts)
         
-        total_cost = total_cost_analysis + total_cost_generation
-        conn = database.get_db_connection()
-        conn.execute(
-            """
-            UPDATE analyses 
-            SET status = ?, analysis_html = ?, cost_analysis = ?, cost_generation = ?, total_cost = ?, 
-                num_ads_to_analyze = ?, min_spend_param = ?, target_cpa_param = ?, 
-                target_roas_param = ?, date_start_param = ?, date_end_param = ?, analysis_code_param = ?
-            WHERE id = ?
-            """,
-            ('COMPLETED', final_report_structure, total_cost_analysis, total_cost_generation, total_cost,
-             num_ads, min_spend, target_cpa, target_roas, date_start, date_end, analysis_code, report_id)
-        )
-        conn.commit()
-        conn.close()
+            total_cost = total_cost_analysis + total_cost_generation
+            store.complete(final_report_structure, total_cost_analysis, total_cost_generation)
         
-        print(f"--- FIN PIPELINE TOP {num_ads} pour le client : {client['name']}. Coût total: ${total_cost:.4f} ---")
+            print(f"--- FIN PIPELINE TOP {num_ads} pour le client : {client['name']}. Coût total: ${total_cost:.4f} ---")
 
-    except Exception as e:
-        error_message = f"ERREUR dans le pipeline TOP {num_ads} pour le rapport {report_id}: {e}"
-        print(error_message)
-        traceback.print_exc()
-        # On utilise la nouvelle fonction pour sauvegarder le statut ET la raison de l'échec
-        database.update_analysis_status(report_id, 'FAILED', failure_reason=str(e))
+        except AnalysisCancelled:
+            if abort_event is not None and abort_event.is_set():
+                # Les résultats déjà obtenus sont gardés ; le statut reste celui du nouveau worker
+                print(f"--- PIPELINE TOP {num_ads} INTERROMPU pour le rapport {report_id} (bail perdu) ---")
+                try:
+                    store.flush()
+                except Exception as flush_error:
+                    print(f"⚠️ Impossible d'enregistrer les derniers résultats du rapport {report_id} : {flush_error}")
+            else:
+                print(f"--- PIPELINE TOP {num_ads} ANNULÉ pour le rapport {report_id} ---")
+                store.cancel()
+        except Exception as e:
+            error_message = f"ERREUR dans le pipeline TOP {num_ads} pour le rapport {report_id}: {e}"
+            print(error_message)
+            traceback.print_exc()
+            # Les résultats déjà obtenus sont conservés avant de marquer l'échec (et sa raison) ;
+            # l'erreur remonte au worker, qui remet le job en file s'il lui reste des tentatives
+            store.fail(str(e))
+            raise
+        finally:
+            watcher_stop.set()
+            store.close()
+
+def resume_top_n_analysis(report_id: int, abort_event: Optional[threading.Event] = None):
+    """
+    Reprend un rapport Top N interrompu ou en échec avec ses paramètres d'origine.
+    Seules les annonces sans point de reprise terminé sont analysées.
+    """
+    conn = database.get_db_connection()
+    report = conn.execute('SELECT * FROM analyses WHERE id = ?', (report_id,)).fetchone()
+    conn.close()
+    if not report or not report['num_ads_to_analyze']:
+        print(f"Rapport {report_id} introuvable ou sans paramètres enregistrés : reprise impossible.")
+        return
+
+    run_top_n_analysis_for_client(
+        client_id=report['client_id'],
+        report_id=report_id,
+        num_ads=report['num_ads_to_analyze'],
+        min_spend=report['min_spend_param'],
+        target_cpa=report['target_cpa_param'],
+        target_roas=report['target_roas_param'],
+        date_start=report['date_start_param'],
+        date_end=report['date_end_param'],
+        analysis_code=report['analysis_code_param'],
+        abort_event=abort_event
+    )
 
 def run_analysis_for_client(client_id, report_id, media_type: str):
     """
     Exécute le pipeline d'analyse pour la MEILLEURE annonce d'un client pour un type de média donné.
     Met à jour un enregistrement de rapport existant.
     """
-    cache_path = os.path.join(ANALYSIS_CACHE_DIR, f"analysis_{client_id}_{report_id}.json")
+    cache = analysis_cache.AdAnalysisStore(f"analysis_{client_id}_{report_id}")
 
     try:
         conn = database.get_db_connection()
@@ -416,9 +772,7 @@ def run_analysis_for_client(client_id, report_id, media_type: str):
         conn.commit()
         conn.close()
 
-        cache = load_cache(cache_path)
         analyzed_ad_data = _perform_single_ad_analysis(best_ad, cache)
-        save_cache(cache_path, cache)
 
         print("Génération des fragments de rapport...")
         analysis_html, script_html_with_images = generate_report_fragments(analyzed_ad_data)
@@ -453,9 +807,160 @@ def run_analysis_for_client(client_id, report_id, media_type: str):
         conn.close()
         print(f"LOG: Statut du rapport {report_id} mis à jour à FAILED.")
 
+def run_batch_top_n_analysis(client_ids: Optional[list] = None, num_ads: int = 5,
+                             min_spend: float = None, target_cpa: float = None, target_roas: float = None,
+                             date_start: str = None, date_end: str = None,
+                             max_workers: int = BATCH_MAX_WORKERS,
+                             max_per_ad_account: int = BATCH_MAX_PER_AD_ACCOUNT) -> list:
+    """
+    Lance un rapport Top N pour chaque client (tous, ou ceux de `client_ids`) avec les mêmes
+    paramètres. Les clients se partagent un pool de `max_workers` threads ; au plus
+    `max_per_ad_account` analyses tournent en même temps sur un même compte publicitaire.
+    Chaque compte a sa file de clients : un client n'est confié au pool que lorsque son compte
+    a une place libre, et n'occupe donc jamais un thread à attendre. Les étapes d'analyse des
+    rapports simultanés se partagent les places globales de `_STAGE_SLOTS`.
+    Retourne un résumé par client (statut, coût, durée).
+    """
+    clients = database.get_all_clients()
+    if client_ids:
+        wanted = set(client_ids)
+        clients = [client for client in clients if client['id'] in wanted]
+        missing = wanted - {client['id'] for client in clients}
+        if missing:
+            print(f"⚠️ Clients introuvables ignorés : {sorted(missing)}")
+
+    account_queues = {}
+    results = []
+    runnable = []
+    for client in clients:
+        ad_account_id = client['ad_account_id']
+        if not ad_account_id or not ad_account_id.startswith('act_') or not client['facebook_token']:
+            results.append({'client_id': client['id'], 'client_name': client['name'], 'report_id': None,
+                            'status': 'SKIPPED', 'reason': "Compte publicitaire ou token manquant.",
+                            'total_cost': 0.0, 'duration': 0.0})
+            continue
+        account_queues.setdefault(ad_account_id, deque()).append(client)
+        runnable.append(client)
+
+    def run_client(client) -> dict:
+        created_at = datetime.now(pytz.timezone("America/Mexico_City")).strftime('%Y-%m-%d %H:%M:%S')
+        report_id = database.create_analysis_report(client['id'], f'Top {num_ads}', created_at)
+        started = time.time()
+        try:
+            run_top_n_analysis_for_client(
+                client_id=client['id'], report_id=report_id, num_ads=num_ads, min_spend=min_spend,
+                target_cpa=target_cpa, target_roas=target_roas, date_start=date_start, date_end=date_end
+            )
+        except Exception:
+            # L'échec et sa raison sont déjà enregistrés dans le rapport, lu ci-dessous
+            pass
+        duration = time.time() - started
+
+        conn = database.get_db_connection()
+        report = conn.execute(
+            'SELECT status, failure_reason, total_cost FROM analyses WHERE id = ?', (report_id,)
+        ).fetchone()
+        conn.close()
+        return {'client_id': client['id'], 'client_name': client['name'], 'report_id': report_id,
+                'status': report['status'], 'reason': report['failure_reason'],
+                'total_cost': report['total_cost'] or 0.0, 'duration': duration}
+
+    print(f"--- DÉBUT DU LOT : {len(runnable)} client(s), {max_workers} en parallèle, "
+          f"{max_per_ad_account} par compte publicitaire ---")
+    running = {}
+    running_per_account = {ad_account_id: 0 for ad_account_id in account_queues}
+
+    def submit_ready(executor):
+        # Tour à tour, chaque compte ayant une place libre confie son prochain client au pool
+        submitted = True
+        while submitted:
+            submitted = False
+            for ad_account_id, clients_queue in account_queues.items():
+                if clients_queue and running_per_account[ad_account_id] < max(1, max_per_ad_account):
+                    client = clients_queue.popleft()
+                    running_per_account[ad_account_id] += 1
+                    running[executor.submit(run_client, client)] = client
+                    submitted = True
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="batch-client") as executor:
+        submit_ready(executor)
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                client = running.pop(future)
+                running_per_account[client['ad_account_id']] -= 1
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    traceback.print_exc()
+                    results.append({'client_id': client['id'], 'client_name': client['name'], 'report_id': None,
+                                    'status': 'FAILED', 'reason': str(e), 'total_cost': 0.0, 'duration': 0.0})
+            submit_ready(executor)
+    return results
+
+def print_batch_summary(results: list):
+    """Affiche le résumé d'un lot : une ligne par client, puis les totaux."""
+    print("\n--- RÉSUMÉ DU LOT ---")
+    for result in sorted(results, key=lambda r: r['client_name'] or ''):
+        line = (f"{result['status']:<10} {result['client_name']} (client {result['client_id']}, "
+                f"rapport {result['report_id']}) - ${result['total_cost']:.4f} en {result['duration']:.0f}s")
+        if result['status'] != 'COMPLETED' and result['reason']:
+            line += f" : {result['reason']}"
+        print(line)
+
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    total_cost = sum(result['total_cost'] for result in results)
+    print(f"Total : {len(results)} client(s), "
+          + ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+          + f". Coût total : ${total_cost:.4f}")
+
+    api_metrics = facebook_throttle.get_metrics()
+    print(f"API Facebook : {api_metrics['calls']} appel(s), {api_metrics['retries']} nouvelle(s) tentative(s), "
+          f"{api_metrics['throttle_pauses']} pause(s) ({api_metrics['throttle_wait_seconds']:.0f}s), "
+          f"utilisation maximale {api_metrics['max_usage_pct']:.0f}%")
+
+def _batch_main(argv: list) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="python pipeline.py batch",
+        description="Lance un rapport Top N pour tous les clients (ou une sélection)."
+    )
+    parser.add_argument('--clients', type=lambda value: [int(i) for i in value.split(',') if i.strip()],
+                        help="IDs des clients séparés par des virgules (par défaut : tous).")
+    parser.add_argument('--top-n', type=int, default=5, help="Nombre d'annonces analysées par client.")
+    parser.add_argument('--min-spend', type=float)
+    parser.add_argument('--target-cpa', type=float)
+    parser.add_argument('--target-roas', type=float)
+    parser.add_argument('--date-start', help="Date de début (AAAA-MM-JJ).")
+    parser.add_argument('--date-end', help="Date de fin (AAAA-MM-JJ).")
+    parser.add_argument('--workers', type=int, default=BATCH_MAX_WORKERS,
+                        help="Nombre de clients analysés en parallèle.")
+    parser.add_argument('--per-account', type=int, default=BATCH_MAX_PER_AD_ACCOUNT,
+                        help="Analyses simultanées maximum par compte publicitaire.")
+    args = parser.parse_args(argv)
+
+    database.init_db()
+    if not database.get_setting('GEMINI_API_KEY'):
+        print("❌ La clé API Gemini n'est pas configurée : lot annulé.")
+        return 1
+
+    results = run_batch_top_n_analysis(
+        client_ids=args.clients, num_ads=args.top_n, min_spend=args.min_spend,
+        target_cpa=args.target_cpa, target_roas=args.target_roas,
+        date_start=args.date_start, date_end=args.date_end,
+        max_workers=args.workers, max_per_ad_account=args.per_account
+    )
+    print_batch_summary(results)
+    return 0 if all(result['status'] in ('COMPLETED', 'SKIPPED') for result in results) else 1
+
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(_batch_main(sys.argv[2:]))
+    elif len(sys.argv) > 1:
         run_analysis_for_client(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3])
     else:
-        print("Usage: python pipeline.py <client_id> <report_id> <media_type>") 
\ No newline at end of file
+        print("Usage: python pipeline.py <client_id> <report_id> <media_type>")
+        print("       python pipeline.py batch [--clients 1,2,3] [--top-n 5] [--workers N] [--per-account N] ...")
@@ -0,0 +1,147 @@
+"""
+Mesure des temps d'exécution du pipeline d'analyse, par rapport, par annonce et par étape.
+
+Chaque étape est encadrée par `span(stage)`, qui enregistre sa durée, son statut et, si
+l'étape les renseigne, les octets transférés et les tokens consommés dans la table
+`pipeline_timings`. Le rapport et l'annonce en cours sont liés au contexte avec `bind` :
+les appels imbriqués (téléchargeur, client Gemini...) n'ont pas à les connaître.
+
+Étapes mesurées : facebook_fetch, mp4_resolve, download, gemini_upload, gemini_processing,
+generation, markdown_render, db_write, ainsi que les attentes liées aux limites de l'API
+Facebook (facebook_throttle, facebook_retry).
+"""
+
+import contextvars
+import math
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import database
+from config import PIPELINE_TIMINGS_ENABLED, PIPELINE_TIMINGS_RETENTION_DAYS
+
+_report_id = contextvars.ContextVar('timings_report_id', default=None)
+_ad_id = contextvars.ContextVar('timings_ad_id', default=None)
+
+
+def current_report_id() -> Optional[int]:
+    """Rapport lié au contexte courant (à transmettre explicitement aux threads de travail)."""
+    return _report_id.get()
+
+
+def submit(executor, fn, *args, **kwargs):
+    """
+    `executor.submit` dans une copie du contexte courant : les mesures faites par le thread
+    du pool sont rattachées au rapport et à l'annonce liés ici (un pool ne les hérite pas).
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+@contextmanager
+def bind(report_id: Optional[int] = None, ad_id: Optional[str] = None):
+    """Associe un rapport et/ou une annonce aux mesures faites dans ce bloc."""
+    tokens = []
+    if report_id is not None:
+        tokens.append((_report_id, _report_id.set(report_id)))
+    if ad_id is not None:
+        tokens.append((_ad_id, _ad_id.set(ad_id)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+@contextmanager
+def span(stage: str, bytes: Optional[int] = None, tokens: Optional[int] = None):
+    """
+    Mesure la durée du bloc et l'enregistre sous le nom `stage`.
+    Le dictionnaire fourni permet de renseigner 'bytes' et 'tokens' une fois connus.
+    """
+    measure = {'bytes': bytes, 'tokens': tokens}
+    started_at = time.time()
+    start = time.perf_counter()
+    status = 'OK'
+    try:
+        yield measure
+    except BaseException:
+        status = 'ERROR'
+        raise
+    finally:
+        if PIPELINE_TIMINGS_ENABLED:
+            _record(stage, started_at, (time.perf_counter() - start) * 1000, measure, status)
+
+
+def _record(stage: str, started_at: float, duration_ms: float, measure: Dict, status: str):
+    # La mesure ne doit jamais faire échouer l'analyse
+    try:
+        conn = database.get_db_connection()
+        conn.execute(
+            """
+            INSERT INTO pipeline_timings (report_id, ad_id, stage, started_at, duration_ms, bytes, tokens, status)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (_report_id.get(), _ad_id.get(), stage, started_at, duration_ms,
+             measure.get('bytes'), measure.get('tokens'), status)
+        )
+        conn.commit()
+        conn.close()
+    except Exception as e:
+        print(f"⚠️ Impossible d'enregistrer la mesure '{stage}' : {e}")
+
+
+def purge_old_timings():
+    """Supprime les mesures plus anciennes que PIPELINE_TIMINGS_RETENTION_DAYS."""
+    conn = database.get_db_connection()
+    conn.execute(
+        'DELETE FROM pipeline_timings WHERE started_at < ?',
+        (time.time() - PIPELINE_TIMINGS_RETENTION_DAYS * 86400,)
+    )
+    conn.commit()
+    conn.close()
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    """Percentile par rang le plus proche sur une liste déjà triée."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def get_stage_stats(report_id: Optional[int] = None, days: Optional[float] = None) -> Dict:
+    """
+    Agrège les mesures par étape : nombre, erreurs, p50/p95/moyenne en millisecondes,
+    octets et tokens cumulés. Filtre optionnel sur un rapport ou sur les `days` derniers jours.
+    """
+    query = 'SELECT stage, duration_ms, bytes, tokens, status FROM pipeline_timings WHERE 1 = 1'
+    params = []
+    if report_id is not None:
+        query += ' AND report_id = ?'
+        params.append(report_id)
+    if days is not None:
+        query += ' AND started_at >= ?'
+        params.append(time.time() - days * 86400)
+
+    conn = database.get_db_connection()
+    rows = conn.execute(query, params).fetchall()
+    conn.close()
+
+    by_stage = {}
+    for row in rows:
+        by_stage.setdefault(row['stage'], []).append(row)
+
+    stats = {}
+    for stage, stage_rows in by_stage.items():
+        durations = sorted(row['duration_ms'] for row in stage_rows)
+        stats[stage] = {
+            'count': len(stage_rows),
+            'errors': sum(1 for row in stage_rows if row['status'] == 'ERROR'),
+            'p50_ms': round(_percentile(durations, 0.50), 1),
+            'p95_ms': round(_percentile(durations, 0.95), 1),
+            'mean_ms': round(sum(durations) / len(durations), 1),
+            'total_ms': round(sum(durations), 1),
+            'total_bytes': sum(row['bytes'] or 0 for row in stage_rows),
+            'total_tokens': sum(row['tokens'] or 0 for row in stage_rows),
+        }
+    return stats
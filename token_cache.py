@@ -0,0 +1,85 @@
+"""
+Cache des validations de tokens Facebook.
+
+Lister les comptes publicitaires d'un token d'agence prend plusieurs secondes : le résultat de
+`facebook_client.check_token_validity` (validité, message, comptes actifs, métadonnées de
+/debug_token) est conservé en base pendant TOKEN_VALIDATION_TTL_SECONDS, indexé par l'empreinte
+SHA-256 du token (le token lui-même n'est pas stocké ici).
+
+Dès que l'API répond par une erreur d'authentification (code 190) avec un token, celui-ci est
+marqué invalide : l'interface l'affiche sans nouvel appel et une analyse échoue immédiatement.
+"""
+
+import hashlib
+import json
+import time
+from typing import Dict, List, Optional
+
+import database
+from config import TOKEN_VALIDATION_TTL_SECONDS, TOKEN_VALIDATION_INVALID_TTL_SECONDS
+
+# Code d'erreur Graph d'un token invalide, expiré ou révoqué
+AUTH_ERROR_CODE = 190
+
+
+def token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def get(token: str) -> Optional[Dict]:
+    """
+    Validation en cache du token, ou None si absente ou expirée.
+    Retourne {'is_valid', 'message', 'accounts', 'debug_info', 'checked_at'}.
+    """
+    conn = database.get_db_connection()
+    row = conn.execute('SELECT * FROM token_validations WHERE token_hash = ?', (token_hash(token),)).fetchone()
+    conn.close()
+    if row is None:
+        return None
+
+    ttl = TOKEN_VALIDATION_TTL_SECONDS if row['is_valid'] else TOKEN_VALIDATION_INVALID_TTL_SECONDS
+    if time.time() - row['checked_at'] > ttl:
+        return None
+
+    debug_info = json.loads(row['debug_info']) if row['debug_info'] else {}
+    # Un token arrivé à expiration n'est plus valide, même si la validation est récente
+    expires_at = debug_info.get('expires_at') or 0
+    if row['is_valid'] and expires_at and expires_at < time.time():
+        return {
+            'is_valid': False, 'message': "Token inválido: el token ha expirado.", 'accounts': None,
+            'debug_info': debug_info, 'checked_at': row['checked_at']
+        }
+
+    return {
+        'is_valid': bool(row['is_valid']),
+        'message': row['message'],
+        'accounts': json.loads(row['accounts']) if row['accounts'] is not None else None,
+        'debug_info': debug_info,
+        'checked_at': row['checked_at'],
+    }
+
+
+def save(token: str, is_valid: bool, message: str, accounts: Optional[List[Dict]] = None,
+         debug_info: Optional[Dict] = None):
+    """Enregistre (ou remplace) le résultat de la validation du token."""
+    conn = database.get_db_connection()
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO token_validations (token_hash, is_valid, message, accounts, debug_info, checked_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (token_hash(token), 1 if is_valid else 0, message,
+         json.dumps(accounts) if accounts is not None else None,
+         json.dumps(debug_info) if debug_info else None, time.time())
+    )
+    conn.commit()
+    conn.close()
+
+
+def mark_invalid(token: str, message: str):
+    """Marque le token comme refusé par Facebook (erreur d'authentification)."""
+    try:
+        save(token, False, f"Token inválido: {message}")
+    except Exception as e:
+        # L'erreur d'origine reste celle qui doit remonter
+        print(f"⚠️ Impossible d'invalider le token en cache : {e}")
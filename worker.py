@@ -0,0 +1,198 @@
+"""
+Worker de fond qui exécute les jobs d'analyse enregistrés dans la table `jobs`.
+
+Chaque job est réclamé avec un bail renouvelé tant que l'analyse tourne. Si le processus
+meurt (redémarrage du conteneur, recyclage d'un worker gunicorn...), le bail expire et le
+job est repris par un autre worker. La limite JOB_MAX_CONCURRENCY est globale : on peut
+ajouter des processus worker sans dépasser la capacité prévue.
+
+Lancement : python worker.py [--slots N]
+"""
+
+import argparse
+import os
+import signal
+import socket
+import threading
+import traceback
+from datetime import datetime
+
+import pytz
+
+import database
+import facebook_client
+import pipeline
+import timings
+from config import (
+    JOB_LEASE_SECONDS, JOB_MAX_CONCURRENCY, JOB_POLL_INTERVAL_SECONDS, FACEBOOK_PREWARM_HOUR,
+    CACHE_DURATION_HOURS, FACEBOOK_CACHE_DIR, ANALYSIS_DEFAULT_WINDOW_DAYS
+)
+
+# Fonctions exécutées pour chaque type de job (le payload est passé en kwargs)
+JOB_HANDLERS = {
+    'top_n_analysis': pipeline.run_top_n_analysis_for_client,
+    'resume_top_n_analysis': pipeline.resume_top_n_analysis,
+}
+
+
+def _keep_lease_alive(job_id: int, worker_id: str, stop_event: threading.Event, lease_lost: threading.Event):
+    """
+    Renouvelle le bail du job à intervalles réguliers jusqu'à la fin de son exécution.
+    Si le bail est perdu (le job a pu être confié à un autre worker), `lease_lost` est levé :
+    l'analyse s'arrête au lieu de tourner en double.
+    """
+    while not stop_event.wait(JOB_LEASE_SECONDS / 3):
+        try:
+            renewed = database.renew_job_lease(job_id, worker_id, JOB_LEASE_SECONDS)
+        except Exception as e:
+            print(f"⚠️ [{worker_id}] Impossible de renouveler le bail du job {job_id} : {e}")
+            continue
+        if not renewed:
+            print(f"⚠️ [{worker_id}] Le bail du job {job_id} a été perdu, arrêt de l'analyse.")
+            lease_lost.set()
+            return
+
+
+def run_job(job: dict, worker_id: str):
+    """Exécute un job réclamé et enregistre son issue dans la file."""
+    handler = JOB_HANDLERS.get(job['job_type'])
+    print(f"--- [{worker_id}] Job {job['id']} ({job['job_type']}), tentative {job['attempts']}/{job['max_attempts']} ---")
+
+    heartbeat_stop = threading.Event()
+    lease_lost = threading.Event()
+    heartbeat = threading.Thread(
+        target=_keep_lease_alive, args=(job['id'], worker_id, heartbeat_stop, lease_lost), daemon=True
+    )
+    heartbeat.start()
+    try:
+        if handler is None:
+            raise ValueError(f"Type de job inconnu : {job['job_type']}")
+        handler(**job['payload'], abort_event=lease_lost)
+        if lease_lost.is_set():
+            # Le job ne nous appartient plus : son issue sera enregistrée par son nouveau worker
+            print(f"--- [{worker_id}] Job {job['id']} abandonné (bail perdu) ---")
+        else:
+            database.finish_job(job['id'], worker_id)
+            print(f"--- [{worker_id}] Job {job['id']} terminé ---")
+    except Exception as e:
+        traceback.print_exc()
+        if not lease_lost.is_set():
+            # Une erreur due aux paramètres du rapport échouerait de la même façon à chaque tentative
+            database.finish_job(job['id'], worker_id, error=str(e),
+                                retryable=not isinstance(e, pipeline.AnalysisInputError))
+    finally:
+        heartbeat_stop.set()
+        heartbeat.join()
+
+
+def worker_loop(worker_id: str, stop_event: threading.Event):
+    """Réclame et exécute des jobs jusqu'à ce que `stop_event` soit levé."""
+    print(f"Worker {worker_id} démarré.")
+    while not stop_event.is_set():
+        try:
+            job = database.claim_job(worker_id, JOB_LEASE_SECONDS, JOB_MAX_CONCURRENCY)
+        except Exception as e:
+            print(f"❌ [{worker_id}] Impossible de réclamer un job : {e}")
+            job = None
+
+        if job is None:
+            stop_event.wait(JOB_POLL_INTERVAL_SECONDS)
+            continue
+        run_job(job, worker_id)
+    print(f"Worker {worker_id} arrêté.")
+
+
+def prewarm_facebook_caches():
+    """
+    Rafraîchit, pour chaque client l'un après l'autre, le cache Facebook des périodes réellement
+    demandées : les 30 derniers jours (analyses sans dates) et la période par défaut du formulaire
+    (ANALYSIS_DEFAULT_WINDOW_DAYS). Les caches encore récents (moins de la moitié de
+    CACHE_DURATION_HOURS) sont laissés tels quels. Les caches trop vieux pour être servis sont
+    ensuite supprimés.
+    """
+    windows = sorted({30, ANALYSIS_DEFAULT_WINDOW_DAYS})
+    clients = database.get_all_clients()
+    print(f"--- Préchauffage des caches Facebook de {len(clients)} client(s) ---")
+    for client in clients:
+        ad_account_id = client['ad_account_id']
+        if not client['facebook_token'] or not ad_account_id or not ad_account_id.startswith('act_'):
+            continue
+        try:
+            api = facebook_client.init_facebook_api(client['facebook_token'], ad_account_id)
+            for days in windows:
+                if facebook_client.refresh_account_cache(ad_account_id, api, min_age_hours=CACHE_DURATION_HOURS / 2, days=days):
+                    print(f"Cache du client {client['name']} préchauffé ({days} derniers jours).")
+        except Exception as e:
+            print(f"⚠️ Préchauffage impossible pour le client {client['name']} : {e}")
+
+    removed = facebook_client.prune_raw_caches()
+    if removed:
+        print(f"{removed} cache(s) Facebook expiré(s) supprimé(s).")
+
+
+def _prewarm_loop(stop_event: threading.Event):
+    """
+    Lance `prewarm_facebook_caches` une fois par jour à FACEBOOK_PREWARM_HOUR (heure de Mexico).
+    Un fichier marqueur par jour garantit qu'un seul processus s'en charge.
+    """
+    timezone = pytz.timezone("America/Mexico_City")
+    while not stop_event.wait(60):
+        now = datetime.now(timezone)
+        if now.hour != FACEBOOK_PREWARM_HOUR:
+            continue
+        marker = os.path.join(FACEBOOK_CACHE_DIR, f".prewarm-{now.strftime('%Y-%m-%d')}")
+        try:
+            os.makedirs(FACEBOOK_CACHE_DIR, exist_ok=True)
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
+        for name in os.listdir(FACEBOOK_CACHE_DIR):
+            if name.startswith('.prewarm-') and name != os.path.basename(marker):
+                os.remove(os.path.join(FACEBOOK_CACHE_DIR, name))
+        try:
+            prewarm_facebook_caches()
+        except Exception:
+            traceback.print_exc()
+
+
+def start_workers(slots: int, stop_event: threading.Event) -> list:
+    """Démarre `slots` boucles de worker dans des threads et retourne ces threads."""
+    try:
+        timings.purge_old_timings()
+    except Exception as e:
+        print(f"⚠️ Impossible de purger les anciennes mesures de temps : {e}")
+
+    base_id = f"{socket.gethostname()}:{os.getpid()}"
+    threads = []
+    for slot in range(slots):
+        thread = threading.Thread(
+            target=worker_loop, args=(f"{base_id}:{slot}", stop_event), name=f"job-worker-{slot}", daemon=True
+        )
+        thread.start()
+        threads.append(thread)
+
+    if FACEBOOK_PREWARM_HOUR >= 0:
+        threading.Thread(target=_prewarm_loop, args=(stop_event,), name="fb-prewarm", daemon=True).start()
+    return threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exécute les jobs d'analyse en file d'attente.")
+    parser.add_argument('--slots', type=int, default=JOB_MAX_CONCURRENCY,
+                        help="Nombre de jobs exécutés en parallèle par ce processus.")
+    args = parser.parse_args()
+
+    database.init_db()
+    stop_event = threading.Event()
+    # Arrêt propre : on termine le job en cours, les autres restent en file
+    signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+    threads = start_workers(max(1, args.slots), stop_event)
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=1)
+
+
+if __name__ == '__main__':
+    main()